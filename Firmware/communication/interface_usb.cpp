@@ -60,7 +60,7 @@ public:
         // Loop to ensure all bytes get sent
         while (length) {
             size_t chunk = length < USB_TX_DATA_SIZE ? length : USB_TX_DATA_SIZE;
-            if (output_.process_packet(buffer, length) != 0)
+            if (output_.process_packet(buffer, chunk) != 0)
                 return -1;
             buffer += chunk;
             length -= chunk;
@@ -84,6 +84,13 @@ BidirectionalPacketBasedChannel usb_channel(usb_packet_output_native);
 StreamBasedPacketSink usb_packetized_output(usb_stream_output);
 BidirectionalPacketBasedChannel usb_channel(usb_packetized_output);
 StreamToPacketSegmenter usb_native_stream_input(usb_channel);
+// The native interface gets its own stream, so that responses go back on the
+// native IN endpoint. Clients that talk to the native interface through libusb
+// (e.g. USBBulkTransport.coalesce_delay) don't read the CDC IN endpoint.
+TreatPacketSinkAsStreamSink usb_stream_output_native(usb_packet_output_native);
+StreamBasedPacketSink usb_packetized_output_native(usb_stream_output_native);
+BidirectionalPacketBasedChannel usb_channel_native(usb_packetized_output_native);
+StreamToPacketSegmenter usb_native_stream_input_native(usb_channel_native);
 #endif
 
 struct USBInterface {
@@ -146,7 +153,7 @@ static void usb_server_thread(void * ctx) {
 #if defined(USB_PROTOCOL_NATIVE)
                 usb_channel.process_packet(ODrive_interface.rx_buf, ODrive_interface.rx_len);
 #elif defined(USB_PROTOCOL_NATIVE_STREAM_BASED)
-                usb_native_stream_input.process_bytes(
+                usb_native_stream_input_native.process_bytes(
                         ODrive_interface.rx_buf, ODrive_interface.rx_len, nullptr);
 #endif
                 USBD_CDC_ReceivePacket(&hUsbDeviceFS, ODrive_interface.out_ep);  // Allow next packet
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""
+Measures the Python overhead of attribute access on RemoteObject trees,
+without any communication: navigating to child objects, accessing
+internal attributes and reading a property that is served from the
+PropertyCache.
+
+Usage:
+    python benchmarks/attribute_benchmark.py
+"""
+
+import timeit
+
+from fake_device import FakeDevice, open_object
+import fibre.remote_object
+
+def run(name, stmt, namespace, iterations=200000):
+    seconds = min(timeit.repeat(stmt, globals=namespace, number=iterations, repeat=5))
+    print("  {:<40} {:8.3f} us".format(name, seconds / iterations * 1e6))
+
+def main():
+    device = FakeDevice()
+    odrv = open_object(device)
+    fibre.remote_object.enable_cache(odrv, config_ttl=1e9)
+    odrv.axis0.controller.config.vel_limit # populate the cache
+    controller = odrv.axis0.controller
+    namespace = {'odrv': odrv, 'controller': controller}
+
+    run("odrv.axis0.controller", "odrv.axis0.controller", namespace)
+    run("controller.__channel__", "controller.__channel__", namespace)
+    run("controller._remote_attributes", "controller._remote_attributes", namespace)
+    run("controller.config.vel_limit (cached)", "controller.config.vel_limit", namespace)
+    run("odrv.axis0.controller.config.vel_limit (cached)", "odrv.axis0.controller.config.vel_limit", namespace)
+
+    odrv.__channel__._channel_broken.set()
+    odrv.__channel__.fake_link.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Compares reading the supervisory values of both axes one by one through
+attribute access with reading them through RemoteObject.read_many().
+
+Usage:
+    python benchmarks/batch_benchmark.py [--latency SECONDS] [--cycles N]
+"""
+
+import argparse
+import time
+
+from fake_device import FakeDevice, open_object
+
+def axis_paths(axis):
+    paths = [axis + '.error', axis + '.current_state', axis + '.loop_counter']
+    paths += [axis + '.motor.' + name for name in ('error', 'is_calibrated', 'current_meas_phB', 'current_meas_phC')]
+    paths += [axis + '.motor.current_control.' + name for name in ('Iq_setpoint', 'Iq_measured', 'Id_measured')]
+    paths += [axis + '.encoder.' + name for name in ('error', 'is_ready', 'shadow_count', 'count_in_cpr', 'pos_estimate', 'pos_cpr', 'vel_estimate')]
+    paths += [axis + '.controller.' + name for name in ('error', 'pos_setpoint', 'vel_setpoint', 'vel_integrator_current', 'current_setpoint')]
+    paths += [axis + '.controller.config.' + name for name in ('control_mode', 'pos_gain', 'vel_gain', 'vel_integrator_gain', 'vel_limit')]
+    paths += [axis + '.motor.config.reserved' + str(i) for i in range(8)]
+    paths += [axis + '.encoder.config.reserved' + str(i) for i in range(4)]
+    return paths
+
+def read_one_by_one(obj, paths):
+    values = []
+    for path in paths:
+        value = obj
+        for name in path.split('.'):
+            value = getattr(value, name)
+        values.append(value)
+    return values
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.0005, help="one-way latency of the link in seconds")
+    parser.add_argument("--cycles", type=int, default=20, help="number of supervisory cycles")
+    args = parser.parse_args()
+
+    device = FakeDevice()
+    odrv = open_object(device, latency=args.latency)
+    paths = axis_paths('axis0') + axis_paths('axis1')
+    print("{} values per cycle".format(len(paths)))
+
+    assert read_one_by_one(odrv, paths) == odrv.read_many(paths)
+
+    start = time.monotonic()
+    for _ in range(args.cycles):
+        read_one_by_one(odrv, paths)
+    sequential = (time.monotonic() - start) / args.cycles
+    print("one by one: {:7.2f} ms/cycle".format(sequential * 1000))
+
+    start = time.monotonic()
+    for _ in range(args.cycles):
+        odrv.read_many(paths)
+    batched = (time.monotonic() - start) / args.cycles
+    print("read_many:  {:7.2f} ms/cycle ({:.1f}x)".format(batched * 1000, sequential / batched))
+
+    odrv.__channel__._channel_broken.set()
+    odrv.__channel__.fake_link.close()
+
+if __name__ == '__main__':
+    main()
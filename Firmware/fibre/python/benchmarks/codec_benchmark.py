@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Compares the precompiled struct.Struct based codecs in fibre.remote_object
+with the format string based implementation that was used previously, and
+measures encoding a request and decoding a response for a float property.
+
+Usage:
+    python benchmarks/codec_benchmark.py
+"""
+
+import os
+import sys
+import struct
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from fibre.remote_object import StructCodec
+
+## Previous implementation, kept here as a baseline ##
+
+class LegacyStructCodec():
+    def __init__(self, struct_format, target_type):
+        self._struct_format = struct_format
+        self._target_type = target_type
+    def get_length(self):
+        return struct.calcsize(self._struct_format)
+    def serialize(self, value):
+        value = self._target_type(value)
+        return struct.pack(self._struct_format, value)
+    def deserialize(self, buffer):
+        value = struct.unpack(self._struct_format, buffer)
+        value = value[0] if len(value) == 1 else value
+        return self._target_type(value)
+
+def legacy_request(codec, value):
+    packet = struct.pack('<HHH', 0x81, 0x8012, 0)
+    packet = packet + codec.serialize(value)
+    return packet + struct.pack('<H', 0x1234)
+
+def legacy_response(codec, ack):
+    return codec.deserialize(ack[2:])
+
+def new_request(codec, value):
+    return codec.pack_request(0x81, 0x8012, 0, value, 0x1234)
+
+def new_response(codec, ack):
+    return codec.deserialize_from(ack, 2)
+
+def run(name, func, iterations):
+    seconds = min(timeit.repeat(func, number=iterations, repeat=5))
+    print("  {:<8} {:8.3f} us/call".format(name, seconds / iterations * 1e6))
+    return seconds
+
+def main():
+    iterations = 200000
+    for fmt, target_type, value in (("<f", float, 1.5), ("<i", int, -1234), ("<?", bool, True)):
+        legacy = LegacyStructCodec(fmt, target_type)
+        codec = StructCodec(fmt, target_type)
+        ack = struct.pack('<H', 0x8081) + codec.serialize(value)
+        assert new_request(codec, value) == legacy_request(legacy, value)
+        assert new_response(codec, ack) == legacy_response(legacy, ack) == value
+
+        print("encode request ({})".format(fmt))
+        t_old = run("legacy", lambda: legacy_request(legacy, value), iterations)
+        t_new = run("struct", lambda: new_request(codec, value), iterations)
+        print("  speedup: {:.1f}x".format(t_old / t_new))
+        print("decode response ({})".format(fmt))
+        t_old = run("legacy", lambda: legacy_response(legacy, ack), iterations)
+        t_new = run("struct", lambda: new_response(codec, ack), iterations)
+        print("  speedup: {:.1f}x".format(t_old / t_new))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Measures the cost of signalling the completion of requests.
+
+The first part compares the lock based completion of PendingOperation with
+a fibre.utils.Event per request (as used before) in a single thread. The
+second part issues requests to a fake device with no latency from many
+threads at once, which is dominated by per-request overhead and lock
+contention.
+
+Usage:
+    python benchmarks/completion_benchmark.py [--count N] [--threads N [N ...]]
+"""
+
+import argparse
+import threading
+import time
+
+from fake_device import FakeDevice, open_channel
+import fibre.protocol
+from fibre.utils import Event
+
+class _FakeChannel(object):
+    def _resend_overdue(self):
+        pass
+
+def event_completion(count):
+    start = time.monotonic()
+    for _ in range(count):
+        done = Event()
+        done.set()
+        done.wait(1.0)
+    return (time.monotonic() - start) / count
+
+def operation_completion(count):
+    channel = _FakeChannel()
+    start = time.monotonic()
+    for _ in range(count):
+        operation = fibre.protocol.PendingOperation(channel, 0, b'', 1)
+        operation._resend_deadline = time.monotonic() + 1.0
+        operation._set_done()
+        operation._wait(1.0)
+    return (time.monotonic() - start) / count
+
+def concurrent_requests(channel, endpoint_id, n_threads, count):
+    def worker():
+        for _ in range(count // n_threads):
+            channel.remote_endpoint_operation(endpoint_id, None, True, 4)
+    threads = [threading.Thread(target=worker) for _ in range(n_threads)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return (count // n_threads) * n_threads / (time.monotonic() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--count", type=int, default=20000, help="number of requests per run")
+    parser.add_argument("--threads", type=int, nargs='+', default=[1, 4, 16], help="thread counts to test")
+    args = parser.parse_args()
+
+    print("completion via fibre.utils.Event: {:6.2f} us".format(event_completion(args.count) * 1e6))
+    print("completion via PendingOperation:  {:6.2f} us".format(operation_completion(args.count) * 1e6))
+
+    device = FakeDevice()
+    channel = open_channel(device, latency=0)
+    endpoint_id = device.endpoint_id('vbus_voltage')
+    for n_threads in args.threads:
+        rate = concurrent_requests(channel, endpoint_id, n_threads, args.count)
+        print("{:2} threads: {:8.0f} requests/s".format(n_threads, rate))
+    channel._channel_broken.set()
+    channel.fake_link.close()
+
+if __name__ == '__main__':
+    main()
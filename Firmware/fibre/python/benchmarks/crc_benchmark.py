@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Compares the table driven CRC implementation in fibre.crc with the
+bit-by-bit implementation that fibre.protocol used previously.
+
+Usage:
+    python benchmarks/crc_benchmark.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import fibre.crc
+from fibre.crc import CRC8_DEFAULT, CRC16_DEFAULT
+from fibre.protocol import CRC8_INIT, CRC16_INIT
+
+## Previous implementation, kept here as a baseline ##
+
+def legacy_calc_crc(remainder, value, polynomial, bitwidth):
+    topbit = (1 << (bitwidth - 1))
+    remainder ^= (value << (bitwidth - 8))
+    for bitnumber in range(0,8):
+        if (remainder & topbit):
+            remainder = (remainder << 1) ^ polynomial
+        else:
+            remainder = (remainder << 1)
+    return remainder & ((1 << bitwidth) - 1)
+
+def legacy_calc_crc8(remainder, value):
+    for byte in value:
+        if not isinstance(byte,int):
+            byte = ord(byte)
+        remainder = legacy_calc_crc(remainder, byte, CRC8_DEFAULT, 8)
+    return remainder
+
+def legacy_calc_crc16(remainder, value):
+    for byte in value:
+        if not isinstance(byte, int):
+            byte = ord(byte)
+        remainder = legacy_calc_crc(remainder, byte, CRC16_DEFAULT, 16)
+    return remainder
+
+
+def run(name, func, iterations):
+    seconds = min(timeit.repeat(func, number=iterations, repeat=5))
+    print("  {:<8} {:10.2f} us/call".format(name, seconds / iterations * 1e6))
+    return seconds
+
+def main():
+    header = bytes([0xAA, 0x0C])
+    payloads = {
+        'header': header,
+        '8 bytes': bytes(range(8)),
+        '127 bytes': bytes(range(127)),
+        '512 bytes': bytes(i & 0xff for i in range(512)),
+    }
+
+    # Sanity check: both implementations must agree
+    for payload in payloads.values():
+        for buf in (payload, bytearray(payload), memoryview(payload)):
+            assert fibre.crc.calc_crc8(CRC8_INIT, buf) == legacy_calc_crc8(CRC8_INIT, payload)
+            assert fibre.crc.calc_crc16(CRC16_INIT, buf) == legacy_calc_crc16(CRC16_INIT, payload)
+
+    for name, payload in payloads.items():
+        iterations = max(100, 200000 // (len(payload) + 1))
+        print("CRC8 over {}".format(name))
+        t_old = run("legacy", lambda: legacy_calc_crc8(CRC8_INIT, payload), iterations)
+        t_new = run("table", lambda: fibre.crc.calc_crc8(CRC8_INIT, payload), iterations)
+        print("  speedup: {:.1f}x".format(t_old / t_new))
+        print("CRC16 over {}".format(name))
+        t_old = run("legacy", lambda: legacy_calc_crc16(CRC16_INIT, payload), iterations)
+        t_new = run("table", lambda: fibre.crc.calc_crc16(CRC16_INIT, payload), iterations)
+        print("  speedup: {:.1f}x".format(t_old / t_new))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Measures how long fibre.discovery.find_all() takes until all devices of a
+rack of fake devices are discovered, with and without concurrent device
+initialization. The interface cache is disabled to simulate a cold start.
+
+Usage:
+    python benchmarks/discovery_benchmark.py [--devices N] [--latency SECONDS]
+"""
+
+import argparse
+import threading
+import time
+
+from fake_device import FakeDevice, open_channel
+import fibre.discovery
+from fibre.utils import Event, Logger
+
+def run(n_devices, latency, max_concurrent_inits):
+    fibre.discovery.max_concurrent_inits = max_concurrent_inits
+    devices = []
+    for i in range(n_devices):
+        device = FakeDevice()
+        device.set('serial_number', 0x385F324D3037 + i)
+        devices.append(device)
+
+    channels = []
+    def discover_channels(path, serial_number, callback, cancellation_token, channel_termination_token, logger):
+        for device in devices:
+            channel = open_channel(device, latency=latency)
+            channels.append(channel)
+            callback(channel)
+        cancellation_token.wait()
+    fibre.discovery.channel_types['fake'] = discover_channels
+
+    objects = []
+    all_found = threading.Event()
+    def did_discover_object(obj):
+        objects.append(obj)
+        if len(objects) == n_devices:
+            all_found.set()
+
+    cancellation_token = Event()
+    start = time.monotonic()
+    fibre.discovery.find_all('fake', None, did_discover_object, cancellation_token, Event(), Logger(verbose=False))
+    all_found.wait()
+    duration = time.monotonic() - start
+    cancellation_token.set()
+    assert len(set(obj.serial_number for obj in objects)) == n_devices
+    for channel in channels:
+        channel._channel_broken.set()
+        channel.fake_link.close()
+    return duration
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--devices", type=int, default=8, help="number of devices")
+    parser.add_argument("--latency", type=float, default=0.001, help="one-way latency of the links in seconds")
+    args = parser.parse_args()
+
+    fibre.discovery.interface_cache = None
+    sequential = run(args.devices, args.latency, 1)
+    print("one at a time:  {:6.3f} s".format(sequential))
+    concurrent = run(args.devices, args.latency, args.devices)
+    print("concurrently:   {:6.3f} s ({:.1f}x)".format(concurrent, sequential / concurrent))
+    single = run(1, args.latency, 1)
+    print("single device:  {:6.3f} s".format(single))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,457 @@
+"""
+In-process stand-in for a Fibre device, used by the benchmarks.
+
+The device publishes an ODrive-like interface definition, keeps all property
+values in memory and processes requests in order on its own thread, just
+like the firmware does. The transports in this module connect a Channel to
+the device with a configurable one-way latency and bandwidth.
+"""
+
+import os
+import sys
+import json
+import time
+import struct
+import random
+import threading
+import collections
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import fibre.protocol
+import fibre.remote_object
+from fibre.protocol import PROTOCOL_VERSION, DEFAULT_MTU, calc_crc16
+from fibre.utils import Event, Logger
+
+STRUCT_FORMATS = {
+    'int8': '<b', 'uint8': '<B', 'int16': '<h', 'uint16': '<H',
+    'int32': '<i', 'uint32': '<I', 'int64': '<q', 'uint64': '<Q',
+    'bool': '<?', 'float': '<f',
+}
+
+def _config(prefix, count):
+    return [(prefix + str(i), 'float', 'rw') for i in range(count)]
+
+def _axis():
+    return [
+        ('error', 'uint16', 'rw'),
+        ('current_state', 'int32', 'r'),
+        ('requested_state', 'int32', 'rw'),
+        ('loop_counter', 'uint32', 'r'),
+        ('config', [
+            ('startup_motor_calibration', 'bool', 'rw'),
+            ('startup_encoder_index_search', 'bool', 'rw'),
+            ('startup_closed_loop_control', 'bool', 'rw'),
+            ('counts_per_step', 'float', 'rw'),
+        ] + _config('reserved', 8)),
+        ('motor', [
+            ('error', 'uint16', 'rw'),
+            ('is_calibrated', 'bool', 'r'),
+            ('current_meas_phB', 'float', 'r'),
+            ('current_meas_phC', 'float', 'r'),
+            ('current_control', [
+                ('Iq_setpoint', 'float', 'r'),
+                ('Iq_measured', 'float', 'r'),
+                ('Id_measured', 'float', 'r'),
+                ('v_current_control_integral_d', 'float', 'r'),
+                ('v_current_control_integral_q', 'float', 'r'),
+            ]),
+            ('config', [
+                ('pole_pairs', 'int32', 'rw'),
+                ('calibration_current', 'float', 'rw'),
+                ('resistance_calib_max_voltage', 'float', 'rw'),
+                ('phase_inductance', 'float', 'rw'),
+                ('phase_resistance', 'float', 'rw'),
+                ('current_lim', 'float', 'rw'),
+                ('requested_current_range', 'float', 'rw'),
+            ] + _config('reserved', 8)),
+        ]),
+        ('encoder', [
+            ('error', 'uint16', 'rw'),
+            ('is_ready', 'bool', 'r'),
+            ('shadow_count', 'int32', 'r'),
+            ('count_in_cpr', 'int32', 'r'),
+            ('pos_estimate', 'float', 'r'),
+            ('pos_cpr', 'float', 'r'),
+            ('vel_estimate', 'float', 'r'),
+            ('config', [
+                ('mode', 'int32', 'rw'),
+                ('use_index', 'bool', 'rw'),
+                ('cpr', 'int32', 'rw'),
+                ('offset', 'int32', 'rw'),
+                ('bandwidth', 'float', 'rw'),
+            ] + _config('reserved', 8)),
+            ('set_linear_count', ('count', 'int32'), None),
+        ]),
+        ('controller', [
+            ('error', 'uint16', 'rw'),
+            ('pos_setpoint', 'float', 'rw'),
+            ('vel_setpoint', 'float', 'rw'),
+            ('vel_integrator_current', 'float', 'rw'),
+            ('current_setpoint', 'float', 'rw'),
+            ('config', [
+                ('control_mode', 'int32', 'rw'),
+                ('pos_gain', 'float', 'rw'),
+                ('vel_gain', 'float', 'rw'),
+                ('vel_integrator_gain', 'float', 'rw'),
+                ('vel_limit', 'float', 'rw'),
+            ] + _config('reserved', 8)),
+            ('move_to_pos', ('pos_setpoint', 'int32'), None),
+            ('move_incremental', [('displacement', 'int32'), ('from_goal_point', 'bool')], None),
+        ]),
+        ('trap_traj', [
+            ('config', [
+                ('vel_limit', 'float', 'rw'),
+                ('accel_limit', 'float', 'rw'),
+                ('decel_limit', 'float', 'rw'),
+                ('A_per_css', 'float', 'rw'),
+            ]),
+        ]),
+    ]
+
+def odrive_like_interface():
+    """
+    Returns a compact description of an interface that resembles the one
+    of an ODrive. Each member is a tuple (name, type, access) for properties,
+    (name, members) for objects and (name, inputs, output) for functions.
+    """
+    return [
+        ('vbus_voltage', 'float', 'r'),
+        ('serial_number', 'uint64', 'r'),
+        ('hw_version_major', 'uint8', 'r'),
+        ('hw_version_minor', 'uint8', 'r'),
+        ('hw_version_variant', 'uint8', 'r'),
+        ('fw_version_major', 'uint8', 'r'),
+        ('fw_version_minor', 'uint8', 'r'),
+        ('fw_version_revision', 'uint8', 'r'),
+        ('fw_version_unreleased', 'uint8', 'r'),
+        ('user_config_loaded', 'bool', 'r'),
+        ('brake_resistor_armed', 'bool', 'r'),
+        ('config', [
+            ('brake_resistance', 'float', 'rw'),
+            ('enable_uart', 'bool', 'rw'),
+            ('enable_i2c_instead_of_can', 'bool', 'rw'),
+            ('enable_ascii_protocol_on_usb', 'bool', 'rw'),
+            ('dc_bus_undervoltage_trip_level', 'float', 'rw'),
+            ('dc_bus_overvoltage_trip_level', 'float', 'rw'),
+        ] + _config('gpio_analog_map', 8)),
+        ('axis0', _axis()),
+        ('axis1', _axis()),
+        ('save_configuration', [], None),
+        ('erase_configuration', [], None),
+        ('reboot', [], None),
+        ('get_oscilloscope_val', [('index', 'uint32')], 'float'),
+        ('get_adc_voltage', [('gpio', 'uint32')], 'float'),
+        ('test_function', [('delta', 'int32')], 'int32'),
+    ]
+
+
+class FakeDevice(object):
+    """
+    Serves the interface returned by odrive_like_interface() (or a custom one).
+
+    Params:
+    extended: If True, the device accepts packets of up to max_mtu bytes and
+              starts sending large responses once the client sent it a large
+              packet. If False, it behaves like firmware that predates
+              the extended framing.
+    """
+    def __init__(self, interface=None, extended=True, max_mtu=512, blob_size=16384):
+        self.extended = extended
+        self.max_mtu = max_mtu if extended else DEFAULT_MTU
+        self.tx_size = DEFAULT_MTU
+        self.request_count = 0
+        self._values = {}
+        self._paths = {}
+        self._formats = {}
+        self._functions = {}
+        self._next_id = 1
+        members = self._build(interface or odrive_like_interface(), ())
+        # A large read-only buffer that is read in chunks like endpoint 0
+        self.blob_id = self._next_id
+        self.blob = bytes(bytearray(i & 0xff for i in range(blob_size)))
+        members.append({"name": "blob", "id": self.blob_id, "type": "buffer", "access": "r"})
+        self._next_id += 1
+        members.insert(0, {"name": "", "id": 0, "type": "json", "access": "r"})
+        self.json = json.dumps(members, separators=(',', ':')).encode('ascii')
+        self.json_crc = calc_crc16(PROTOCOL_VERSION, self.json)
+        for path, value in [('serial_number', 0x385F324D3037), ('hw_version_major', 3),
+                            ('hw_version_minor', 5), ('hw_version_variant', 24)]:
+            if path in self._paths:
+                self.set(path, value)
+
+    def _add_property(self, path, type_str, access):
+        endpoint_id = self._next_id
+        self._next_id += 1
+        self._formats[endpoint_id] = struct.Struct(STRUCT_FORMATS[type_str])
+        self._values[endpoint_id] = 0
+        self._paths['.'.join(path)] = endpoint_id
+        return {"name": path[-1], "id": endpoint_id, "type": type_str, "access": access}
+
+    def _build(self, interface, path):
+        members = []
+        for member in interface:
+            name = member[0]
+            if len(member) == 2:
+                members.append({"name": name, "type": "object",
+                                "members": self._build(member[1], path + (name,))})
+            elif isinstance(member[1], str):
+                members.append(self._add_property(path + (name,), member[1], member[2]))
+            else:
+                inputs, output_type = member[1], member[2]
+                if isinstance(inputs, tuple):
+                    inputs = [inputs]
+                trigger_id = self._next_id
+                self._next_id += 1
+                function = {"name": name, "id": trigger_id, "type": "function",
+                            "inputs": [self._add_property(path + (name, arg), arg_type, 'rw')
+                                       for arg, arg_type in inputs],
+                            "outputs": []}
+                if output_type is not None:
+                    function["outputs"].append(self._add_property(path + (name, 'result'), output_type, 'r'))
+                self._functions[trigger_id] = function
+                members.append(function)
+        return members
+
+    def endpoint_id(self, path):
+        return self._paths[path]
+
+    def set(self, path, value):
+        self._values[self._paths[path]] = value
+
+    def get(self, path):
+        return self._values[self._paths[path]]
+
+    def _call(self, function):
+        args = [self._values[arg["id"]] for arg in function["inputs"]]
+        if function["outputs"]:
+            # All functions of the fake device just add up their arguments
+            self._values[function["outputs"][0]["id"]] = sum(args)
+
+    def handle_request(self, packet):
+        """
+        Processes one request and returns the response packet or None.
+        Mirrors BidirectionalPacketBasedChannel::process_packet().
+        """
+        packet = bytes(packet)
+        if len(packet) > self.max_mtu:
+            return None
+        if len(packet) > DEFAULT_MTU:
+            # The client obviously supports large packets
+            self.tx_size = self.max_mtu
+        if len(packet) < 8:
+            return None
+        seq_no, endpoint_id, output_length = struct.unpack_from('<HHH', packet, 0)
+        if seq_no & 0x8000:
+            return None
+        expect_ack = endpoint_id & 0x8000
+        endpoint_id &= 0x7fff
+        trailer = struct.unpack_from('<H', packet, len(packet) - 2)[0]
+        if trailer != (self.json_crc if endpoint_id else PROTOCOL_VERSION):
+            return None
+        self.request_count += 1
+        payload = packet[6:-2]
+        output_length = min(output_length, self.tx_size - 2)
+
+        if endpoint_id == 0 or endpoint_id == self.blob_id:
+            data = self.json if endpoint_id == 0 else self.blob
+            offset = struct.unpack_from('<I', payload, 0)[0]
+            output = data[offset:offset + output_length]
+        elif endpoint_id in self._functions:
+            self._call(self._functions[endpoint_id])
+            output = b''
+        elif endpoint_id in self._formats:
+            fmt = self._formats[endpoint_id]
+            output = fmt.pack(self._values[endpoint_id])[:output_length]
+            if len(payload) >= fmt.size:
+                self._values[endpoint_id] = fmt.unpack_from(payload, 0)[0]
+        else:
+            return None
+
+        if expect_ack:
+            return struct.pack('<H', seq_no | 0x8000) + output
+        return None
+
+
+class FakeLink(object):
+    """
+    Runs a FakeDevice on a dedicated thread and delivers requests and
+    responses with the specified one-way latency [s] and bandwidth [bytes/s].
+    A fraction of the requests (specified by loss) is dropped.
+    """
+    def __init__(self, device, latency=0.0005, bandwidth=None, loss=0.0):
+        self.device = device
+        self._latency = latency
+        self._bandwidth = bandwidth
+        self._loss = loss
+        self._random = random.Random(0)
+        self._requests = collections.deque()
+        self._request_cond = threading.Condition()
+        self._responses = collections.deque()
+        self._response_cond = threading.Condition()
+        self._closed = False
+        t = threading.Thread(target=self._device_thread)
+        t.daemon = True
+        t.start()
+
+    def _delivery_time(self, data):
+        t = time.monotonic() + self._latency
+        if self._bandwidth:
+            t += len(data) / float(self._bandwidth)
+        return t
+
+    def send(self, data):
+        if self._loss and self._random.random() < self._loss:
+            return
+        with self._request_cond:
+            self._requests.append((self._delivery_time(data), bytes(data)))
+            self._request_cond.notify()
+
+    def receive(self, deadline):
+        """
+        Returns the next response that is due or None if the deadline
+        is reached first.
+        """
+        with self._response_cond:
+            while True:
+                now = time.monotonic()
+                if self._responses and self._responses[0][0] <= now:
+                    return self._responses.popleft()[1]
+                wait_until = deadline
+                if self._responses:
+                    due = self._responses[0][0]
+                    wait_until = due if deadline is None else min(deadline, due)
+                if wait_until is None:
+                    self._response_cond.wait()
+                elif wait_until <= now:
+                    return None # deadline reached
+                else:
+                    self._response_cond.wait(wait_until - now)
+
+    def _device_thread(self):
+        while not self._closed:
+            with self._request_cond:
+                while not self._requests and not self._closed:
+                    self._request_cond.wait(0.1)
+                if self._closed:
+                    return
+                due, data = self._requests.popleft()
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            for response in self.process(data):
+                with self._response_cond:
+                    self._responses.append((self._delivery_time(response), response))
+                    self._response_cond.notify_all()
+
+    def process(self, data):
+        response = self.device.handle_request(data)
+        return [] if response is None else [response]
+
+    def close(self):
+        self._closed = True
+
+
+class FakeStreamLink(FakeLink):
+    """
+    Like FakeLink but carries the stream based protocol (e.g. UART).
+    """
+    def __init__(self, device, latency=0.0005, bandwidth=None, loss=0.0):
+        self._requests_out = []
+        self._segmenter = fibre.protocol.StreamToPacketSegmenter(self, mtu=device.max_mtu)
+        self._framer = fibre.protocol.StreamBasedPacketSink(self)
+        self._framer.set_mtu(device.max_mtu)
+        FakeLink.__init__(self, device, latency, bandwidth, loss)
+
+    def process_packet(self, packet):
+        response = self.device.handle_request(packet)
+        if response is not None:
+            self._framer.process_packet(response)
+
+    def process_bytes(self, data):
+        self._requests_out.append(bytes(data))
+
+    def process(self, data):
+        self._requests_out = []
+        self._segmenter.process_bytes(data)
+        return self._requests_out
+
+
+class FakePacketTransport(fibre.protocol.PacketSource, fibre.protocol.PacketSink):
+    """
+    Packet based transport (like USB) that connects to a FakeLink.
+    """
+    max_mtu = 512
+
+    def __init__(self, link):
+        self._link = link
+
+    def process_packet(self, packet):
+        self._link.send(packet)
+
+    def get_packet(self, deadline):
+        packet = self._link.receive(deadline)
+        if packet is None:
+            raise fibre.protocol.TimeoutError()
+        return packet
+
+
+class FakeStreamTransport(fibre.protocol.StreamSource, fibre.protocol.StreamSink):
+    """
+    Stream based transport (like UART or TCP) that connects to a FakeStreamLink.
+    """
+    def __init__(self, link):
+        self._link = link
+        self._rx_buffer = bytearray()
+
+    def process_bytes(self, data):
+        self._link.send(data)
+
+    def get_available_bytes(self, max_bytes, deadline):
+        if not self._rx_buffer:
+            data = self._link.receive(deadline)
+            if data is None:
+                return bytes()
+            self._rx_buffer += data
+        result = bytes(self._rx_buffer[:max_bytes])
+        del self._rx_buffer[:max_bytes]
+        return result
+
+    def get_bytes(self, n_bytes, deadline):
+        result = bytes()
+        while len(result) < n_bytes:
+            data = self.get_available_bytes(n_bytes - len(result), deadline)
+            if not data:
+                break
+            result += data
+        return result
+
+
+def open_channel(device, stream=False, latency=0.0005, bandwidth=None, loss=0.0):
+    """
+    Connects a new Channel to the device and returns it.
+    """
+    logger = Logger(verbose=False)
+    if stream:
+        link = FakeStreamLink(device, latency, bandwidth, loss)
+        transport = FakeStreamTransport(link)
+        input = fibre.protocol.PacketFromStreamConverter(transport)
+        output = fibre.protocol.StreamBasedPacketSink(transport)
+    else:
+        link = FakeLink(device, latency, bandwidth, loss)
+        transport = FakePacketTransport(link)
+        input = output = transport
+    channel = fibre.protocol.Channel("fake device", input, output, Event(), logger)
+    channel._interface_definition_crc = device.json_crc
+    channel.fake_link = link
+    return channel
+
+def open_object(device, **kwargs):
+    """
+    Connects a new Channel to the device and returns the root RemoteObject
+    built from the device's JSON, like fibre.discovery does.
+    """
+    channel = open_channel(device, **kwargs)
+    channel.negotiate_mtu()
+    json_data = {"name": "fibre_node", "members": json.loads(device.json.decode("ascii"))}
+    return fibre.remote_object.RemoteObject(json_data, None, channel, Logger(verbose=False))
@@ -0,0 +1,218 @@
+"""
+Stand-in for a pyusb device with a libusb like asynchronous API, used to
+run fibre.usbbulk_transport against a FakeDevice without hardware.
+
+Responses of the device are split into USB packets of wMaxPacketSize bytes
+(followed by a zero length packet if they fill the last one, once the
+device sends large packets). An IN transfer takes packets until it is full
+or gets a short packet, like on a real bus.
+
+The host controller only polls the device for a transfer that is queued.
+A newly submitted transfer is picked up schedule_delay seconds later (one
+high speed microframe by default), so a host that only ever has a single
+transfer outstanding pays that delay for every packet. Likewise, every OUT
+transfer costs write_overhead seconds for the system call and the
+transaction on the bus.
+
+With stream=True, the device expects the stream framing on its bulk
+endpoints, like firmware built with CONFIG_USB_PROTOCOL=native-stream.
+"""
+
+import time
+import threading
+import collections
+
+from fake_device import FakeLink, FakeStreamLink
+import usb.core
+import fibre.usbbulk_transport
+from fibre.usbbulk_transport import TRANSFER_COMPLETED, TRANSFER_CANCELLED
+
+class _FakeContext(object):
+    """
+    The part of pyusb's resource manager that usb.util uses.
+    """
+    def managed_claim_interface(self, device, interface):
+        pass
+
+    def managed_release_interface(self, device, interface):
+        pass
+
+class FakeEndpoint(object):
+    def __init__(self, device, address, max_packet_size):
+        self._device = device
+        self.bEndpointAddress = address
+        self.wMaxPacketSize = max_packet_size
+
+    def write(self, data, timeout):
+        if self._device.write_overhead:
+            time.sleep(self._device.write_overhead)
+        self._device.out_transfers += 1
+        self._device.link.send(data)
+        return len(data)
+
+    def read(self, length, timeout):
+        deadline = None if timeout == 0 else time.monotonic() + timeout / 1000.0
+        data = self._device.read_transfer(length, time.monotonic() + self._device.schedule_delay, deadline)
+        if data is None:
+            raise usb.core.USBError("Operation timed out", None, 110)
+        return data
+
+class FakeInterface(object):
+    bInterfaceClass = 0x00
+    bInterfaceSubClass = 0x01
+    bInterfaceNumber = 0
+    bAlternateSetting = 0
+
+    def __init__(self, endpoints):
+        self._endpoints = endpoints
+
+    def __iter__(self):
+        return iter(self._endpoints)
+
+class FakeConfiguration(object):
+    bConfigurationValue = 1
+
+    def __init__(self, interfaces):
+        self._interfaces = interfaces
+
+    def __iter__(self):
+        return iter(self._interfaces)
+
+    def interfaces(self):
+        return self._interfaces
+
+class FakeUSBDevice(object):
+    """
+    Provides the parts of usb.core.Device that USBBulkTransport uses and
+    connects them to a FakeDevice through a FakeLink.
+    """
+    idVendor = 0x1209
+    idProduct = 0x0D32
+    bus = 1
+    address = 1
+
+    def __init__(self, device, latency=0.0002, max_packet_size=64, schedule_delay=0.000125,
+                 write_overhead=0.0, stream=False):
+        self.link = (FakeStreamLink if stream else FakeLink)(device, latency)
+        self.schedule_delay = schedule_delay
+        self.write_overhead = write_overhead
+        self.out_transfers = 0
+        self.max_packet_size = max_packet_size
+        self._device = device
+        self._packets = collections.deque()
+        self._ctx = _FakeContext()
+        endpoints = [FakeEndpoint(self, 0x01, max_packet_size), FakeEndpoint(self, 0x81, max_packet_size)]
+        self._config = FakeConfiguration([FakeInterface(endpoints)])
+        self.serial_number = "{:012X}".format(device.get('serial_number'))
+        # Like the firmware, the device responds with a single USB packet
+        # until the host sends it a large packet
+        device.tx_size = min(device.tx_size, max_packet_size)
+
+    def __iter__(self):
+        return iter([self._config])
+
+    def reset(self):
+        pass
+
+    def get_active_configuration(self):
+        return self._config
+
+    def is_kernel_driver_active(self, interface):
+        return False
+
+    def next_packet(self, not_before, deadline):
+        """
+        Returns the next USB packet the device sends to a transfer that is
+        polled from not_before on, or None if there is none by the deadline.
+        """
+        if not self._packets:
+            response = self.link.receive(deadline)
+            if response is None:
+                return None
+            size = self.max_packet_size
+            self._packets.extend(response[i:i + size] for i in range(0, len(response), size))
+            if len(response) % size == 0 and self._device.tx_size > size:
+                self._packets.append(b'') # zero length packet
+        delay = not_before - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        return self._packets.popleft()
+
+    def read_transfer(self, length, not_before, deadline):
+        """
+        Fills a synchronous IN transfer of up to length bytes.
+        """
+        packet = self.next_packet(not_before, deadline)
+        if packet is None:
+            return None
+        data = bytearray(packet)
+        while len(packet) == self.max_packet_size and len(data) < length:
+            packet = self.next_packet(0, None)
+            data += packet
+        return data
+
+class FakeTransfer(object):
+    def __init__(self, length, callback):
+        self.length = length
+        self.callback = callback
+        self.data = bytearray()
+        self.not_before = None
+        self.cancelled = False
+
+class FakeAsyncIO(object):
+    """
+    Mock of fibre.usbbulk_transport.LibusbAsyncIO for a FakeUSBDevice.
+    Transfers complete in the order they were submitted.
+    """
+    def __init__(self, device):
+        self._device = device
+        self._queue = collections.deque()
+        self._submitted = threading.Condition()
+
+    def alloc_transfer(self, endpoint, length, callback):
+        return FakeTransfer(length, callback)
+
+    def submit(self, transfer):
+        transfer.data = bytearray()
+        transfer.cancelled = False
+        transfer.not_before = time.monotonic() + self._device.schedule_delay
+        with self._submitted:
+            self._queue.append(transfer)
+            self._submitted.notify()
+
+    def cancel(self, transfer):
+        transfer.cancelled = True
+
+    def free(self, transfer):
+        pass
+
+    def handle_events(self, timeout):
+        deadline = time.monotonic() + timeout
+        with self._submitted:
+            if not self._queue:
+                self._submitted.wait(timeout)
+                return
+        transfer = self._queue[0]
+        if transfer.cancelled:
+            self._queue.popleft()
+            transfer.callback(transfer, TRANSFER_CANCELLED, bytes(transfer.data))
+            return
+        packet = self._device.next_packet(transfer.not_before, deadline)
+        if packet is None:
+            return
+        transfer.data += packet
+        if len(packet) < self._device.max_packet_size or len(transfer.data) >= transfer.length:
+            self._queue.popleft()
+            transfer.callback(transfer, TRANSFER_COMPLETED, bytes(transfer.data))
+
+def open_transport(device, in_transfers, logger, coalesce_delay=None, **kwargs):
+    """
+    Returns an initialized USBBulkTransport for a FakeUSBDevice that
+    serves device. With in_transfers > 0, it uses a FakeAsyncIO. With a
+    coalesce_delay, the device uses the stream framing.
+    """
+    usb_device = FakeUSBDevice(device, stream=coalesce_delay is not None, **kwargs)
+    async_io = FakeAsyncIO(usb_device) if in_transfers else None
+    transport = fibre.usbbulk_transport.USBBulkTransport(usb_device, logger, in_transfers, async_io, coalesce_delay)
+    transport.init()
+    return transport
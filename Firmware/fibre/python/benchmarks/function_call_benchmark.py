@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+Compares calling a remote function with one round trip per step (argument
+writes, trigger, output read) with the pipelined RemoteFunction.__call__(),
+optionally over a lossy link.
+
+Usage:
+    python benchmarks/function_call_benchmark.py [--latency SECONDS] [--count N] [--loss RATE]
+"""
+
+import argparse
+import time
+
+from fake_device import FakeDevice, open_object
+
+def call_sequential(func, *args):
+    for prop, arg in zip(func._inputs, args):
+        prop.set_value(arg)
+    func._parent.__channel__.remote_endpoint_operation(func._trigger_id, None, True, 0)
+    return func._outputs[0].get_value()
+
+def run(func, count):
+    start = time.monotonic()
+    for i in range(count):
+        # The fake device returns the sum of the arguments
+        assert func(i) == i
+    return count / (time.monotonic() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.0005, help="one-way latency of the link in seconds")
+    parser.add_argument("--count", type=int, default=1000, help="number of calls")
+    parser.add_argument("--loss", type=float, default=0.0, help="probability that a packet is dropped")
+    args = parser.parse_args()
+
+    device = FakeDevice()
+    odrv = open_object(device, latency=args.latency, loss=args.loss)
+    func = odrv.test_function
+
+    sequential = run(lambda arg: call_sequential(func, arg), args.count)
+    print("sequential: {:8.0f} calls/s".format(sequential))
+    pipelined = run(func, args.count)
+    print("pipelined:  {:8.0f} calls/s ({:.1f}x)".format(pipelined, pipelined / sequential))
+
+    odrv.__channel__._channel_broken.set()
+    odrv.__channel__.fake_link.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Runs USB discovery against a fake bus, once with polling and once with a
+fake hotplug monitor, and reports how often the bus was enumerated, how
+many serial numbers were read (each is a control transfer on a real bus)
+and how long it took until a newly plugged in device was looked at.
+Requires pyusb to be installed, but no USB devices.
+
+Usage:
+    python benchmarks/hotplug_benchmark.py [--devices N] [--duration SECONDS]
+"""
+
+import argparse
+import random
+import threading
+import time
+
+from fake_device import FakeDevice # sets up the import path
+import fibre.hotplug
+import fibre.usbbulk_transport
+from fibre.utils import Event, Logger
+
+ODRIVE_VID_PID = fibre.usbbulk_transport.WELL_KNOWN_VID_PID_PAIRS[0]
+
+class FakeUsbDevice(object):
+    def __init__(self, bus, address, vid_pid, serial_number, stats):
+        self.bus = bus
+        self.address = address
+        self.idVendor, self.idProduct = vid_pid
+        self._serial_number = serial_number
+        self._stats = stats
+        self.plugged_at = time.monotonic()
+
+    @property
+    def serial_number(self):
+        time.sleep(0.001) # a control transfer takes about a millisecond
+        self._stats['serial_reads'] += 1
+        self._stats['latencies'].append(time.monotonic() - self.plugged_at)
+        return self._serial_number
+
+class FakeMonitor(object):
+    """
+    Hotplug monitor that is triggered by plug().
+    """
+    hotplug = True
+
+    def __init__(self, cancellation_token):
+        self._cancellation_token = cancellation_token
+        self._event = threading.Event()
+        cancellation_token.subscribe(self._event.set)
+
+    def plug(self):
+        self._event.set()
+
+    def wait(self, timeout):
+        result = self._event.wait(timeout) and not self._cancellation_token.is_set()
+        self._event.clear()
+        return result
+
+    def close(self):
+        pass
+
+def run(n_devices, duration, hotplug):
+    stats = {'scans': 0, 'serial_reads': 0, 'latencies': []}
+    # Many unrelated devices and one ODrive whose serial number doesn't
+    # match, so nothing is actually opened
+    devices = [FakeUsbDevice(1, i + 1, (0x1234, 0x5678), None, stats) for i in range(n_devices)]
+    devices.append(FakeUsbDevice(1, n_devices + 1, ODRIVE_VID_PID, "other", stats))
+    def enumerate_devices():
+        stats['scans'] += 1
+        return list(devices)
+
+    cancellation_token = Event()
+    if hotplug:
+        monitor = FakeMonitor(cancellation_token)
+    else:
+        monitor = fibre.hotplug.PollingMonitor(cancellation_token)
+    thread = threading.Thread(target=fibre.usbbulk_transport.discover_channels,
+        args=(None, "123456", None, cancellation_token, Event(), Logger(verbose=False)),
+        kwargs={'enumerate_devices': enumerate_devices, 'monitor': monitor})
+    thread.start()
+
+    # Plug in a few devices at random times over the course of the run
+    rng = random.Random(0)
+    interval = duration / 4
+    for i in range(3):
+        time.sleep(rng.uniform(0.5, 1.0) * interval)
+        devices.append(FakeUsbDevice(2, i + 1, ODRIVE_VID_PID, "other", stats))
+        if hotplug:
+            monitor.plug()
+    time.sleep(interval)
+    cancellation_token.set()
+    thread.join()
+
+    new_device_latencies = stats['latencies'][1:]
+    return stats['scans'], stats['serial_reads'], sum(new_device_latencies) / len(new_device_latencies)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--devices", type=int, default=20, help="number of unrelated devices on the bus")
+    parser.add_argument("--duration", type=float, default=4.0, help="duration of each run in seconds")
+    args = parser.parse_args()
+
+    for hotplug in (False, True):
+        scans, serial_reads, latency = run(args.devices, args.duration, hotplug)
+        print("{}: {:3} scans, {:3} serial number reads, new devices seen after {:6.1f} ms".format(
+            "hotplug" if hotplug else "polling", scans, serial_reads, latency * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Measures how long it takes to fetch the interface definition of a fake
+device with an empty and with a populated interface cache, and checks that
+a device with a different definition is not served from the cache.
+
+Usage:
+    python benchmarks/interface_cache_benchmark.py [--latency SECONDS]
+"""
+
+import argparse
+import shutil
+import tempfile
+import time
+
+from fake_device import FakeDevice, odrive_like_interface, open_channel
+from fibre.interface_cache import InterfaceCache
+from fibre.utils import Logger
+
+def fetch(cache, device, latency):
+    channel = open_channel(device, latency=latency)
+    channel.negotiate_mtu()
+    requests_before = device.request_count
+    start = time.monotonic()
+    json_bytes, json_crc = cache.fetch(channel, Logger(verbose=False))
+    duration = time.monotonic() - start
+    assert json_bytes == device.json and json_crc == device.json_crc
+    channel._channel_broken.set()
+    channel.fake_link.close()
+    return duration, device.request_count - requests_before
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.0005, help="one-way latency of the link in seconds")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        device = FakeDevice()
+        print("JSON: {} bytes".format(len(device.json)))
+        cold, cold_requests = fetch(InterfaceCache(directory), device, args.latency)
+        print("empty cache:     {:7.1f} ms, {:3} requests".format(cold * 1000, cold_requests))
+        warm, warm_requests = fetch(InterfaceCache(directory), device, args.latency)
+        print("populated cache: {:7.1f} ms, {:3} requests ({:.1f}x)".format(warm * 1000, warm_requests, cold / warm))
+
+        # Same beginning of the JSON but a different interface
+        other = FakeDevice(interface=odrive_like_interface() + [('extra', 'float', 'rw')])
+        changed, changed_requests = fetch(InterfaceCache(directory), other, args.latency)
+        print("changed device:  {:7.1f} ms, {:3} requests".format(changed * 1000, changed_requests))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Reports how much memory the object trees of connected devices take.
+The trees are built for the interface of a fake device from the same
+parsed JSON, like fibre.discovery does for devices with identical firmware.
+
+Usage:
+    python benchmarks/memory_benchmark.py [--devices N]
+"""
+
+import argparse
+import gc
+import json
+import tracemalloc
+
+from fake_device import FakeDevice, open_channel
+import fibre.remote_object
+from fibre.utils import Logger
+
+def materialize(obj):
+    for _, attribute in obj._remote_attributes.items():
+        if isinstance(attribute, fibre.remote_object.RemoteObject):
+            materialize(attribute)
+        elif isinstance(attribute, fibre.remote_object.RemoteFunction):
+            attribute._inputs, attribute._outputs
+
+def measure(json_data, channel, count, full):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    trees = []
+    for _ in range(count):
+        obj = fibre.remote_object.RemoteObject(json_data, None, channel, Logger(verbose=False))
+        if full:
+            materialize(obj)
+        trees.append(obj)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / count
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--devices", type=int, default=60, help="number of connected devices")
+    args = parser.parse_args()
+
+    device = FakeDevice()
+    channel = open_channel(device)
+    json_data = {"name": "fibre_node", "members": json.loads(device.json.decode("ascii"))}
+
+    print("untouched tree:      {:9.0f} bytes per device".format(measure(json_data, channel, args.devices, False)))
+    print("fully accessed tree: {:9.0f} bytes per device".format(measure(json_data, channel, args.devices, True)))
+
+    channel._channel_broken.set()
+    channel.fake_link.close()
+
+if __name__ == '__main__':
+    main()
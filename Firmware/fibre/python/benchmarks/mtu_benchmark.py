@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Measures how long it takes to download the JSON interface definition and
+to read a large buffer from a fake device, once with a device that only
+supports the original 127 byte packets and once with a device that supports
+the extended framing.
+
+Usage:
+    python benchmarks/mtu_benchmark.py [--latency SECONDS]
+"""
+
+import argparse
+import time
+
+from fake_device import FakeDevice, open_channel
+
+def measure(stream, extended, latency):
+    device = FakeDevice(extended=extended)
+    channel = open_channel(device, stream=stream, latency=latency)
+    mtu = channel.negotiate_mtu()
+
+    start = time.monotonic()
+    requests_before = device.request_count
+    json_bytes = channel.remote_endpoint_read_buffer(0)
+    json_time = time.monotonic() - start
+    json_requests = device.request_count - requests_before
+    assert json_bytes == device.json
+
+    start = time.monotonic()
+    blob = channel.remote_endpoint_read_buffer(device.blob_id)
+    blob_time = time.monotonic() - start
+    assert blob == device.blob
+
+    channel._channel_broken.set()
+    channel.fake_link.close()
+    return mtu, len(json_bytes), json_time, json_requests, len(blob), blob_time
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.0005, help="one-way latency of the link in seconds")
+    args = parser.parse_args()
+
+    for stream in (False, True):
+        print("{} transport:".format("stream based" if stream else "packet based"))
+        results = {}
+        for extended in (False, True):
+            mtu, json_len, json_time, json_requests, blob_len, blob_time = measure(stream, extended, args.latency)
+            results[extended] = (json_time, blob_time)
+            print("  {:<9} MTU {:4}: JSON ({} bytes) in {:7.1f} ms / {:3} requests, buffer ({} bytes) in {:7.1f} ms".format(
+                "extended" if extended else "legacy", mtu,
+                json_len, json_time * 1000, json_requests,
+                blob_len, blob_time * 1000))
+        print("  speedup: JSON {:.1f}x, buffer {:.1f}x".format(
+            results[False][0] / results[True][0], results[False][1] / results[True][1]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Measures how long it takes to build the RemoteObject tree for the interface
+of a fake device, both for a script that only touches a few properties and
+for one that touches everything.
+
+Usage:
+    python benchmarks/object_tree_benchmark.py [--repeat N]
+"""
+
+import argparse
+import json
+import time
+
+from fake_device import FakeDevice, open_channel
+import fibre.remote_object
+from fibre.utils import Logger
+
+def build(json_data, channel):
+    return fibre.remote_object.RemoteObject(json_data, None, channel, Logger(verbose=False))
+
+def materialize(obj):
+    count = 1
+    for _, attribute in obj._remote_attributes.items():
+        if isinstance(attribute, fibre.remote_object.RemoteObject):
+            count += materialize(attribute)
+        else:
+            count += 1
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=200, help="number of trees to build")
+    args = parser.parse_args()
+
+    device = FakeDevice()
+    channel = open_channel(device)
+    json_data = {"name": "fibre_node", "members": json.loads(device.json.decode("ascii"))}
+
+    start = time.monotonic()
+    for _ in range(args.repeat):
+        obj = build(json_data, channel)
+        obj._resolve('vbus_voltage')
+        obj._resolve('axis0.encoder.pos_estimate')
+        obj._resolve('axis1.controller.config.vel_limit')
+    few = (time.monotonic() - start) / args.repeat
+    print("root + 3 properties: {:8.3f} ms".format(few * 1000))
+
+    start = time.monotonic()
+    for _ in range(args.repeat):
+        count = materialize(build(json_data, channel))
+    full = (time.monotonic() - start) / args.repeat
+    print("full tree ({} members): {:8.3f} ms".format(count, full * 1000))
+
+    channel._channel_broken.set()
+    channel.fake_link.close()
+
+if __name__ == '__main__':
+    main()
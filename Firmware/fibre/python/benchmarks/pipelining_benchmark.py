@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Compares reading many properties one by one with reading them through
+pipelined operations (Channel.submit_endpoint_operation).
+
+Usage:
+    python benchmarks/pipelining_benchmark.py [--latency SECONDS] [--count N]
+"""
+
+import argparse
+import time
+
+from fake_device import FakeDevice, open_channel
+
+PATHS = [
+    'vbus_voltage',
+    'axis0.encoder.pos_estimate', 'axis0.encoder.vel_estimate',
+    'axis0.motor.current_control.Iq_measured', 'axis0.controller.pos_setpoint',
+    'axis1.encoder.pos_estimate', 'axis1.encoder.vel_estimate',
+    'axis1.motor.current_control.Iq_measured', 'axis1.controller.pos_setpoint',
+]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.0005, help="one-way latency of the link in seconds")
+    parser.add_argument("--count", type=int, default=2000, help="number of reads")
+    args = parser.parse_args()
+
+    device = FakeDevice()
+    channel = open_channel(device, latency=args.latency)
+    endpoint_ids = [device.endpoint_id(path) for path in PATHS]
+    ids = [endpoint_ids[i % len(endpoint_ids)] for i in range(args.count)]
+
+    start = time.monotonic()
+    for endpoint_id in ids:
+        channel.remote_endpoint_operation(endpoint_id, None, True, 4)
+    sequential = time.monotonic() - start
+    print("sequential: {:8.0f} reads/s".format(args.count / sequential))
+
+    for window in (4, 16, 64):
+        channel._max_in_flight = window
+        start = time.monotonic()
+        operations = [channel.submit_endpoint_operation(endpoint_id, None, True, 4) for endpoint_id in ids]
+        for operation in operations:
+            operation.result()
+        pipelined = time.monotonic() - start
+        print("pipelined (window {:2}): {:8.0f} reads/s ({:.1f}x)".format(
+            window, args.count / pipelined, sequential / pipelined))
+
+    channel._channel_broken.set()
+    channel.fake_link.close()
+
+if __name__ == '__main__':
+    main()
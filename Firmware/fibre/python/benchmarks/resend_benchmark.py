@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Reads properties one by one over a lossy fake link, once with a fixed
+resend timeout and once with the adaptive resend timeout, and compares the
+read latencies.
+
+Usage:
+    python benchmarks/resend_benchmark.py [--latency SECONDS] [--loss RATE] [--count N] [--fixed-timeout SECONDS]
+"""
+
+import argparse
+import time
+
+from fake_device import FakeDevice, open_channel
+
+def run(channel, endpoint_id, count):
+    latencies = []
+    for _ in range(count):
+        start = time.monotonic()
+        channel.remote_endpoint_operation(endpoint_id, None, True, 4)
+        latencies.append(time.monotonic() - start)
+    latencies.sort()
+    return sum(latencies) / len(latencies), latencies[int(len(latencies) * 0.99)], latencies[-1]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.0005, help="one-way latency of the link in seconds")
+    parser.add_argument("--loss", type=float, default=0.01, help="probability that a packet is dropped")
+    parser.add_argument("--count", type=int, default=1000, help="number of reads")
+    parser.add_argument("--fixed-timeout", type=float, default=1.0, help="resend timeout of the fixed run in seconds")
+    args = parser.parse_args()
+
+    device = FakeDevice()
+    for fixed in (True, False):
+        channel = open_channel(device, latency=args.latency, loss=args.loss)
+        if fixed:
+            channel._min_resend_timeout = channel._max_resend_timeout = args.fixed_timeout
+            channel._resend_timeout = args.fixed_timeout
+        endpoint_id = device.endpoint_id('vbus_voltage')
+        mean, p99, worst = run(channel, endpoint_id, args.count)
+        print("{}: mean {:7.2f} ms, 99th percentile {:7.2f} ms, max {:7.2f} ms, resend timeout {:.1f} ms".format(
+            "fixed   " if fixed else "adaptive", mean * 1000, p99 * 1000, worst * 1000, channel._resend_timeout * 1000))
+        channel._channel_broken.set()
+        channel.fake_link.close()
+
+if __name__ == '__main__':
+    main()
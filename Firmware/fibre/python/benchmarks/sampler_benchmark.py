@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Compares sampling properties of a fake device with a time.sleep() loop (as
+the liveplotter used to do) with fibre.sampler.Sampler.
+
+Usage:
+    python benchmarks/sampler_benchmark.py [--latency SECONDS] [--rate HZ] [--duration SECONDS]
+"""
+
+import argparse
+import time
+
+from fake_device import FakeDevice, open_object
+from fibre.sampler import Sampler
+
+PATHS = [
+    'vbus_voltage',
+    'axis0.encoder.pos_estimate', 'axis0.encoder.vel_estimate',
+    'axis1.encoder.pos_estimate', 'axis1.encoder.vel_estimate',
+]
+
+def sleep_loop(odrv, rate, duration):
+    props = [odrv._resolve(path) for path in PATHS]
+    samples = 0
+    start = time.monotonic()
+    while time.monotonic() - start < duration:
+        [prop.get_value() for prop in props]
+        samples += 1
+        time.sleep(1 / rate)
+    return samples / (time.monotonic() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.0005, help="one-way latency of the link in seconds")
+    parser.add_argument("--rate", type=float, default=200, help="target sample rate in Hz")
+    parser.add_argument("--duration", type=float, default=2.0, help="duration of each run in seconds")
+    args = parser.parse_args()
+
+    device = FakeDevice()
+    odrv = open_object(device, latency=args.latency)
+
+    print("target rate:       {:8.1f} samples/s".format(args.rate))
+    print("time.sleep() loop: {:8.1f} samples/s".format(sleep_loop(odrv, args.rate, args.duration)))
+
+    with Sampler(odrv, PATHS, rate=args.rate, capacity=int(args.rate * args.duration)) as sampler:
+        time.sleep(args.duration)
+    print("Sampler:           {:8.1f} samples/s, {} missed deadlines".format(
+        sampler.achieved_rate, sampler.missed_deadlines))
+
+    with Sampler(odrv, PATHS, rate=None, capacity=1000) as sampler:
+        time.sleep(args.duration)
+    print("Sampler (no rate): {:8.1f} samples/s".format(sampler.achieved_rate))
+
+    odrv.__channel__._channel_broken.set()
+    odrv.__channel__.fake_link.close()
+
+if __name__ == '__main__':
+    main()
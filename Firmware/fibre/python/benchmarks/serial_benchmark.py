@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Compares reads that set pyserial's timeout on every call (as the serial
+transport did before) with the two ways in which SerialStreamTransport
+drains the port into a ring buffer: select() on the caller's thread and a
+dedicated reader thread.
+
+A FakeDevice serves the stream based protocol on the master side of a
+pseudo terminal and the transport opens the slave side like a serial
+port. A pty has no baud rate, so this measures the overhead on the host.
+
+Usage:
+    python benchmarks/serial_benchmark.py [--count N] [--baud N]
+"""
+
+import argparse
+import os
+import threading
+import time
+
+from fake_device import FakeDevice
+import serial
+import fibre.protocol
+import fibre.serial_transport
+from fibre.utils import Event, Logger
+
+class PtyDevice(fibre.protocol.PacketSink, fibre.protocol.StreamSink):
+    """
+    Serves a FakeDevice on the master side of a new pty pair.
+    port_name is the name of the slave side.
+    """
+    def __init__(self, device):
+        self._device = device
+        self._master, self._slave = os.openpty()
+        self.port_name = os.ttyname(self._slave)
+        self._segmenter = fibre.protocol.StreamToPacketSegmenter(self, mtu=device.max_mtu)
+        self._framer = fibre.protocol.StreamBasedPacketSink(self)
+        self._framer.set_mtu(device.max_mtu)
+        self._closed = False
+        t = threading.Thread(target=self._run)
+        t.daemon = True
+        t.start()
+
+    def _run(self):
+        while not self._closed:
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                return
+            self._segmenter.process_bytes(data)
+
+    def process_packet(self, packet):
+        response = self._device.handle_request(packet)
+        if response is not None:
+            self._framer.process_packet(response)
+
+    def process_bytes(self, data):
+        os.write(self._master, data)
+
+    def close(self):
+        self._closed = True
+        os.close(self._slave)
+        os.close(self._master)
+
+class PerCallTimeoutTransport(fibre.protocol.StreamSource, fibre.protocol.StreamSink):
+    """
+    Reads from the port on the caller's thread and sets the timeout of the
+    port before every read.
+    """
+    def __init__(self, port, baud):
+        self._dev = serial.Serial(port, baud, timeout=1)
+
+    def process_bytes(self, bytes):
+        self._dev.write(bytes)
+
+    def get_bytes(self, n_bytes, deadline):
+        self._dev.timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+        return self._dev.read(n_bytes)
+
+    def get_available_bytes(self, max_bytes, deadline):
+        n_waiting = self._dev.in_waiting
+        if n_waiting > 0:
+            return self._dev.read(min(n_waiting, max_bytes))
+        result = self.get_bytes(1, deadline)
+        if len(result) > 0 and max_bytes > 1:
+            n_waiting = self._dev.in_waiting
+            if n_waiting > 0:
+                result += self._dev.read(min(n_waiting, max_bytes - 1))
+        return result
+
+    def close(self):
+        self._dev.close()
+
+def single_reads(channel, endpoint_id, count):
+    latencies = []
+    for _ in range(count):
+        start = time.monotonic()
+        channel.remote_endpoint_operation(endpoint_id, None, True, 4)
+        latencies.append(time.monotonic() - start)
+    latencies.sort()
+    return latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+def pipelined_reads(channel, endpoint_id, count, burst=16):
+    start = time.monotonic()
+    for _ in range(count // burst):
+        operations = [channel.submit_endpoint_operation(endpoint_id, None, True, 4) for _ in range(burst)]
+        for operation in operations:
+            operation.result()
+    return (count // burst) * burst / (time.monotonic() - start)
+
+def buffer_read(channel, device, repeat):
+    start = time.monotonic()
+    for _ in range(repeat):
+        assert len(channel.remote_endpoint_read_buffer(device.blob_id)) == len(device.blob)
+    return repeat * len(device.blob) / (time.monotonic() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--count", type=int, default=4000, help="number of reads per measurement")
+    parser.add_argument("--baud", type=int, default=921600, help="baud rate to configure on the port")
+    args = parser.parse_args()
+
+    device = FakeDevice()
+    endpoint_id = device.endpoint_id('vbus_voltage')
+    logger = Logger(verbose=False)
+    variants = [
+        ("per-call timeout", lambda port: PerCallTimeoutTransport(port, args.baud)),
+        ("select", lambda port: fibre.serial_transport.SerialStreamTransport(port, args.baud, reader_thread=False)),
+        ("reader thread", lambda port: fibre.serial_transport.SerialStreamTransport(port, args.baud, reader_thread=True)),
+    ]
+    for name, open_transport in variants:
+        pty = PtyDevice(device)
+        transport = open_transport(pty.port_name)
+        channel = fibre.protocol.Channel("pty", fibre.protocol.PacketFromStreamConverter(transport),
+                                         fibre.protocol.StreamBasedPacketSink(transport), Event(), logger)
+        channel._interface_definition_crc = device.json_crc
+        channel.negotiate_mtu()
+        p50, p99 = single_reads(channel, endpoint_id, args.count // 4)
+        rate = pipelined_reads(channel, endpoint_id, args.count)
+        bulk = buffer_read(channel, device, 20)
+        print("{:<16}: single read p50 {:6.3f} ms, p99 {:6.3f} ms, pipelined {:6.0f} reads/s, buffer {:6.0f} kB/s".format(
+            name, p50 * 1e3, p99 * 1e3, rate, bulk / 1e3))
+        channel._channel_broken.set()
+        transport.close()
+        pty.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Compares streaming setpoints to a fake device with acknowledged writes and
+with unacknowledged writes (RemoteObject.unacked()), with and without
+ack sampling.
+
+Usage:
+    python benchmarks/setpoint_benchmark.py [--latency SECONDS] [--count N]
+"""
+
+import argparse
+import time
+
+from fake_device import FakeDevice, open_object
+
+def stream(odrv, device, count, ack_every=None):
+    controller = odrv.axis0.controller
+    start = time.monotonic()
+    if ack_every is None:
+        for i in range(count):
+            controller.pos_setpoint = i
+    else:
+        with odrv.unacked(ack_every=ack_every):
+            for i in range(count):
+                controller.pos_setpoint = i
+        # The device processes requests in order, so once this is
+        # acknowledged all setpoints arrived
+        odrv.vbus_voltage
+    duration = time.monotonic() - start
+    assert device.get('axis0.controller.pos_setpoint') == count - 1
+    return count / duration
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.0005, help="one-way latency of the link in seconds")
+    parser.add_argument("--count", type=int, default=2000, help="number of setpoints")
+    args = parser.parse_args()
+
+    device = FakeDevice()
+    odrv = open_object(device, latency=args.latency)
+
+    acked = stream(odrv, device, args.count)
+    print("acknowledged:            {:8.0f} setpoints/s".format(acked))
+    for ack_every in (0, 100):
+        rate = stream(odrv, device, args.count, ack_every)
+        print("unacked (ack_every={:3}): {:8.0f} setpoints/s ({:.1f}x)".format(ack_every, rate, rate / acked))
+
+    odrv.__channel__._channel_broken.set()
+    odrv.__channel__.fake_link.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Compares one bulk transfer per request with requests that are coalesced
+into shared bulk transfers (USBBulkTransport.coalesce_delay) on a fake USB
+device (see fake_usb.py).
+
+Each run reads batches of properties with pipelined operations and then
+reads single properties one by one. The first shows how many OUT
+transfers coalescing saves, the second that it doesn't delay requests that
+someone waits for.
+
+Usage:
+    python benchmarks/usb_coalescing_benchmark.py [--delays SECONDS [SECONDS ...]] [--batch N] [--count N] [--in-transfers N]
+"""
+
+import argparse
+import time
+
+from fake_device import FakeDevice
+from fake_usb import open_transport
+import fibre.protocol
+from fibre.utils import Event, Logger
+
+def batch_reads(channel, endpoint_ids, count):
+    start = time.monotonic()
+    for _ in range(count // len(endpoint_ids)):
+        operations = [channel.submit_endpoint_operation(endpoint_id, None, True, 4) for endpoint_id in endpoint_ids]
+        for operation in operations:
+            operation.result()
+    return (count // len(endpoint_ids)) * len(endpoint_ids) / (time.monotonic() - start)
+
+def single_reads(channel, endpoint_id, count):
+    latencies = []
+    for _ in range(count):
+        start = time.monotonic()
+        channel.remote_endpoint_operation(endpoint_id, None, True, 4)
+        latencies.append(time.monotonic() - start)
+    latencies.sort()
+    return latencies[len(latencies) // 2]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--delays", type=float, nargs='+', default=[0.0, 0.0005, 0.002],
+                        help="coalesce delays to test in seconds (in addition to no coalescing)")
+    parser.add_argument("--batch", type=int, default=16, help="number of properties read per batch")
+    parser.add_argument("--count", type=int, default=2000, help="number of reads per measurement")
+    parser.add_argument("--write-overhead", type=float, default=0.0001,
+                        help="time that each OUT transfer takes in seconds")
+    parser.add_argument("--in-transfers", type=int, default=8, help="number of queued IN transfers (0: synchronous reads)")
+    args = parser.parse_args()
+
+    device = FakeDevice()
+    endpoint_ids = [device.endpoint_id('axis{}.config.reserved{}'.format(i % 2, i // 2 % 8)) for i in range(args.batch)]
+    logger = Logger(verbose=False)
+    for delay in [None] + args.delays:
+        transport = open_transport(device, args.in_transfers, logger, coalesce_delay=delay, write_overhead=args.write_overhead)
+        channel = fibre.protocol.Channel("fake USB device", transport, transport, Event(), logger)
+        channel._interface_definition_crc = device.json_crc
+        transfers_before = transport.dev.out_transfers
+        rate = batch_reads(channel, endpoint_ids, args.count)
+        transfers = (transport.dev.out_transfers - transfers_before) / float(args.count)
+        p50 = single_reads(channel, endpoint_ids[0], args.count // 4)
+        print("{:<22}: batches {:6.0f} reads/s, {:.2f} OUT transfers per read, single read p50 {:6.3f} ms".format(
+            "no coalescing" if delay is None else "coalescing, {:.1f} ms".format(delay * 1e3),
+            rate, transfers, p50 * 1e3))
+        channel._channel_broken.set()
+        transport.dev.link.close()
+
+if __name__ == '__main__':
+    main()
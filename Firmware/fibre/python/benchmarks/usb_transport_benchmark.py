@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Compares synchronous reads of the USB transport with queued asynchronous
+IN transfers on a fake USB device (see fake_usb.py).
+
+Each run measures the latency of single reads and the throughput of
+bursts of pipelined reads. In a burst, the responses arrive back to back
+and synchronous reads pay the time it takes the host to pick up a newly
+submitted transfer for each one of them.
+
+Usage:
+    python benchmarks/usb_transport_benchmark.py [--transfers N [N ...]] [--count N] [--schedule-delay SECONDS]
+"""
+
+import argparse
+import time
+
+from fake_device import FakeDevice
+from fake_usb import open_transport
+import fibre.protocol
+from fibre.utils import Event, Logger
+
+def single_reads(channel, endpoint_id, count):
+    latencies = []
+    for _ in range(count):
+        start = time.monotonic()
+        channel.remote_endpoint_operation(endpoint_id, None, True, 4)
+        latencies.append(time.monotonic() - start)
+    latencies.sort()
+    return latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+def pipelined_reads(channel, endpoint_id, count, burst=16):
+    start = time.monotonic()
+    for _ in range(count // burst):
+        operations = [channel.submit_endpoint_operation(endpoint_id, None, True, 4) for _ in range(burst)]
+        for operation in operations:
+            operation.result()
+    return (count // burst) * burst / (time.monotonic() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--transfers", type=int, nargs='+', default=[0, 2, 4, 8],
+                        help="numbers of queued IN transfers to test (0: synchronous reads)")
+    parser.add_argument("--count", type=int, default=2000, help="number of reads per measurement")
+    parser.add_argument("--latency", type=float, default=0.0002, help="one-way latency of the link in seconds")
+    parser.add_argument("--schedule-delay", type=float, default=0.000125,
+                        help="time until the host polls for a newly submitted transfer in seconds")
+    args = parser.parse_args()
+
+    device = FakeDevice()
+    endpoint_id = device.endpoint_id('vbus_voltage')
+    logger = Logger(verbose=False)
+    for in_transfers in args.transfers:
+        transport = open_transport(device, in_transfers, logger,
+                                   latency=args.latency, schedule_delay=args.schedule_delay)
+        channel = fibre.protocol.Channel("fake USB device", transport, transport, Event(), logger)
+        channel._interface_definition_crc = device.json_crc
+        channel.negotiate_mtu()
+        p50, p99 = single_reads(channel, endpoint_id, args.count // 4)
+        rate = pipelined_reads(channel, endpoint_id, args.count)
+        print("{:<12}: single read p50 {:6.3f} ms, p99 {:6.3f} ms, pipelined {:7.0f} reads/s".format(
+            "{} transfers".format(in_transfers) if in_transfers else "synchronous", p50 * 1e3, p99 * 1e3, rate))
+        channel._channel_broken.set()
+        transport.dev.link.close()
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,7 @@
 
 from .discovery import find_any, find_all
-from .utils import Event, Logger, TimeoutError
+from .utils import Event, EventGroup, Logger, TimeoutError, wait_any, wait_all
 from .protocol import ChannelBrokenException, ChannelDamagedException
+from .remote_object import BatchOperationError
+from .sampler import Sampler
 from .shell import launch_shell
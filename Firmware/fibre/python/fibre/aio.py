@@ -0,0 +1,230 @@
+"""
+asyncio based interface to Fibre nodes.
+
+The functions in this module mirror the blocking API but return coroutines.
+Operations are submitted to the channel without blocking the event loop and
+their completion is delivered to the loop directly by the receiver thread of
+the channel, so no executor threads are needed for outstanding calls.
+
+Example:
+
+    import fibre.aio
+
+    async def main():
+        odrv0 = await fibre.aio.find_any()
+        vbus = await fibre.aio.get_value(odrv0, 'vbus_voltage')
+        await fibre.aio.set_value(odrv0, 'axis0.controller.pos_setpoint', 1000)
+        await fibre.aio.call(odrv0.axis0.controller.move_to_pos, 2000)
+
+This module requires Python 3.6 or newer.
+"""
+
+import asyncio
+import time
+
+import fibre.discovery
+from fibre.utils import Event, Logger, TimeoutError
+from fibre.remote_object import RemoteObject, RemoteProperty, RemoteFunction, _CALL_REPEAT, _CALL_REREAD_OUTPUT
+
+try:
+    _get_running_loop = asyncio.get_running_loop
+except AttributeError:
+    _get_running_loop = asyncio.get_event_loop # Python 3.6
+
+def _call_soon_threadsafe(loop, callback, *args):
+    """
+    Schedules callback on the event loop from another thread, such as the
+    receiver thread of a channel. Does nothing if the loop was closed, since
+    nobody waits for the result anymore and the exception would otherwise
+    end up in the thread that called this.
+    """
+    try:
+        loop.call_soon_threadsafe(callback, *args)
+    except RuntimeError:
+        pass
+
+def _set_done(future):
+    if not future.done():
+        future.set_result(None)
+
+def _done_future(operation):
+    loop = _get_running_loop()
+    future = loop.create_future()
+    operation.add_done_callback(lambda op: _call_soon_threadsafe(loop, _set_done, future))
+    return future
+
+async def wait_operation(operation):
+    """
+    Waits for a PendingOperation to complete and returns its response.
+    While waiting, the operation is resent if it is not acknowledged in time,
+    just like PendingOperation.result() does for blocking callers.
+    """
+    future = _done_future(operation)
+    if not operation.done():
+        operation._channel._flush()
+    # The future is only resolved once the event loop runs the callback,
+    # while the operation may already be done (e.g. if it failed right away)
+    while not operation.done():
+        timeout = max(operation._resend_deadline - time.monotonic(), 0)
+        done, _ = await asyncio.wait([future], timeout=timeout)
+        if not done:
+            operation._channel._resend_overdue()
+    return operation.result(timeout=0)
+
+async def _submit(channel, submit):
+    """
+    Calls submit(block=False) without blocking the event loop.
+    If the channel's window of outstanding operations is full, this waits
+    for the oldest outstanding operation to complete before trying again.
+    """
+    while True:
+        try:
+            return submit(block=False)
+        except BlockingIOError:
+            pass
+        try:
+            oldest = next(iter(list(channel._expected_acks.values())))
+        except StopIteration:
+            await asyncio.sleep(0)
+            continue
+        try:
+            await wait_operation(oldest)
+        except Exception:
+            pass # the exception is reported to whoever submitted that operation
+
+async def endpoint_operation(channel, endpoint_id, input, expect_ack, output_length):
+    """
+    Async variant of Channel.remote_endpoint_operation().
+    """
+    operation = await _submit(channel, lambda block: channel.submit_endpoint_operation(
+            endpoint_id, input, expect_ack, output_length, block))
+    if operation is None:
+        return None
+    return await wait_operation(operation)
+
+def _resolve(obj, path, expected_type):
+    """
+    Returns the remote attribute at the dot-separated path relative to obj.
+    If path is None, obj itself must be of the expected type.
+    """
+    if path is not None:
+        for name in path.split('.'):
+            attributes = object.__getattribute__(obj, "_remote_attributes")
+            if name not in attributes:
+                raise AttributeError("Attribute {} not found".format(name))
+            obj = attributes[name]
+    if not isinstance(obj, expected_type):
+        raise TypeError("expected {} but got {}".format(expected_type.__name__, type(obj).__name__))
+    return obj
+
+async def get_value(obj, path=None):
+    """
+    Async variant of RemoteProperty.get_value(). obj is either a
+    RemoteProperty or a RemoteObject together with the path of a property.
+    """
+    prop = _resolve(obj, path, RemoteProperty)
+    if not prop._can_read:
+        raise Exception("Cannot read from property {}".format(prop._name))
+    cache = prop._cache
+    if cache is not None:
+        hit, value, token = cache.lookup(prop)
+        if hit:
+            return value
+    operation = await _submit(prop.__channel__, prop._begin_get_value)
+    await wait_operation(operation)
+    value = prop._end_get_value(operation)
+    if cache is not None:
+        cache.store(prop, value, token)
+    return value
+
+async def set_value(obj, path_or_value, value=None):
+    """
+    Async variant of RemoteProperty.set_value(). Can be called as
+    set_value(prop, value) or as set_value(obj, path, value).
+    """
+    if isinstance(obj, RemoteObject):
+        prop = _resolve(obj, path_or_value, RemoteProperty)
+        if not prop._can_write:
+            raise Exception("Cannot write to property {}".format(prop._name))
+    else:
+        prop = _resolve(obj, None, RemoteProperty)
+        value = path_or_value
+    operation = await _submit(prop.__channel__, lambda block: prop._begin_set_value(value, block))
+    await wait_operation(operation)
+
+async def call(func, *args):
+    """
+    Async variant of RemoteFunction.__call__(). Like the blocking variant,
+    it takes one round trip.
+    """
+    func = _resolve(func, None, RemoteFunction)
+    if (len(func._inputs) != len(args)):
+        raise TypeError("expected {} arguments but have {}".format(len(func._inputs), len(args)))
+    channel = func._parent.__channel__
+    try:
+        ops = []
+        for submit in func._call_requests(args):
+            ops.append(await _submit(channel, submit))
+        func._begin_call(ops)
+        for op in ops:
+            await wait_operation(op)
+        outcome = func._end_call(ops)
+        if outcome == _CALL_REPEAT:
+            ops = []
+            for submit in func._call_requests(args, sequential=True):
+                ops.append(await _submit(channel, submit))
+                await wait_operation(ops[-1])
+    finally:
+        if func._cache is not None:
+            func._cache.clear()
+    if len(func._outputs) > 0:
+        output = ops[-1]
+        if outcome == _CALL_REREAD_OUTPUT:
+            output = await _submit(channel, func._outputs[0]._begin_get_value)
+            await wait_operation(output)
+        return func._outputs[0]._end_get_value(output)
+
+async def find_all(path="usb", serial_number=None,
+        search_cancellation_token=None, channel_termination_token=None,
+        logger=Logger(verbose=False), negotiate_mtu=False):
+    """
+    Async generator that yields each matching Fibre node as it is found.
+    The search stops when the generator is closed or when
+    search_cancellation_token is set.
+    See fibre.discovery.find_all() for negotiate_mtu.
+    """
+    loop = _get_running_loop()
+    queue = asyncio.Queue()
+    done_signal = Event(search_cancellation_token)
+    def did_discover_object(obj):
+        _call_soon_threadsafe(loop, queue.put_nowait, obj)
+    done_signal.subscribe(lambda: _call_soon_threadsafe(loop, queue.put_nowait, None))
+    fibre.discovery.find_all(path, serial_number, did_discover_object, done_signal, channel_termination_token, logger, negotiate_mtu)
+    try:
+        while True:
+            obj = await queue.get()
+            if obj is None:
+                break
+            yield obj
+    finally:
+        done_signal.set() # terminate find_all
+
+async def find_any(path="usb", serial_number=None,
+        search_cancellation_token=None, channel_termination_token=None,
+        timeout=None, logger=Logger(verbose=False), negotiate_mtu=False):
+    """
+    Waits until the first matching Fibre node is connected and then returns that node
+    """
+    loop = _get_running_loop()
+    future = loop.create_future()
+    done_signal = Event(search_cancellation_token)
+    def did_discover_object(obj):
+        _call_soon_threadsafe(loop, lambda: future.done() or future.set_result(obj))
+    done_signal.subscribe(lambda: _call_soon_threadsafe(loop, lambda: future.done() or future.set_result(None)))
+    fibre.discovery.find_all(path, serial_number, did_discover_object, done_signal, channel_termination_token, logger, negotiate_mtu)
+    try:
+        return await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        raise TimeoutError()
+    finally:
+        done_signal.set() # terminate find_all
@@ -0,0 +1,71 @@
+"""
+Table driven CRC8 and CRC16 implementations used by the Fibre protocol.
+See crc.hpp for the C++ counterpart. The polynomials here must match
+the ones used in the C++ implementation.
+"""
+
+CRC8_DEFAULT = 0x37 # this must match the polynomial in the C++ implementation
+CRC16_DEFAULT = 0x3d65 # this must match the polynomial in the C++ implementation
+
+def calc_crc(remainder, value, polynomial, bitwidth):
+    """
+    Calculates an arbitrary CRC for one byte, one bit at a time.
+    This is slow and only used to generate the lookup tables.
+    """
+    topbit = (1 << (bitwidth - 1))
+
+    # Bring the next byte into the remainder.
+    remainder ^= (value << (bitwidth - 8))
+    for bitnumber in range(0,8):
+        if (remainder & topbit):
+            remainder = (remainder << 1) ^ polynomial
+        else:
+            remainder = (remainder << 1)
+
+    return remainder & ((1 << bitwidth) - 1)
+
+def make_crc_table(polynomial, bitwidth):
+    """
+    Returns a 256-entry lookup table for the specified polynomial.
+    Entry i is the remainder that results from shifting the byte i
+    through a zero remainder.
+    """
+    return tuple(calc_crc(0, i, polynomial, bitwidth) for i in range(256))
+
+CRC8_TABLE = make_crc_table(CRC8_DEFAULT, 8)
+CRC16_TABLE = make_crc_table(CRC16_DEFAULT, 16)
+
+def _as_byte_sequence(value):
+    """
+    Returns an iterable of ints for any of the accepted input types
+    (int, bytes, bytearray, memoryview, list of ints).
+    """
+    if isinstance(value, int):
+        return (value,)
+    elif isinstance(value, memoryview) and value.format != 'B':
+        return value.cast('B')
+    return value
+
+def calc_crc8(remainder, value):
+    """
+    Calculates the CRC8 of a single byte or of a whole buffer
+    (bytes, bytearray, memoryview or list of ints).
+    """
+    table = CRC8_TABLE
+    for byte in _as_byte_sequence(value):
+        remainder = table[remainder ^ byte]
+    return remainder
+
+def calc_crc16(remainder, value):
+    """
+    Calculates the CRC16 of a single byte or of a whole buffer
+    (bytes, bytearray, memoryview or list of ints).
+    """
+    table = CRC16_TABLE
+    for byte in _as_byte_sequence(value):
+        remainder = ((remainder << 8) & 0xffff) ^ table[(remainder >> 8) ^ byte]
+    return remainder
+
+# Can be verified with http://www.sunshine2k.de/coding/javascript/crc/crc_js.html:
+#print(hex(calc_crc8(0x12, [1, 2, 3, 4, 5, 0x10, 0x13, 0x37])))
+#print(hex(calc_crc16(0xfeef, [1, 2, 3, 4, 5, 0x10, 0x13, 0x37])))
@@ -6,10 +6,13 @@ import sys
 import json
 import time
 import threading
+import collections
+import itertools
 import traceback
 import fibre.protocol
 import fibre.utils
 import fibre.remote_object
+import fibre.interface_cache
 from fibre.utils import Event, Logger
 from fibre.protocol import ChannelBrokenException, TimeoutError
 
@@ -41,21 +44,120 @@ try:
 except ImportError:
     pass
 
+# Persistent cache of interface definitions (see fibre.interface_cache).
+# Disabled by default, in which case the full definition is downloaded from
+# the device. To enable it, set it to an InterfaceCache, e.g.:
+#   fibre.discovery.interface_cache = fibre.interface_cache.InterfaceCache()
+interface_cache = None
+
+# Maximum number of devices that are initialized (JSON download and object
+# creation) at the same time
+max_concurrent_inits = 8
+
 def noprint(text):
     pass
 
+class _WorkerPool(object):
+    """
+    Runs tasks on up to max_workers daemon threads. Threads are started on
+    demand and exit when there is nothing left to do.
+    """
+    def __init__(self, max_workers):
+        self._max_workers = max(max_workers, 1)
+        self._tasks = collections.deque()
+        self._lock = threading.Lock()
+        self._n_workers = 0
+
+    def submit(self, task):
+        with self._lock:
+            self._tasks.append(task)
+            if self._n_workers >= self._max_workers:
+                return
+            self._n_workers += 1
+        t = threading.Thread(target=self._worker)
+        t.daemon = True
+        t.start()
+
+    def _worker(self):
+        while True:
+            with self._lock:
+                if not self._tasks:
+                    self._n_workers -= 1
+                    return
+                task = self._tasks.popleft()
+            task()
+
 def find_all(path, serial_number,
          did_discover_object_callback,
          search_cancellation_token,
          channel_termination_token,
-         logger):
+         logger,
+         negotiate_mtu=False):
     """
     Starts scanning for Fibre nodes that match the specified path spec and calls
     the callback for each Fibre node that is found.
     This function is non-blocking.
+
+    negotiate_mtu: Try to raise the MTU of each new channel before the
+    interface definition is downloaded (see Channel.negotiate_mtu()). This
+    costs an extra round trip per connection and only pays off with devices
+    that accept packets larger than 127 bytes, which the bundled firmware
+    doesn't.
+
+    New channels are initialized on a pool of up to max_concurrent_inits
+    threads, so that many devices that show up at once don't wait for each
+    other. The callback is never invoked concurrently. For any one device
+    (by transport type and serial number), the callbacks are delivered in
+    the order in which the channels were discovered. A channel whose
+    initialization finishes after a newer channel to the same device on the
+    same transport type was delivered is closed. Devices without a serial
+    number can't be told apart, so their channels are always delivered.
     """
+    pool = _WorkerPool(max_concurrent_inits)
+    callback_lock = threading.Lock()
+    discovery_counter = itertools.count(1)
+    delivered = {} # {(transport type, serial number): discovery index of the last delivered channel}
+    callback_queue = collections.deque()
+    delivering = [False] # True while a thread runs the callbacks in callback_queue
+
+    def did_discover_channel(channel, channel_type):
+        index = next(discovery_counter)
+        pool.submit(lambda: init_channel(channel, channel_type, index))
 
-    def did_discover_channel(channel):
+    def deliver(obj, channel, channel_type, device_serial_number, index):
+        """
+        Decides under callback_lock whether obj is still current and queues it
+        for the callback. The callback itself runs outside the lock, on the
+        thread that found the queue idle, so that a slow callback doesn't hold
+        up the initialization of other devices.
+        """
+        # Devices without a serial number can't be told apart
+        key = (channel_type, device_serial_number) if device_serial_number != "[unknown serial number]" else None
+        with callback_lock:
+            outdated = key is not None and delivered.get(key, 0) > index
+            if not outdated:
+                if key is not None:
+                    delivered[key] = index
+                callback_queue.append(obj)
+                if delivering[0]:
+                    return # the thread that runs the callbacks picks it up
+                delivering[0] = True
+        if outdated:
+            logger.debug("Ignoring outdated {} channel to device {}".format(channel_type, device_serial_number))
+            channel.close()
+            return
+        while True:
+            with callback_lock:
+                if not callback_queue:
+                    delivering[0] = False
+                    return
+                obj = callback_queue.popleft()
+            try:
+                did_discover_object_callback(obj)
+            except Exception:
+                logger.debug("Unexpected exception in discovery callback: " + traceback.format_exc())
+
+    def init_channel(channel, channel_type, index):
         """
         Inits an object from a given channel and then calls did_discover_object_callback
         with the created object
@@ -64,25 +166,32 @@ def find_all(path, serial_number,
         """
         try:
             logger.debug("Connecting to device on " + channel._name)
+            cache = interface_cache
             try:
-                json_bytes = channel.remote_endpoint_read_buffer(0)
+                if negotiate_mtu:
+                    channel.negotiate_mtu()
+                if cache is not None:
+                    json_bytes, json_crc16 = cache.fetch(channel, logger)
+                else:
+                    json_bytes = channel.remote_endpoint_read_buffer(0)
+                    json_crc16 = fibre.protocol.calc_crc16(fibre.protocol.PROTOCOL_VERSION, json_bytes)
             except (TimeoutError, ChannelBrokenException):
                 logger.debug("no response - probably incompatible")
                 return
-            json_crc16 = fibre.protocol.calc_crc16(fibre.protocol.PROTOCOL_VERSION, json_bytes)
             channel._interface_definition_crc = json_crc16
+            logger.debug("JSON checksum: 0x{:02X} 0x{:02X}".format(json_crc16 & 0xff, (json_crc16 >> 8) & 0xff))
             try:
-                json_string = json_bytes.decode("ascii")
+                if cache is not None:
+                    json_data = cache.parse(json_bytes, json_crc16)
+                else:
+                    json_data = json.loads(json_bytes.decode("ascii"))
             except UnicodeDecodeError:
                 logger.debug("device responded on endpoint 0 with something that is not ASCII")
                 return
-            logger.debug("JSON: " + json_string.replace('{"name"', '\n{"name"'))
-            logger.debug("JSON checksum: 0x{:02X} 0x{:02X}".format(json_crc16 & 0xff, (json_crc16 >> 8) & 0xff))
-            try:
-                json_data = json.loads(json_string)
-            except json.decoder.JSONDecodeError as error:
+            except ValueError as error:
                 logger.debug("device responded on endpoint 0 with something that is not JSON: " + str(error))
                 return
+            logger.debug("JSON: " + json_bytes.decode("ascii").replace('{"name"', '\n{"name"'))
             json_data = {"name": "fibre_node", "members": json_data}
             obj = fibre.remote_object.RemoteObject(json_data, None, channel, logger)
 
@@ -93,7 +202,7 @@ def find_all(path, serial_number,
             if serial_number != None and device_serial_number != serial_number:
                 logger.debug("Ignoring device with serial number {}".format(device_serial_number))
                 return
-            did_discover_object_callback(obj)
+            deliver(obj, channel, channel_type, device_serial_number, index)
         except Exception:
             logger.debug("Unexpected exception after discovering channel: " + traceback.format_exc())
 
@@ -102,8 +211,9 @@ def find_all(path, serial_number,
         prefix = search_spec.split(':')[0]
         the_rest = ':'.join(search_spec.split(':')[1:])
         if prefix in channel_types:
+            did_discover = lambda channel, prefix=prefix: did_discover_channel(channel, prefix)
             t = threading.Thread(target=channel_types[prefix],
-                             args=(the_rest, serial_number, did_discover_channel, search_cancellation_token, channel_termination_token, logger))
+                             args=(the_rest, serial_number, did_discover, search_cancellation_token, channel_termination_token, logger))
             t.daemon = True
             t.start()
         else:
@@ -112,7 +222,7 @@ def find_all(path, serial_number,
 
 def find_any(path="usb", serial_number=None,
         search_cancellation_token=None, channel_termination_token=None,
-        timeout=None, logger=Logger(verbose=False)):
+        timeout=None, logger=Logger(verbose=False), negotiate_mtu=False):
     """
     Blocks until the first matching Fibre node is connected and then returns that node
     """
@@ -121,7 +231,7 @@ def find_any(path="usb", serial_number=None,
     def did_discover_object(obj):
         result[0] = obj
         done_signal.set()
-    find_all(path, serial_number, did_discover_object, done_signal, channel_termination_token, logger)
+    find_all(path, serial_number, did_discover_object, done_signal, channel_termination_token, logger, negotiate_mtu)
     try:
         done_signal.wait(timeout=timeout)
     finally:
@@ -0,0 +1,176 @@
+"""
+Notifications about devices being plugged in or removed, so that discovery
+loops only rescan when something changed.
+
+On Linux, kernel and udev events are received on a netlink socket, which
+needs no extra dependencies. On other platforms, or if the socket can't be
+opened, discovery falls back to polling at a fixed interval.
+"""
+
+import os
+import sys
+import time
+import errno
+import select
+import socket
+import struct
+from fibre.utils import TimeoutError
+
+_NETLINK_KOBJECT_UEVENT = 15
+_KERNEL_GROUP = 1 # raw kernel events
+_UDEV_GROUP = 2 # events that udev has processed (e.g. set permissions on)
+_UDEV_PREFIX = b'libudev\0'
+_UDEV_HEADER = struct.Struct('=8sIIII') # prefix, magic, header size, properties offset, properties length
+
+class PollingMonitor(object):
+    """
+    Fallback for platforms without hotplug notifications: every wait lasts
+    for the poll interval.
+    """
+    hotplug = False
+
+    def __init__(self, cancellation_token, poll_interval=1.0):
+        self._cancellation_token = cancellation_token
+        self._poll_interval = poll_interval
+
+    def wait(self, timeout):
+        """
+        Blocks until the cancellation token is set or the poll interval
+        (at most timeout) has passed. Returns False.
+        """
+        try:
+            self._cancellation_token.wait(timeout=min(timeout, self._poll_interval))
+        except TimeoutError:
+            pass
+        return False
+
+    def close(self):
+        pass
+
+def parse_uevent(data):
+    """
+    Parses a kernel or udev uevent message into a dict of its properties
+    (ACTION, SUBSYSTEM, DEVNAME, ...). Returns None if the message is
+    malformed.
+    """
+    if data.startswith(_UDEV_PREFIX):
+        if len(data) < _UDEV_HEADER.size:
+            return None
+        _, _, _, offset, length = _UDEV_HEADER.unpack_from(data, 0)
+        fields = data[offset:offset + length].split(b'\0')
+    else:
+        fields = data.split(b'\0')[1:] # skip "ACTION@DEVPATH"
+    properties = {}
+    for field in fields:
+        key, sep, value = field.partition(b'=')
+        if sep:
+            properties[key.decode('ascii', 'replace')] = value.decode('ascii', 'replace')
+    return properties
+
+class NetlinkMonitor(object):
+    """
+    Receives Linux uevents on a netlink socket. wait() returns as soon as
+    a device of one of the specified subsystems was added or removed.
+    Raises OSError on construction if netlink is not available.
+    """
+    hotplug = True
+    # Plugging in a device causes a burst of events (device, interfaces,
+    # drivers, udev), which are merged into a single wake up
+    settle_time = 0.05 # [s]
+
+    def __init__(self, subsystems, cancellation_token):
+        self._subsystems = set(subsystems)
+        self._socket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, _NETLINK_KOBJECT_UEVENT)
+        try:
+            self._socket.bind((0, _KERNEL_GROUP | _UDEV_GROUP))
+            self._socket.setblocking(False)
+        except:
+            self._socket.close()
+            raise
+        # Setting the cancellation token writes to this pipe to interrupt select()
+        self._wake_r, self._wake_w = os.pipe()
+        self._cancellation_token = cancellation_token
+        self._subscription = cancellation_token.subscribe(self._wake)
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, b'\0')
+        except OSError:
+            pass # already closed
+
+    def _drain(self):
+        """
+        Reads all pending messages. Returns True if any of them is relevant.
+        """
+        relevant = False
+        while True:
+            try:
+                data = self._socket.recv(16384)
+            except OSError as ex:
+                if ex.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return relevant
+                if ex.errno == errno.ENOBUFS:
+                    relevant = True # events were lost, so assume something changed
+                    continue
+                raise
+            properties = parse_uevent(data)
+            if (properties is not None and properties.get('SUBSYSTEM', None) in self._subsystems and
+                    properties.get('ACTION', None) in ('add', 'remove', 'bind')):
+                relevant = True
+
+    def wait(self, timeout):
+        """
+        Blocks until a device was added or removed, the cancellation token is
+        set or the timeout passes. Returns True in the first case.
+        """
+        deadline = time.monotonic() + timeout
+        while not self._cancellation_token.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            readable, _, _ = select.select([self._socket, self._wake_r], [], [], remaining)
+            if self._socket in readable and self._drain():
+                # Let the burst of events pass before reporting it
+                settle_deadline = time.monotonic() + self.settle_time
+                while not self._cancellation_token.is_set():
+                    remaining = settle_deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    if select.select([self._socket, self._wake_r], [], [], remaining)[0]:
+                        self._drain()
+                return True
+        return False
+
+    def close(self):
+        self._cancellation_token.unsubscribe(self._subscription)
+        self._socket.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+def create_monitor(subsystems, cancellation_token, logger, poll_interval=1.0):
+    """
+    Returns a NetlinkMonitor for the specified Linux subsystems (e.g.
+    ('usb',) or ('tty',)) if possible and a PollingMonitor otherwise.
+    """
+    if sys.platform.startswith('linux'):
+        try:
+            return NetlinkMonitor(subsystems, cancellation_token)
+        except (OSError, AttributeError) as ex:
+            logger.debug("hotplug events not available, falling back to polling: {}".format(ex))
+    return PollingMonitor(cancellation_token, poll_interval)
+
+def discovery_loop(scan, monitor, cancellation_token, rescan_interval=10.0, retry_interval=1.0):
+    """
+    Calls scan() until cancellation_token is set: first right away and then
+    each time the monitor reports a hotplug event. scan() returns True if
+    some device should be looked at again soon (e.g. because it was busy),
+    in which case the next scan happens after retry_interval at the latest.
+    Otherwise, a scan is forced every rescan_interval in case an event was
+    missed.
+    """
+    try:
+        while not cancellation_token.is_set():
+            retry = scan()
+            monitor.wait(retry_interval if retry else rescan_interval)
+    finally:
+        monitor.close()
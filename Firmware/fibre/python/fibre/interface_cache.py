@@ -0,0 +1,172 @@
+"""
+Persistent cache of the interface definitions (endpoint 0 JSON) of Fibre nodes.
+
+Downloading the JSON takes many round trips. Instead, only the first chunk
+is read. If a cached definition starts with the same bytes, its CRC is
+checked against the device with a single request (see
+Channel.verify_interface_crc()). A match makes the rest of the download
+unnecessary. Parsed definitions are kept in memory, so reconnecting to the
+same kind of device reuses them as well.
+"""
+
+import os
+import json
+import struct
+import hashlib
+import platform
+import threading
+import collections
+from fibre.protocol import PROTOCOL_VERSION, calc_crc16
+
+def default_cache_dir():
+    """
+    Returns the platform specific directory for the interface cache.
+    """
+    if platform.system() == 'Windows':
+        base = os.environ.get('LOCALAPPDATA', None) or os.path.expanduser('~')
+    elif platform.system() == 'Darwin':
+        base = os.path.join(os.path.expanduser('~'), 'Library', 'Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME', None) or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'fibre', 'interfaces')
+
+def _find_probe_endpoint(members):
+    """
+    Returns the ID of a property in the specified JSON members that can be
+    used to probe the interface CRC, or None if there is no such property.
+    """
+    for member in members:
+        type_str = member.get("type", None)
+        if type_str == "object":
+            endpoint_id = _find_probe_endpoint(member.get("members", []))
+            if endpoint_id is not None:
+                return endpoint_id
+        elif type_str not in (None, "function", "json") and member.get("id", 0):
+            return int(member["id"])
+    return None
+
+class InterfaceCache(object):
+    """
+    Stores interface definitions in a directory, one file per definition.
+    The file name contains the CRC, length and a hash of the JSON. All
+    errors while accessing the directory are ignored, the cache is only an
+    optimization. The directory is not touched before the first fetch().
+
+    Up to max_parsed parsed definitions are kept in memory, the least
+    recently used one is dropped first.
+    """
+    max_parsed = 8
+
+    def __init__(self, directory=None):
+        self._directory = directory or default_cache_dir()
+        self._definitions = None # {file name: (json_bytes, json_crc)}
+        self._parsed = collections.OrderedDict() # {(json_crc, json_bytes): parsed JSON}
+        self._lock = threading.Lock()
+
+    def _load(self, logger):
+        definitions = {}
+        try:
+            file_names = os.listdir(self._directory)
+        except OSError:
+            file_names = []
+        for file_name in file_names:
+            if not file_name.endswith('.json'):
+                continue
+            try:
+                json_crc = int(file_name.split('-')[0], 16)
+                with open(os.path.join(self._directory, file_name), 'rb') as f:
+                    json_bytes = f.read()
+            except (OSError, ValueError):
+                continue
+            if calc_crc16(PROTOCOL_VERSION, json_bytes) != json_crc:
+                logger.debug("ignoring corrupt interface cache file " + file_name)
+                continue
+            definitions[file_name] = (json_bytes, json_crc)
+        return definitions
+
+    def candidates(self, first_chunk, logger):
+        """
+        Returns a list of (json_bytes, json_crc) of all cached definitions
+        that start with first_chunk.
+        """
+        self._lock.acquire()
+        try:
+            if self._definitions is None:
+                self._definitions = self._load(logger)
+            return [d for d in self._definitions.values() if d[0].startswith(first_chunk)]
+        finally:
+            self._lock.release()
+
+    def store(self, json_bytes, json_crc, logger):
+        file_name = "{:04x}-{}-{}.json".format(json_crc, len(json_bytes), hashlib.sha1(json_bytes).hexdigest()[:16])
+        self._lock.acquire()
+        try:
+            if self._definitions is None:
+                self._definitions = self._load(logger)
+            if file_name in self._definitions:
+                return
+            self._definitions[file_name] = (json_bytes, json_crc)
+        finally:
+            self._lock.release()
+        path = os.path.join(self._directory, file_name)
+        try:
+            if not os.path.isdir(self._directory):
+                os.makedirs(self._directory)
+            # Write to a temporary file first so that concurrent readers
+            # never see a partial file
+            tmp_path = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                f.write(json_bytes)
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                os.remove(tmp_path) # another process was faster
+        except OSError as ex:
+            logger.debug("could not write interface cache file {}: {}".format(path, ex))
+
+    def parse(self, json_bytes, json_crc):
+        """
+        Parses the JSON or returns the result of an earlier call with the
+        same JSON. The result is shared and should not be modified.
+        Raises UnicodeDecodeError or ValueError if the JSON is malformed.
+        """
+        key = (json_crc, json_bytes)
+        self._lock.acquire()
+        try:
+            json_data = self._parsed.pop(key, None)
+            if json_data is not None:
+                self._parsed[key] = json_data # now the most recently used
+                return json_data
+        finally:
+            self._lock.release()
+        json_data = json.loads(json_bytes.decode("ascii"))
+        self._lock.acquire()
+        try:
+            self._parsed[key] = json_data
+            while len(self._parsed) > self.max_parsed:
+                self._parsed.popitem(last=False)
+        finally:
+            self._lock.release()
+        return json_data
+
+    def fetch(self, channel, logger):
+        """
+        Returns a tuple (json_bytes, json_crc) with the interface definition
+        of the remote end of the channel. Only the first chunk is downloaded
+        if a matching definition is in the cache.
+        """
+        first_chunk = channel.remote_endpoint_operation(0, struct.pack("<I", 0), True, channel._mtu - 2)
+        if len(first_chunk) > 0:
+            for json_bytes, json_crc in self.candidates(first_chunk, logger):
+                try:
+                    endpoint_id = _find_probe_endpoint(self.parse(json_bytes, json_crc))
+                except ValueError:
+                    continue
+                if endpoint_id is not None and channel.verify_interface_crc(json_crc, endpoint_id):
+                    logger.debug("interface definition 0x{:04X} loaded from cache".format(json_crc))
+                    return json_bytes, json_crc
+
+        json_bytes = channel.remote_endpoint_read_buffer(0, first_chunk)
+        json_crc = calc_crc16(PROTOCOL_VERSION, json_bytes)
+        self.store(json_bytes, json_crc, logger)
+        return json_bytes, json_crc
@@ -0,0 +1,149 @@
+"""
+Statistics about the performance of a channel.
+
+Every Channel has a ChannelMetrics instance in its metrics attribute. The
+counters are updated without locking, so keeping them enabled costs
+next to nothing. The flip side is that a snapshot taken while the channel
+is busy may be off by a few counts.
+
+Example (in the odrivetool shell):
+
+    print(odrv0.__channel__.metrics)
+"""
+
+class LatencyHistogram(object):
+    """
+    Histogram of durations with buckets whose width grows with their value,
+    in the style of HdrHistogram. Durations are stored with a resolution of
+    1us and a relative error of at most 1/(2**(sub_bucket_bits-1)). Recording
+    a value is a handful of integer operations.
+    """
+    sub_bucket_bits = 5
+    max_value = 1 << 28 # [us], about 4.5 minutes. Larger values are clamped.
+
+    def __init__(self):
+        self._half = 1 << (self.sub_bucket_bits - 1)
+        self._counts = [0] * self._index(self.max_value)
+        self.reset()
+
+    def reset(self):
+        for i in range(len(self._counts)):
+            self._counts[i] = 0
+        self.count = 0
+        self.total = 0.0 # [s]
+        self.min = None # [s]
+        self.max = None # [s]
+
+    def _index(self, value):
+        if value < (self._half << 1):
+            return value
+        shift = value.bit_length() - self.sub_bucket_bits
+        return (shift + 1) * self._half + ((value >> shift) - self._half)
+
+    def _bucket_bounds(self, index):
+        """
+        Returns the range [lower, upper) of values [us] in a bucket.
+        """
+        if index < (self._half << 1):
+            return index, index + 1
+        shift = index // self._half - 1
+        lower = (index % self._half + self._half) << shift
+        return lower, lower + (1 << shift)
+
+    def record(self, value):
+        """
+        Records a duration [s].
+        """
+        us = min(max(int(value * 1e6), 0), self.max_value - 1)
+        self._counts[self._index(us)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def percentile(self, percentile):
+        """
+        Returns the duration [s] below which the specified percentage of the
+        recorded durations fall, or None if nothing was recorded.
+        """
+        if not self.count:
+            return None
+        rank = max(percentile / 100.0 * self.count, 1)
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if seen >= rank:
+                lower, upper = self._bucket_bounds(index)
+                return min((lower + upper) / 2e6, self.max)
+        return self.max
+
+    def buckets(self):
+        """
+        Returns a list of (lower [s], upper [s], count) of all non-empty buckets.
+        """
+        result = []
+        for index, count in enumerate(self._counts):
+            if count:
+                lower, upper = self._bucket_bounds(index)
+                result.append((lower / 1e6, upper / 1e6, count))
+        return result
+
+    def __str__(self):
+        if not self.count:
+            return "no samples"
+        return "{} samples, mean {:.3f} ms, p50 {:.3f} ms, p90 {:.3f} ms, p99 {:.3f} ms, max {:.3f} ms".format(
+            self.count, self.mean() * 1e3, self.percentile(50) * 1e3,
+            self.percentile(90) * 1e3, self.percentile(99) * 1e3, self.max * 1e3)
+
+class ChannelMetrics(object):
+    """
+    Counters and latency histogram of a channel.
+    """
+    _counters = [
+        ('operations', "acknowledged operations"),
+        ('resends', "requests that were resent"),
+        ('timeouts', "operations that failed after all attempts"),
+        ('unexpected_acks', "ACKs without a matching operation"),
+        ('send_errors', "requests that the transport failed to send"),
+        ('receive_errors', "errors reported by the transport while receiving"),
+        ('framing_errors', "stream frames with a corrupt header"),
+        ('crc_errors', "stream frames with a corrupt payload"),
+    ]
+
+    def __init__(self):
+        self.latency = LatencyHistogram() # time from the first attempt to the ACK of an operation
+        self.reset()
+
+    def reset(self):
+        for name, _ in self._counters:
+            setattr(self, name, 0)
+        self.latency.reset()
+        self.srtt = None # smoothed round trip time [s], see Channel._update_rtt()
+        self.resend_timeout = None # [s]
+
+    def as_dict(self):
+        """
+        Returns the counters, latency percentiles [s] and round trip time
+        estimate as a dict.
+        """
+        result = {name: getattr(self, name) for name, _ in self._counters}
+        for percentile in (50, 90, 99):
+            result['latency_p{}'.format(percentile)] = self.latency.percentile(percentile)
+        result['latency_max'] = self.latency.max
+        result['srtt'] = self.srtt
+        result['resend_timeout'] = self.resend_timeout
+        return result
+
+    def __str__(self):
+        lines = ["{:<16} {:>8}  ({})".format(name, getattr(self, name), description)
+                 for name, description in self._counters]
+        lines.append("latency          " + str(self.latency))
+        if self.srtt is not None:
+            lines.append("srtt             {:.3f} ms, resend timeout {:.3f} ms".format(
+                self.srtt * 1e3, self.resend_timeout * 1e3))
+        return "\n".join(lines)
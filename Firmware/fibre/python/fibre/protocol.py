@@ -5,8 +5,12 @@ import struct
 import sys
 import threading
 import traceback
+import itertools
+import collections
 #import fibre.utils
-from fibre.utils import Event, wait_any, TimeoutError
+from fibre.utils import Event, TimeoutError
+from fibre.crc import calc_crc, calc_crc8, calc_crc16, CRC8_DEFAULT, CRC16_DEFAULT
+from fibre.metrics import ChannelMetrics
 
 import abc
 if sys.version_info >= (3, 4):
@@ -23,47 +27,19 @@ CRC8_INIT = 0x42
 CRC16_INIT = 0x1337
 PROTOCOL_VERSION = 1
 
-CRC8_DEFAULT = 0x37 # this must match the polynomial in the C++ implementation
-CRC16_DEFAULT = 0x3d65 # this must match the polynomial in the C++ implementation
-
+# Packets below this size use the original 3-byte stream header. Longer
+# packets use the extended 4-byte header. Peers that predate the extended
+# header discard such frames, so it's only used on channels that negotiated it.
 MAX_PACKET_SIZE = 128
+MAX_EXTENDED_PACKET_SIZE = 0x8000
 
-def calc_crc(remainder, value, polynomial, bitwidth):
-    topbit = (1 << (bitwidth - 1))
+# Largest packet that a channel sends before negotiating a larger MTU
+DEFAULT_MTU = MAX_PACKET_SIZE - 1
 
-    # Bring the next byte into the remainder.
-    remainder ^= (value << (bitwidth - 8))
-    for bitnumber in range(0,8):
-        if (remainder & topbit):
-            remainder = (remainder << 1) ^ polynomial
-        else:
-            remainder = (remainder << 1)
-
-    return remainder & ((1 << bitwidth) - 1)
-
-def calc_crc8(remainder, value):
-    if isinstance(value, bytearray) or isinstance(value, bytes) or isinstance(value, list):
-        for byte in value:
-            if not isinstance(byte,int):
-                byte = ord(byte)
-            remainder = calc_crc(remainder, byte, CRC8_DEFAULT, 8)
-    else:
-        remainder = calc_crc(remainder, byte, CRC8_DEFAULT, 8)
-    return remainder
-
-def calc_crc16(remainder, value):
-    if isinstance(value, bytearray) or isinstance(value, bytes) or isinstance(value, list):
-        for byte in value:
-            if not isinstance(byte, int):
-                byte = ord(byte)
-            remainder = calc_crc(remainder, byte, CRC16_DEFAULT, 16)
-    else:
-        remainder = calc_crc(remainder, value, CRC16_DEFAULT, 16)
-    return remainder
-
-# Can be verified with http://www.sunshine2k.de/coding/javascript/crc/crc_js.html:
-#print(hex(calc_crc8(0x12, [1, 2, 3, 4, 5, 0x10, 0x13, 0x37])))
-#print(hex(calc_crc16(0xfeef, [1, 2, 3, 4, 5, 0x10, 0x13, 0x37])))
+_REQUEST_HEADER = struct.Struct('<HHH') # seq_no, endpoint_id, output_length
+_REQUEST_TRAILER = struct.Struct('<H')
+_EMPTY_REQUEST = struct.Struct('<HHHH') # header and trailer without payload
+_SEQ_NO = struct.Struct('<H')
 
 class DeviceInitException(Exception):
     pass
@@ -87,6 +63,16 @@ class StreamSource(ABC):
     def get_bytes(self, n_bytes, deadline):
         pass
 
+    def get_available_bytes(self, max_bytes, deadline):
+        """
+        Returns between 1 and max_bytes bytes as soon as at least one byte is
+        available. Returns an empty result if the deadline is reached before
+        that.
+        Stream sources should override this to return everything that is
+        already buffered with a single call to the underlying device.
+        """
+        return self.get_bytes(1, deadline)
+
 class StreamSink(ABC):
     @abc.abstractmethod
     def process_bytes(self, bytes):
@@ -104,106 +90,411 @@ class PacketSink(ABC):
 
 
 class StreamToPacketSegmenter(StreamSink):
-    def __init__(self, output):
-        self._header = []
-        self._packet = []
-        self._packet_length = 0
+    def __init__(self, output, mtu=DEFAULT_MTU):
+        """
+        Params:
+        output: The PacketSink that receives the packets.
+        mtu: Frames that announce a longer packet are discarded. Keep this as
+             small as possible: the header of a frame is only protected by a
+             CRC8, so now and then a false sync byte in the stream passes as a
+             header, and until the announced length has arrived, the real
+             packets behind it are held up.
+        """
+        self._buffer = bytearray()
         self._output = output
+        self._mtu = mtu
+        self._metrics = None # optional ChannelMetrics that count corrupt frames
+
+    def set_mtu(self, mtu):
+        self._mtu = mtu
 
     def process_bytes(self, bytes):
         """
         Processes an arbitrary number of bytes. If one or more full packets are
         are received, they are sent to this instance's output PacketSink.
         Incomplete packets are buffered between subsequent calls to this function.
-        """
 
-        for byte in bytes:
-            if (len(self._header) < 3):
-                # Process header byte
-                self._header.append(byte)
-                if (len(self._header) == 1) and (self._header[0] != SYNC_BYTE):
-                    self._header = []
-                elif (len(self._header) == 2) and (self._header[1] & 0x80):
-                    self._header = [] # TODO: support packets larger than 128 bytes
-                elif (len(self._header) == 3) and calc_crc8(CRC8_INIT, self._header):
-                    self._header = []
-                elif (len(self._header) == 3):
-                    self._packet_length = self._header[1] + 2
-            else:
-                # Process payload byte
-                self._packet.append(byte)
+        The packets are handed to the output as memoryviews into this instance's
+        buffer. They are only valid for the duration of the process_packet call,
+        so the output must copy them if it wants to retain them.
+        """
+        buffer = self._buffer
+        buffer += bytes
 
-            # If both header and packet are fully received, hand it on to the packet processor
-            if (len(self._header) == 3) and (len(self._packet) == self._packet_length):
-                if calc_crc16(CRC16_INIT, self._packet) == 0:
-                    self._output.process_packet(self._packet[:-2])
-                self._header = []
-                self._packet = []
-                self._packet_length = 0
+        view = memoryview(buffer)
+        pos = 0
+        try:
+            while True:
+                # Skip to the next sync byte
+                pos = buffer.find(SYNC_BYTE, pos)
+                if pos < 0:
+                    pos = len(buffer)
+                    break
+                if len(buffer) - pos < 3:
+                    break # incomplete header
+
+                # Decode and validate header
+                if buffer[pos + 1] & 0x80:
+                    # extended header
+                    if len(buffer) - pos < 4:
+                        break # incomplete header
+                    header_length = 4
+                    packet_length = ((buffer[pos + 1] & 0x7f) << 8) | buffer[pos + 2]
+                else:
+                    header_length = 3
+                    packet_length = buffer[pos + 1]
+                if (packet_length > self._mtu) or calc_crc8(CRC8_INIT, view[pos:pos + header_length]):
+                    if self._metrics is not None:
+                        self._metrics.framing_errors += 1
+                    pos += 1
+                    continue
+
+                start = pos + header_length
+                end = start + packet_length + 2
+                if len(buffer) < end:
+                    break # incomplete payload
+
+                # If both header and packet are fully received, hand it on to
+                # the packet processor. If the CRC doesn't match, the sync byte
+                # was probably part of some other data so we resync right after it.
+                packet = view[start:end]
+                if calc_crc16(CRC16_INIT, packet) == 0:
+                    pos = end
+                    payload = packet[:-2]
+                    try:
+                        self._output.process_packet(payload)
+                    finally:
+                        payload.release()
+                        packet.release()
+                else:
+                    packet.release()
+                    if self._metrics is not None:
+                        self._metrics.crc_errors += 1
+                    pos += 1
+        finally:
+            view.release()
+            # Discard everything that was consumed
+            try:
+                del buffer[:pos]
+            except BufferError:
+                # The output held on to a view of the buffer
+                self._buffer = bytearray(buffer[pos:])
 
 
 class StreamBasedPacketSink(PacketSink):
+    # Largest packet that this sink can frame. The remote end must be told
+    # about packets larger than DEFAULT_MTU through Channel.negotiate_mtu().
+    max_mtu = 512
+    # Streams are usually slow serial links where a full window of requests
+    # takes a while to get through
+    min_resend_timeout = 0.05 # [s]
+
     def __init__(self, output):
         self._output = output
+        self._mtu = DEFAULT_MTU
 
-    def process_packet(self, packet):
-        if (len(packet) >= MAX_PACKET_SIZE):
-            raise NotImplementedError("packet larger than 127 currently not supported")
+    def set_mtu(self, mtu):
+        self._mtu = mtu
 
-        header = bytearray()
-        header.append(SYNC_BYTE)
-        header.append(len(packet))
-        header.append(calc_crc8(CRC8_INIT, header))
+    def process_packet(self, packet):
+        if (len(packet) > self._mtu):
+            raise NotImplementedError("packet larger than {} not supported on this channel".format(self._mtu))
 
-        self._output.process_bytes(header)
-        self._output.process_bytes(packet)
+        frame = bytearray()
+        frame.append(SYNC_BYTE)
+        if len(packet) < MAX_PACKET_SIZE:
+            frame.append(len(packet))
+        else:
+            frame.append(0x80 | (len(packet) >> 8))
+            frame.append(len(packet) & 0xff)
+        frame.append(calc_crc8(CRC8_INIT, frame))
+        frame += packet
 
         # append CRC in big endian
         crc16 = calc_crc16(CRC16_INIT, packet)
-        self._output.process_bytes(struct.pack('>H', crc16))
+        frame += struct.pack('>H', crc16)
+
+        # The whole frame is written at once to save syscalls
+        self._output.process_bytes(frame)
+
+class StreamCoalescer(StreamSink):
+    """
+    Packs consecutive writes (usually whole frames from a
+    StreamBasedPacketSink) into chunks of up to max_size bytes and passes
+    each chunk to the output PacketSink as one packet (e.g. one USB bulk
+    transfer). Bytes are held back until the chunk is full, flush() is
+    called or max_delay [s] has passed since the oldest of them was
+    written. A write that doesn't fit into the current chunk starts a new
+    one, so a frame is only split if it is larger than max_size by itself.
+    """
+    # The flush thread exits after being idle for this long [s]
+    _idle_timeout = 1.0
+
+    def __init__(self, output, max_size, max_delay):
+        self._output = output
+        self._max_size = max_size
+        self._max_delay = max_delay
+        self._buffer = bytearray()
+        self._deadline = None # time by which the buffered bytes must be sent
+        self._cond = threading.Condition()
+        self._thread = None
+        self._error = None # exception of a failed write on the flush thread
+
+    def process_bytes(self, bytes):
+        self._cond.acquire()
+        try:
+            self._raise_error()
+            if self._buffer and len(self._buffer) + len(bytes) > self._max_size:
+                self._write()
+            self._buffer += bytes
+            if len(self._buffer) >= self._max_size or self._max_delay <= 0:
+                self._write()
+            elif self._deadline is None:
+                self._deadline = time.monotonic() + self._max_delay
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._flush_thread, name="fibre coalescer")
+                    self._thread.daemon = True
+                    self._thread.start()
+                else:
+                    self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def flush(self):
+        """
+        Sends everything that is held back.
+        """
+        self._cond.acquire()
+        try:
+            self._raise_error()
+            if self._buffer:
+                self._write()
+        finally:
+            self._cond.release()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write(self):
+        # Written while holding the lock so that chunks can't overtake each other
+        chunk = bytes(self._buffer)
+        del self._buffer[:]
+        self._deadline = None
+        self._output.process_packet(chunk)
+
+    def _flush_thread(self):
+        self._cond.acquire()
+        try:
+            while True:
+                if self._deadline is None:
+                    if not self._cond.wait(self._idle_timeout) and self._deadline is None:
+                        self._thread = None
+                        return
+                    continue
+                remaining = self._deadline - time.monotonic()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+                try:
+                    self._write()
+                except (ChannelDamagedException, TimeoutError):
+                    pass # the requests are resent once their ACKs are overdue
+                except Exception as ex:
+                    self._error = ex # reported to the next writer
+        finally:
+            self._cond.release()
+
+class PacketQueue(PacketSink):
+    """
+    Collects packets in a FIFO queue. Each packet is copied on arrival.
+    """
+    def __init__(self):
+        self._packets = collections.deque()
+
+    def __len__(self):
+        return len(self._packets)
+
+    def process_packet(self, packet):
+        self._packets.append(bytes(packet))
+
+    def pop(self):
+        return self._packets.popleft()
 
 class PacketFromStreamConverter(PacketSource):
+    # Maximum number of bytes requested from the input stream per call
+    _read_size = 4096
+
     def __init__(self, input):
         self._input = input
-    
+        self._packets = PacketQueue()
+        self._segmenter = StreamToPacketSegmenter(self._packets)
+
+    def set_mtu(self, mtu):
+        """
+        Sets the size of the largest packet that is expected on the stream.
+        Called by the Channel once the MTU is negotiated.
+        """
+        self._segmenter.set_mtu(mtu)
+
+    def attach_metrics(self, metrics):
+        """
+        Makes the segmenter count corrupt frames in the specified ChannelMetrics.
+        """
+        self._segmenter._metrics = metrics
+
     def get_packet(self, deadline):
         """
         Requests bytes from the underlying input stream until a full packet is
-        received or the deadline is reached, in which case None is returned. A
-        deadline before the current time corresponds to non-blocking mode.
+        received or the deadline is reached, in which case a TimeoutError is
+        raised. A deadline before the current time corresponds to non-blocking
+        mode.
+        Everything that the input stream has available is read at once, so a
+        single read may yield several packets. These are buffered and returned
+        by subsequent calls to this function.
         """
-        while True:
-            header = bytes()
+        while not len(self._packets):
+            data = self._input.get_available_bytes(self._read_size, deadline)
+            if not data:
+                raise TimeoutError()
+            self._segmenter.process_bytes(data)
+        return self._packets.pop()
+
+
+# Only taken when the first done-callback of an operation is registered
+_callbacks_lock = threading.Lock()
 
-            # TODO: sometimes this call hangs, even though the device apparently sent something
-            header = header + self._input.get_bytes_or_fail(1, deadline)
-            if (header[0] != SYNC_BYTE):
-                #print("sync byte mismatch")
-                continue
+class PendingOperation(object):
+    """
+    An acknowledged endpoint operation that was sent to the remote end.
+    Returned by Channel.submit_endpoint_operation().
+    """
+    __slots__ = ('_channel', '_seq_no', '_packet', '_max_attempts', '_attempts',
+                 '_resend_timeout', '_resend_deadline', '_sent_at', '_is_done', '_done_lock',
+                 '_callbacks', '_ack', '_exception', '_completion_index')
+
+    def __init__(self, channel, seq_no, packet, max_attempts, resend_timeout=None):
+        self._channel = channel
+        self._seq_no = seq_no
+        self._packet = packet
+        self._max_attempts = max_attempts
+        self._attempts = 0
+        self._resend_timeout = resend_timeout # fixed resend timeout [s], None to use the channel's
+        self._resend_deadline = None
+        self._sent_at = None # time of the first attempt
+        # Completion is signalled by releasing a lock that is held from the
+        # start. This is much lighter than a threading.Event, which consists
+        # of a condition variable, a lock and a list of waiters.
+        self._is_done = False
+        self._done_lock = threading.Lock()
+        self._done_lock.acquire()
+        self._callbacks = None # created on demand by add_done_callback()
+        self._ack = None
+        self._exception = None
+        self._completion_index = None # tells the order in which operations of a channel completed
+
+    def done(self):
+        """
+        Returns True if the operation was acknowledged or failed.
+        """
+        return self._is_done
 
-            header = header + self._input.get_bytes_or_fail(1, deadline)
-            if (header[1] & 0x80):
-                #print("packet too large")
-                continue # TODO: support packets larger than 128 bytes
+    def poll(self):
+        """
+        Like done(), but also resends the request if its acknowledgement is
+        overdue. Use this to keep an operation alive without blocking.
+        """
+        if not self._is_done and time.monotonic() >= self._resend_deadline:
+            self._channel._resend_overdue()
+        return self._is_done
 
-            header = header + self._input.get_bytes_or_fail(1, deadline)
-            if calc_crc8(CRC8_INIT, header) != 0:
-                #print("crc8 mismatch")
-                continue
+    def add_done_callback(self, callback):
+        """
+        Invokes callback(operation) as soon as the operation completes. If it
+        is already complete, the callback is invoked immediately. Otherwise it
+        is invoked on the thread that completes the operation, which is
+        usually the receiver thread of the channel, so it must not block.
+        """
+        with _callbacks_lock:
+            if self._callbacks is None:
+                self._callbacks = []
+        self._callbacks.append(callback)
+        if self._is_done:
+            self._run_callbacks()
+
+    def _run_callbacks(self):
+        # list.pop() is atomic, so every callback runs exactly once even if
+        # the completing thread and add_done_callback() both get here
+        callbacks = self._callbacks
+        while callbacks:
+            try:
+                callback = callbacks.pop(0)
+            except IndexError:
+                break
+            callback(self)
 
-            packet_length = header[1] + 2
-            #print("wait for {} bytes".format(packet_length))
-            packet = self._input.get_bytes_or_fail(packet_length, deadline)
-            if calc_crc16(CRC16_INIT, packet) != 0:
-                #print("crc16 mismatch")
-                continue
-            return packet[:-2]
+    def _set_done(self):
+        """
+        Wakes up all waiters. Must be called exactly once, by Channel._complete().
+        """
+        self._is_done = True
+        self._done_lock.release()
+        if self._callbacks is not None:
+            self._run_callbacks()
+
+    def result(self, timeout=None):
+        """
+        Blocks until the operation is acknowledged and returns the response
+        payload. If the acknowledgement doesn't arrive in time, the request is
+        resent from within this function.
+        Raises a ChannelBrokenException if the channel breaks or too many
+        attempts fail and a TimeoutError if the timeout [s] is reached first.
+        """
+        self._wait(timeout)
+        return self._ack[2:]
+
+    def decode_result(self, codec, timeout=None):
+        """
+        Like result() but decodes the response payload with the specified
+        codec directly from the received packet, without copying it first.
+        """
+        self._wait(timeout)
+        return codec.deserialize_from(self._ack, 2)
+
+    def _wait(self, timeout):
+        if not self._is_done:
+            # The request may still be held back by an output that coalesces packets
+            self._channel._flush()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._is_done:
+            wait_until = self._resend_deadline
+            if deadline is not None:
+                wait_until = min(wait_until, deadline)
+            if self._done_lock.acquire(timeout=max(wait_until - time.monotonic(), 0)):
+                # Pass the lock on to the next waiter
+                self._done_lock.release()
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError()
+            self._channel._resend_overdue()
+        if self._exception is not None:
+            raise self._exception
 
 
 class Channel(PacketSink):
-    # Choose these parameters to be sensible for a specific transport layer
-    _resend_timeout = 5.0     # [s]
-    _send_attempts = 5
+    # Choose these parameters to be sensible for a specific transport layer.
+    # The resend timeout adapts to the measured round trip time. A transport
+    # can override its bounds through min_resend_timeout and
+    # max_resend_timeout attributes on its PacketSink.
+    # The remote end doesn't recognize resent requests, so requests that
+    # are not idempotent (function triggers) use _max_resend_timeout instead
+    # (see submit_endpoint_operation()).
+    _resend_timeout = 1.0     # [s] initial value, until a round trip was measured
+    _min_resend_timeout = 0.01 # [s]
+    _max_resend_timeout = 5.0 # [s]
+    _send_attempts = 10
+    _max_in_flight = 16       # maximum number of unacknowledged operations
 
     def __init__(self, name, input, output, cancellation_token, logger):
         """
@@ -219,11 +510,26 @@ class Channel(PacketSink):
         self._logger = logger
         self._outbound_seq_no = 0
         self._interface_definition_crc = 0
+        self._mtu = DEFAULT_MTU
+        self._output_flush = getattr(output, 'flush', None)
+        self._min_resend_timeout = getattr(output, 'min_resend_timeout', self._min_resend_timeout)
+        self._max_resend_timeout = getattr(output, 'max_resend_timeout', self._max_resend_timeout)
+        self._srtt = None # smoothed round trip time [s]
+        self._rttvar = None # round trip time variation [s]
+        self.metrics = ChannelMetrics()
+        if hasattr(input, 'attach_metrics'):
+            input.attach_metrics(self.metrics)
         self._expected_acks = {}
-        self._responses = {}
+        self._completions = itertools.count()
+        self._in_flight = 0
+        self._window_cond = threading.Condition()
         self._my_lock = threading.Lock()
         self._channel_broken = Event(cancellation_token)
-        self.start_receiver_thread(Event(self._channel_broken))
+        self._channel_broken.subscribe(self._fail_pending_operations)
+        # Inputs that deliver packets by themselves (e.g. from the completion
+        # callbacks of asynchronous USB transfers) don't need a receiver thread
+        if not (hasattr(input, 'start_receiving') and input.start_receiving(self, self._channel_broken)):
+            self.start_receiver_thread(Event(self._channel_broken))
 
     def start_receiver_thread(self, cancellation_token):
         """
@@ -243,6 +549,7 @@ class Channel(PacketSink):
                     except TimeoutError:
                         continue # try again
                     except ChannelDamagedException:
+                        self.metrics.receive_errors += 1
                         error_ctr += 1
                         continue # try again
                     if (error_ctr > 0):
@@ -259,76 +566,361 @@ class Channel(PacketSink):
         t.daemon = True
         t.start()
 
-    def remote_endpoint_operation(self, endpoint_id, input, expect_ack, output_length):
-        if input is None:
-            input = bytearray(0)
-        if (len(input) >= 128):
-            raise Exception("packet larger than 127 currently not supported")
-
+    def _make_request(self, endpoint_id, input, expect_ack, output_length, trailer=None, input_codec=None):
+        """
+        Assigns a sequence number to a new request and serializes it.
+        Returns a tuple (seq_no, packet).
+        By default, the trailer is derived from the endpoint ID.
+        If input_codec is given, input is a value that is encoded by the codec
+        together with the header and trailer in one step.
+        """
         if (expect_ack):
             endpoint_id |= 0x8000
 
         self._my_lock.acquire()
         try:
-            self._outbound_seq_no = ((self._outbound_seq_no + 1) & 0x7fff)
-            seq_no = self._outbound_seq_no
+            while True:
+                self._outbound_seq_no = ((self._outbound_seq_no + 1) & 0x7fff)
+                seq_no = self._outbound_seq_no
+                seq_no |= 0x80 # FIXME: we hardwire one bit of the seq-no to 1 to avoid conflicts with the ascii protocol
+                # Skip sequence numbers of operations that are still in flight
+                if not seq_no in self._expected_acks:
+                    break
         finally:
             self._my_lock.release()
-        seq_no |= 0x80 # FIXME: we hardwire one bit of the seq-no to 1 to avoid conflicts with the ascii protocol
-        packet = struct.pack('<HHH', seq_no, endpoint_id, output_length)
-        packet = packet + input
 
-        crc16 = calc_crc16(CRC16_INIT, packet)
-        if (endpoint_id & 0x7fff == 0):
+        if trailer is not None:
+            pass
+        elif (endpoint_id & 0x7fff == 0):
             trailer = PROTOCOL_VERSION
         else:
             trailer = self._interface_definition_crc
         #print("append trailer " + trailer)
-        packet = packet + struct.pack('<H', trailer)
+
+        if input_codec is not None:
+            packet = input_codec.pack_request(seq_no, endpoint_id, output_length, input, trailer)
+        elif not input:
+            packet = _EMPTY_REQUEST.pack(seq_no, endpoint_id, output_length, trailer)
+        else:
+            packet = _REQUEST_HEADER.pack(seq_no, endpoint_id, output_length) + bytes(input) + _REQUEST_TRAILER.pack(trailer)
+        return seq_no, packet
+
+    def submit_endpoint_operation(self, endpoint_id, input, expect_ack, output_length, block=True, input_codec=None,
+                                  resend_timeout=None, max_attempts=None):
+        """
+        Sends an endpoint operation without waiting for it to be acknowledged.
+        If expect_ack is True, a PendingOperation is returned. Its result()
+        function yields the response payload. Otherwise None is returned.
+        If input_codec is given, input is a value that is encoded with that
+        codec instead of a buffer.
+
+        By default, the request is resent when the adaptive resend timeout
+        of the channel expires. Requests that must not be repeated early,
+        because the remote end would process them again (e.g. function
+        triggers), should pass a fixed resend_timeout [s] that is longer
+        than the operation can take. Such requests usually also limit the
+        number of times they are sent with max_attempts, which defaults to
+        _send_attempts.
+
+        At most _max_in_flight acknowledged operations can be outstanding at
+        any time. If that many are outstanding, this function blocks until one
+        of them completes, or raises BlockingIOError if block is False.
+        """
+        seq_no, packet = self._make_request(endpoint_id, input, expect_ack, output_length, input_codec=input_codec)
+        if (len(packet) > self._mtu):
+            raise Exception("packet larger than {} not supported on this channel".format(self._mtu))
 
         if (expect_ack):
-            ack_event = Event()
-            self._expected_acks[seq_no] = ack_event
+            if max_attempts is None:
+                max_attempts = self._send_attempts
+            return self._submit(seq_no, packet, max_attempts, block, resend_timeout)
+        else:
+            # fire and forget
+            self._output.process_packet(packet)
+            return None
+
+    def remote_endpoint_operation(self, endpoint_id, input, expect_ack, output_length):
+        """
+        Sends an endpoint operation and, if expect_ack is True, blocks until
+        the operation is acknowledged. Returns the response payload.
+        """
+        operation = self.submit_endpoint_operation(endpoint_id, input, expect_ack, output_length)
+        if operation is None:
+            return None
+        return operation.result()
+
+    def _submit(self, seq_no, packet, max_attempts, block=True, resend_timeout=None):
+        if self._channel_broken.is_set():
+            raise ChannelBrokenException()
+        if block:
+            self._acquire_window()
+        elif not self._try_acquire_window():
+            raise BlockingIOError("too many operations in flight")
+        operation = PendingOperation(self, seq_no, packet, max_attempts, resend_timeout)
+        self._expected_acks[seq_no] = operation
+        if self._channel_broken.is_set():
+            # The channel may have failed its pending operations before this
+            # one was added
+            self._complete(operation, exception=ChannelBrokenException())
+            raise ChannelBrokenException()
+        self._send(operation)
+        return operation
+
+    def _try_acquire_window(self):
+        """
+        Reserves a slot for a new operation if less than _max_in_flight
+        operations are outstanding. Returns True on success.
+        """
+        self._window_cond.acquire()
+        try:
+            if self._in_flight < self._max_in_flight:
+                self._in_flight += 1
+                return True
+            return False
+        finally:
+            self._window_cond.release()
+
+    def _acquire_window(self):
+        """
+        Blocks until the number of outstanding operations drops below
+        _max_in_flight and then reserves a slot for a new operation.
+        """
+        while True:
+            self._window_cond.acquire()
             try:
-                attempt = 0
-                while (attempt < self._send_attempts):
-                    self._my_lock.acquire()
+                if self._in_flight < self._max_in_flight:
+                    self._in_flight += 1
+                    return
+                if self._channel_broken.is_set():
+                    raise ChannelBrokenException()
+                # Lost packets are only resent when someone waits for them,
+                # so don't wait longer than the next resend is due.
+                resend_deadlines = [op._resend_deadline for op in list(self._expected_acks.values())
+                                    if op._resend_deadline is not None]
+                timeout = self._resend_timeout
+                if resend_deadlines:
+                    timeout = max(min(resend_deadlines) - time.monotonic(), 0)
+                if self._output_flush is not None:
+                    # The operations that would free up the window may still be held back
+                    self._window_cond.release()
                     try:
-                        self._output.process_packet(packet)
-                    except ChannelDamagedException:
-                        attempt += 1
-                        continue # resend
-                    except TimeoutError:
-                        attempt += 1
-                        continue # resend
+                        self._flush()
                     finally:
-                        self._my_lock.release()
-                    # Wait for ACK until the resend timeout is exceeded
-                    try:
-                        if wait_any(self._resend_timeout, ack_event, self._channel_broken) != 0:
-                            raise ChannelBrokenException()
-                    except TimeoutError:
-                        attempt += 1
-                        continue # resend
-                    return self._responses.pop(seq_no)
-                    # TODO: record channel statistics
-                raise ChannelBrokenException() # Too many resend attempts
+                        self._window_cond.acquire()
+                    if self._in_flight < self._max_in_flight:
+                        continue
+                self._window_cond.wait(timeout)
             finally:
-                self._expected_acks.pop(seq_no)
-                self._responses.pop(seq_no, None)
+                self._window_cond.release()
+            self._resend_overdue()
+
+    def _send(self, operation):
+        """
+        Sends or resends the request of an operation. The operation fails if it
+        already used up all attempts or if the output fails with anything
+        other than a ChannelDamagedException or TimeoutError. This doesn't
+        raise, because it also resends the operations of other threads.
+        """
+        while not operation.done():
+            if operation._attempts >= operation._max_attempts:
+                self.metrics.timeouts += 1
+                self._complete(operation, exception=ChannelBrokenException()) # Too many resend attempts
+                return
+            if operation._attempts > 0:
+                self.metrics.resends += 1
+            operation._attempts += 1
+            if operation._attempts == 1:
+                # Set before sending because the ACK can be processed before
+                # process_packet() returns
+                operation._sent_at = time.monotonic()
+            error = None
+            self._my_lock.acquire()
+            try:
+                self._output.process_packet(operation._packet)
+            except ChannelDamagedException:
+                self.metrics.send_errors += 1
+                continue # resend
+            except TimeoutError:
+                self.metrics.send_errors += 1
+                continue # resend
+            except Exception as ex:
+                self.metrics.send_errors += 1
+                error = ex
+            finally:
+                self._my_lock.release()
+            if error is not None:
+                self._complete(operation, exception=error) # releases the operation's window slot
+                return
+            resend_timeout = operation._resend_timeout
+            if resend_timeout is None:
+                resend_timeout = self._resend_timeout
+            operation._resend_deadline = time.monotonic() + resend_timeout
+            return
+
+    def _resend_overdue(self):
+        """
+        Resends all operations whose acknowledgement should have arrived by now.
+        """
+        now = time.monotonic()
+        resent = False
+        for operation in list(self._expected_acks.values()):
+            if (operation._resend_deadline is not None) and (operation._resend_deadline <= now):
+                self._send(operation)
+                resent = True
+        if resent:
+            self._flush()
+            self._back_off()
+
+    def _flush(self):
+        """
+        Sends the requests that the output holds back to coalesce them with
+        subsequent ones (see StreamCoalescer). Called before waiting for
+        an ACK.
+        """
+        if self._output_flush is None:
+            return
+        self._my_lock.acquire()
+        try:
+            self._output_flush()
+        except (ChannelDamagedException, TimeoutError):
+            self.metrics.send_errors += 1 # the requests are resent once their ACKs are overdue
+        finally:
+            self._my_lock.release()
+
+    def _update_rtt(self, rtt):
+        """
+        Updates the round trip time estimate with a new measurement and
+        derives the resend timeout from it (Jacobson/Karels, see RFC 6298).
+        """
+        if self._srtt is None:
+            self._srtt = rtt
+            self._rttvar = rtt / 2
         else:
-            # fire and forget
-            self._output.process_packet(packet)
-            return None
-    
-    def remote_endpoint_read_buffer(self, endpoint_id):
+            self._rttvar += (abs(self._srtt - rtt) - self._rttvar) / 4
+            self._srtt += (rtt - self._srtt) / 8
+        self._resend_timeout = min(max(self._srtt + 4 * self._rttvar, self._min_resend_timeout), self._max_resend_timeout)
+        self.metrics.srtt = self._srtt
+        self.metrics.resend_timeout = self._resend_timeout
+
+    def _back_off(self):
+        """
+        Doubles the resend timeout after a timeout. The next measured round
+        trip resets it.
+        """
+        self._resend_timeout = min(self._resend_timeout * 2, self._max_resend_timeout)
+        self.metrics.resend_timeout = self._resend_timeout
+
+    def _complete(self, operation, ack=None, exception=None):
+        # Only the first completion counts
+        if self._expected_acks.pop(operation._seq_no, None) is not operation:
+            return
+        if ack is not None:
+            latency = time.monotonic() - operation._sent_at
+            self.metrics.operations += 1
+            self.metrics.latency.record(latency)
+            # Only operations that were sent once yield a meaningful round
+            # trip time, for the others it's unknown which attempt was
+            # acknowledged (Karn's algorithm)
+            if operation._attempts == 1:
+                self._update_rtt(latency)
+        operation._ack = ack
+        operation._exception = exception
+        operation._completion_index = next(self._completions)
+        operation._set_done()
+        self._window_cond.acquire()
+        try:
+            self._in_flight -= 1
+            self._window_cond.notify()
+        finally:
+            self._window_cond.release()
+
+    def close(self):
+        """
+        Puts the channel into the broken state. Pending operations fail, the
+        receiver stops and transports that watch the channel release the link.
+        """
+        self._channel_broken.set()
+
+    def _fail_pending_operations(self):
+        for operation in list(self._expected_acks.values()):
+            self._complete(operation, exception=ChannelBrokenException())
+        self._window_cond.acquire()
+        try:
+            self._window_cond.notify_all()
+        finally:
+            self._window_cond.release()
+
+    def _set_transport_mtu(self, mtu):
+        for endpoint in (self._input, self._output):
+            if hasattr(endpoint, 'set_mtu'):
+                endpoint.set_mtu(mtu)
+
+    def negotiate_mtu(self):
+        """
+        Tries to raise the MTU of this channel to the largest packet size that
+        the underlying transport supports (the max_mtu attribute of the output).
+        Returns the resulting MTU.
+
+        A request of that size is sent to endpoint 0, directly followed by a
+        regular request. Remote ends that don't support large packets silently
+        drop the first one. Requests are processed in order, so the outcome is
+        known as soon as the second request is acknowledged. Negotiating with
+        an old device therefore costs one round trip and no timeout.
+        """
+        max_mtu = getattr(self._output, 'max_mtu', DEFAULT_MTU)
+        if max_mtu <= self._mtu:
+            return self._mtu
+
+        # Endpoint 0 ignores everything between the 4 byte offset and the
+        # trailer, so the probe can be padded to the full size.
+        probe_input = struct.pack('<I', 0) + bytes(bytearray(max_mtu - 12))
+        seq_no, packet = self._make_request(0, probe_input, True, max_mtu - 2)
+        self._set_transport_mtu(max_mtu)
+        try:
+            if self._probe(seq_no, packet):
+                self._mtu = max_mtu
+        finally:
+            self._set_transport_mtu(self._mtu)
+        self._logger.debug("{}: using MTU of {} bytes".format(self._name, self._mtu))
+        return self._mtu
+
+    def verify_interface_crc(self, json_crc, endpoint_id):
+        """
+        Returns True if json_crc is the CRC of the remote end's interface
+        definition. The remote end silently drops requests whose trailer does
+        not match its interface CRC, so this sends an empty request with that
+        trailer to the specified endpoint (which must be a property, not a
+        function) and checks whether it gets acknowledged.
+        Like negotiate_mtu(), this costs one round trip and no timeout.
+        """
+        seq_no, packet = self._make_request(endpoint_id, None, True, 0, trailer=json_crc)
+        return self._probe(seq_no, packet)
+
+    def _probe(self, seq_no, packet):
+        """
+        Sends a request that the remote end may silently drop, directly
+        followed by a regular request to endpoint 0. Requests are processed in
+        order, so once the second one is acknowledged the first one is either
+        acknowledged too or was dropped. Returns True in the former case.
+        """
+        probe = self._submit(seq_no, packet, max_attempts=1)
+        try:
+            self.remote_endpoint_operation(0, struct.pack('<I', 0), True, 0)
+        finally:
+            if not probe.done() or probe._exception is not None:
+                self._complete(probe, exception=TimeoutError())
+        return probe._exception is None
+
+    def remote_endpoint_read_buffer(self, endpoint_id, buffer=bytes()):
         """
-        Handles reads from long endpoints
+        Handles reads from long endpoints.
+        If buffer is given, it is taken as the beginning of the data and the
+        read continues from there.
         """
         # TODO: handle device that could (maliciously) send infinite stream
-        buffer = bytes()
         while True:
-            chunk_length = 512
+            # The response must fit into a single packet
+            chunk_length = self._mtu - 2
             chunk = self.remote_endpoint_operation(endpoint_id, struct.pack("<I", len(buffer)), True, chunk_length)
             if (len(chunk) == 0):
                 break
@@ -341,17 +933,17 @@ class Channel(PacketSink):
         if (len(packet) < 2):
             raise Exception("packet too short")
 
-        seq_no = struct.unpack('<H', packet[0:2])[0]
+        seq_no = _SEQ_NO.unpack_from(packet, 0)[0]
 
         if (seq_no & 0x8000):
             seq_no &= 0x7fff
-            ack_signal = self._expected_acks.get(seq_no, None)
-            if (ack_signal):
-                self._responses[seq_no] = packet[2:]
-                ack_signal.set()
+            operation = self._expected_acks.get(seq_no, None)
+            if (operation):
+                self._complete(operation, ack=packet)
                 #print("received ack for packet " + str(seq_no))
             else:
-                print("received unexpected ACK: " + str(seq_no))
+                self.metrics.unexpected_acks += 1
+                self._logger.debug("{}: received unexpected ACK: {}".format(self._name, seq_no))
 
         else:
             #if (calc_crc16(CRC16_INIT, struct.pack('<HBB', PROTOCOL_VERSION, packet[-2], packet[-1]))):
@@ -5,39 +5,319 @@ Provides functions for the discovery of Fibre nodes
 import sys
 import json
 import struct
+import time
 import threading
 import fibre.protocol
 
 class ObjectDefinitionError(Exception):
     pass
 
+class BatchOperationError(Exception):
+    """
+    Raised by RemoteObject.read_many() and RemoteObject.write_many() if some
+    of the items failed. results holds the value of each item (None for
+    failed items) and errors holds the exception of each item (None for
+    successful items), both in the order of the request.
+    """
+    def __init__(self, results, errors):
+        failed = sum(1 for e in errors if e is not None)
+        Exception.__init__(self, "{} of {} operations failed".format(failed, len(errors)))
+        self.results = results
+        self.errors = errors
+
 codecs = {}
 
-class StructCodec():
+CACHE_FOREVER = float('inf')
+
+def default_cache_policy(path, prop, config_ttl):
+    """
+    Returns how long a value of the property at the specified path can be
+    cached (in seconds), CACHE_FOREVER or None if it must not be cached.
+    Read-only identity fields never change during a session, writable
+    properties inside "config" objects change rarely and everything else is
+    considered a live value.
+    """
+    name = path.split('.')[-1]
+    if not prop._can_write and (name == 'serial_number' or name.startswith('hw_version_') or name.startswith('fw_version_')):
+        return CACHE_FOREVER
+    if prop._can_write and 'config' in path.split('.')[:-1]:
+        return config_ttl
+    return None
+
+class PropertyCache(object):
+    """
+    Opt-in cache for property reads. Use enable_cache() to attach it to an
+    object tree. Each property gets a time-to-live from the policy when the
+    cache is attached to it, which happens when the member is first built
+    (see RemoteAttributes). Properties without a TTL are not affected at all.
+    Writes to a property invalidate its entry and calling a remote function
+    drops all entries except the ones that are cached forever.
+    """
+    def __init__(self, policy=None, config_ttl=1.0):
+        if policy is None:
+            policy = lambda path, prop: default_cache_policy(path, prop, config_ttl)
+        self._policy = policy
+        self._ttl = {}
+        self._entries = {}
+        self._objects = [] # objects and functions that this cache is attached to
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _attach(self, obj, path):
+        """
+        Attaches the cache to obj and the members of obj that were already
+        built. Members that are built later attach themselves through
+        _attach_member().
+        """
+        obj.__dict__['_cache_path'] = (self, path)
+        self._objects.append(obj)
+        attributes = object.__getattribute__(obj, "_remote_attributes")
+        for name, attr in list(attributes._attributes.items()):
+            if not isinstance(attr, dict):
+                self._attach_member(attr, path + name)
+
+    def _attach_member(self, attr, attr_path):
+        if isinstance(attr, RemoteObject):
+            self._attach(attr, attr_path + '.')
+        elif isinstance(attr, RemoteFunction):
+            attr._cache = self
+            self._objects.append(attr)
+        elif isinstance(attr, RemoteProperty):
+            ttl = self._policy(attr_path, attr)
+            if ttl is not None:
+                self._ttl[attr] = ttl
+                attr._cache = self
+
+    def _detach(self):
+        for obj in self._objects:
+            if isinstance(obj, RemoteFunction):
+                obj._cache = None
+            else:
+                obj.__dict__.pop('_cache_path', None)
+        self._objects = []
+        for prop in list(self._ttl.keys()):
+            prop._cache = None
+        self._ttl = {}
+        self.clear(permanent=True)
+
+    def lookup(self, prop):
+        """
+        Returns a tuple (hit, value, token). If hit is False, the caller is
+        expected to fetch the value and pass it to store() along with token.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(prop, None)
+            if entry is not None and entry[1] > time.monotonic():
+                self.hits += 1
+                return (True, entry[0], self._generation)
+            self.misses += 1
+            return (False, None, self._generation)
+        finally:
+            self._lock.release()
+
+    def store(self, prop, value, token):
+        """
+        Caches a value that was read from the device. The value is discarded
+        if the cache was invalidated after the corresponding lookup().
+        """
+        self._lock.acquire()
+        try:
+            if token == self._generation and prop in self._ttl:
+                self._entries[prop] = (value, time.monotonic() + self._ttl[prop])
+        finally:
+            self._lock.release()
+
+    def invalidate(self, prop):
+        self._lock.acquire()
+        try:
+            self._generation += 1
+            self._entries.pop(prop, None)
+        finally:
+            self._lock.release()
+
+    def clear(self, permanent=False):
+        """
+        Drops all entries that are not cached forever, or all entries if
+        permanent is True.
+        """
+        self._lock.acquire()
+        try:
+            self._generation += 1
+            if permanent:
+                self._entries = {}
+            else:
+                self._entries = {k: v for k, v in self._entries.items() if self._ttl[k] == CACHE_FOREVER}
+        finally:
+            self._lock.release()
+
+    def __str__(self):
+        return "{} hits, {} misses, {} of {} properties cached".format(
+            self.hits, self.misses, len(self._entries), len(self._ttl))
+
+def enable_cache(obj, policy=None, config_ttl=1.0):
+    """
+    Enables caching of property reads for all properties below obj and
+    returns the PropertyCache. The cache is also available as
+    obj._property_cache.
+    policy is a function (path, property) -> TTL in seconds, CACHE_FOREVER or
+    None. By default default_cache_policy() is used with the specified
+    config_ttl.
+    """
+    disable_cache(obj)
+    cache = PropertyCache(policy, config_ttl)
+    cache._attach(obj, '')
+    obj.__dict__['_property_cache'] = cache
+    return cache
+
+def disable_cache(obj):
+    """
+    Disables a cache previously enabled with enable_cache().
+    """
+    cache = obj.__dict__.pop('_property_cache', None)
+    if cache is not None:
+        cache._detach()
+
+_codec_index = {}
+
+def get_codec(type_str):
+    """
+    Returns a tuple (python_type, codec) for the specified JSON type string.
+    The lookup goes through an index that is rebuilt whenever the type
+    string is not found, so codecs registered later are picked up too.
+    """
+    entry = _codec_index.get(type_str, None)
+    if entry is None:
+        # TODO: better heuristics to select a matching type (i.e. prefer non lossless)
+        for python_type, type_codecs in codecs.items():
+            for codec_type_str, codec in type_codecs.items():
+                _codec_index.setdefault(codec_type_str, (python_type, codec))
+        entry = _codec_index.get(type_str, None)
+        if entry is None:
+            raise ObjectDefinitionError("unsupported codec {}".format(type_str))
+    return entry
+
+# UnackedWrites contexts that are active on the current thread
+_unacked_writers = threading.local()
+
+class UnackedWrites(object):
+    """
+    Context manager that makes property writes on a channel fire-and-forget,
+    so that setpoints can be streamed at the rate the link sustains instead
+    of one write per round trip. Use RemoteObject.unacked() to create one:
+
+        with odrv0.unacked(ack_every=100):
+            for pos in trajectory:
+                odrv0.axis0.controller.pos_setpoint = pos
+
+    If ack_every is N > 0, every Nth write requests an acknowledgement to
+    detect link loss. The writer does not wait for it. A failed sample
+    raises ChannelBrokenException on one of the following writes, and the
+    last sample is waited for when the context exits.
+    The context applies to writes made by the current thread only.
+    """
+    def __init__(self, channel, ack_every=0):
+        self._channel = channel
+        self._ack_every = ack_every
+        self._count = 0
+        self._sample = None
+        self._previous = None
+
+    def write(self, prop, value):
+        self._count += 1
+        if self._ack_every and self._count % self._ack_every == 0:
+            if self._sample is None or self._sample.poll():
+                self._check()
+                try:
+                    self._sample = prop._begin_set_value(value, block=False)
+                    return
+                except BlockingIOError:
+                    pass # too many operations in flight, skip this sample
+        elif self._sample is not None:
+            self._sample.poll()
+        prop._begin_set_value(value, expect_ack=False)
+
+    def _check(self):
+        sample, self._sample = self._sample, None
+        if sample is not None:
+            sample.result()
+
+    def flush(self):
+        """
+        Waits for the last sampled acknowledgement, if any.
+        """
+        self._check()
+
+    def __enter__(self):
+        writers = getattr(_unacked_writers, 'by_channel', None)
+        if writers is None:
+            writers = _unacked_writers.by_channel = {}
+        self._previous = writers.get(self._channel, None)
+        writers[self._channel] = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        writers = _unacked_writers.by_channel
+        if self._previous is None:
+            writers.pop(self._channel, None)
+        else:
+            writers[self._channel] = self._previous
+        if exc_type is None:
+            self.flush()
+
+class StructCodec(object):
     """
     Generic serializer/deserializer based on struct pack
     """
+    __slots__ = ('_struct', '_request_struct', '_target_type')
+
     def __init__(self, struct_format, target_type):
-        self._struct_format = struct_format
+        self._struct = struct.Struct(struct_format)
+        # A complete request with a value of this type as payload
+        # (see Channel._make_request())
+        self._request_struct = struct.Struct('<HHH' + struct_format.lstrip('<') + 'H')
         self._target_type = target_type
     def get_length(self):
-        return struct.calcsize(self._struct_format)
+        return self._struct.size
     def serialize(self, value):
-        value = self._target_type(value)
-        return struct.pack(self._struct_format, value)
+        return self._struct.pack(self._target_type(value))
+    def serialize_into(self, buffer, offset, value):
+        """
+        Encodes the value directly into buffer at the specified offset
+        """
+        self._struct.pack_into(buffer, offset, self._target_type(value))
+    def pack_request(self, seq_no, endpoint_id, output_length, value, trailer):
+        """
+        Encodes a whole request with the value as payload in one step
+        """
+        return self._request_struct.pack(seq_no, endpoint_id, output_length, self._target_type(value), trailer)
     def deserialize(self, buffer):
-        value = struct.unpack(self._struct_format, buffer)
+        value = self._struct.unpack(buffer)
+        value = value[0] if len(value) == 1 else value
+        return self._target_type(value)
+    def deserialize_from(self, buffer, offset=0):
+        """
+        Decodes a value from buffer at the specified offset. The buffer
+        may be longer than the encoded value.
+        """
+        value = self._struct.unpack_from(buffer, offset)
         value = value[0] if len(value) == 1 else value
         return self._target_type(value)
 
-class RemoteProperty():
+class RemoteProperty(object):
     """
     Used internally by dynamically created objects to translate
     property assignments and fetches into endpoint operations on the
     object's associated channel
     """
+    __slots__ = ('_parent', '__channel__', '_id', '_name', '_property_type', '_codec',
+                 '_can_read', '_can_write', '_cache')
+
     def __init__(self, json_data, parent):
         self._parent = parent
+        self._cache = None
         self.__channel__ = parent.__channel__
         id_str = json_data.get("id", None)
         if id_str is None:
@@ -52,30 +332,54 @@ class RemoteProperty():
         if type_str is None:
             raise ObjectDefinitionError("unspecified type")
 
-        # Find all codecs that match the type_str and build a dictionary
-        # of the form {type1: codec1, type2: codec2}
-        eligible_types = {k: v[type_str] for (k,v) in codecs.items() if type_str in v}
-        
-        if not eligible_types:
-            raise ObjectDefinitionError("unsupported codec {}".format(type_str))
-
-        # TODO: better heuristics to select a matching type (i.e. prefer non lossless)
-        eligible_types = list(eligible_types.items())
-        self._property_type = eligible_types[0][0]
-        self._codec = eligible_types[0][1]
+        self._property_type, self._codec = get_codec(type_str)
 
         access_mode = json_data.get("access", "r")
         self._can_read = 'r' in access_mode
         self._can_write = 'w' in access_mode
 
+    def _begin_get_value(self, block=True, resend_timeout=None, max_attempts=None):
+        """
+        Submits a read of this property and returns the PendingOperation.
+        Use _end_get_value() to wait for it and decode the response.
+        """
+        return self._parent.__channel__.submit_endpoint_operation(self._id, None, True, self._codec.get_length(), block,
+                                                                  resend_timeout=resend_timeout,
+                                                                  max_attempts=max_attempts)
+
+    def _end_get_value(self, operation):
+        return operation.decode_result(self._codec)
+
+    def _begin_set_value(self, value, block=True, expect_ack=True):
+        """
+        Submits a write to this property and returns the PendingOperation
+        (or None if expect_ack is False).
+        The value is encoded directly into the request.
+        """
+        if self._cache is not None:
+            self._cache.invalidate(self)
+        return self._parent.__channel__.submit_endpoint_operation(self._id, value, expect_ack, 0, block, input_codec=self._codec)
+
     def get_value(self):
-        buffer = self._parent.__channel__.remote_endpoint_operation(self._id, None, True, self._codec.get_length())
-        return self._codec.deserialize(buffer)
+        cache = self._cache
+        if cache is None:
+            return self._end_get_value(self._begin_get_value())
+        hit, value, token = cache.lookup(self)
+        if not hit:
+            value = self._end_get_value(self._begin_get_value())
+            cache.store(self, value, token)
+        return value
 
     def set_value(self, value):
-        buffer = self._codec.serialize(value)
-        # TODO: Currenly we wait for an ack here. Settle on the default guarantee.
-        self._parent.__channel__.remote_endpoint_operation(self._id, buffer, True, 0)
+        # By default we wait for an ack here, unless the write is made inside
+        # an UnackedWrites context of this channel.
+        writers = getattr(_unacked_writers, 'by_channel', None)
+        if writers:
+            writer = writers.get(self.__channel__, None)
+            if writer is not None:
+                writer.write(self, value)
+                return
+        self._begin_set_value(value).result()
 
     def _dump(self):
         if self._name == "serial_number":
@@ -88,22 +392,34 @@ class RemoteProperty():
             val_str = str(self.get_value())
         return "{} = {} ({})".format(self._name, val_str, self._property_type.__name__)
 
-class EndpointRefCodec():
+class EndpointRefCodec(object):
     """
     Serializer/deserializer for an endpoint reference
     """
+    __slots__ = ()
+    _struct = struct.Struct("<HH")
+    _request_struct = struct.Struct("<HHHHHH")
+
     def get_length(self):
-        return struct.calcsize("<HH")
-    def serialize(self, value):
+        return self._struct.size
+    def _to_tuple(self, value):
         if value is None:
-            (ep_id, ep_crc) = (0, 0)
+            return (0, 0)
         elif isinstance(value, RemoteProperty):
-            (ep_id, ep_crc) = (value._id, value.__channel__._interface_definition_crc)
+            return (value._id, value.__channel__._interface_definition_crc)
         else:
             raise TypeError("Expected value of type RemoteProperty or None but got '{}'. En example for a RemoteProperty is this expression: odrv0.axis0.controller._remote_attributes['pos_setpoint']".format(type(value).__name__))
-        return struct.pack("<HH", ep_id, ep_crc)
+    def serialize(self, value):
+        return self._struct.pack(*self._to_tuple(value))
+    def serialize_into(self, buffer, offset, value):
+        self._struct.pack_into(buffer, offset, *self._to_tuple(value))
+    def pack_request(self, seq_no, endpoint_id, output_length, value, trailer):
+        ep_id, ep_crc = self._to_tuple(value)
+        return self._request_struct.pack(seq_no, endpoint_id, output_length, ep_id, ep_crc, trailer)
     def deserialize(self, buffer):
-        return struct.unpack("<HH", buffer)
+        return self._struct.unpack(buffer)
+    def deserialize_from(self, buffer, offset=0):
+        return self._struct.unpack_from(buffer, offset)
 
 codecs[int] = {
     'int8': StructCodec("<b", int),
@@ -129,12 +445,28 @@ codecs[RemoteProperty] = {
 }
 
 
+# Outcomes of a pipelined function call (see RemoteFunction._end_call())
+_CALL_DONE = 0
+_CALL_REREAD_OUTPUT = 1
+_CALL_REPEAT = 2
+
 class RemoteFunction(object):
     """
-    Represents a callable function that maps to a function call on a remote object
+    Represents a callable function that maps to a function call on a remote object.
+    The RemoteProperty objects for the inputs and outputs are only created
+    when they are first needed.
     """
+    __slots__ = ('_parent', '_trigger_id', '_name', '_json_data', '_input_props', '_output_props', '_cache')
+    # Number of times a trigger is sent before the call fails. Each attempt
+    # waits for the longest resend timeout of the channel.
+    _trigger_attempts = 3
+
     def __init__(self, json_data, parent):
         self._parent = parent
+        self._cache = None
+        self._json_data = json_data
+        self._input_props = None
+        self._output_props = None
         id_str = json_data.get("id", None)
         if id_str is None:
             raise ObjectDefinitionError("unspecified endpoint ID")
@@ -144,75 +476,334 @@ class RemoteFunction(object):
         if self._name is None:
             self._name = "[anonymous]"
 
-        self._inputs = []
-        for param_json in json_data.get("arguments", []) + json_data.get("inputs", []): # TODO: deprecate "arguments" keyword
-            param_json["mode"] = "r"
-            self._inputs.append(RemoteProperty(param_json, parent))
-
-        self._outputs = []
-        for param_json in json_data.get("outputs", []): # TODO: deprecate "arguments" keyword
-            param_json["mode"] = "r"
-            self._outputs.append(RemoteProperty(param_json, parent))
+    @property
+    def _inputs(self):
+        if self._input_props is None:
+            json_data = self._json_data
+            self._input_props = [RemoteProperty(param_json, self._parent)
+                                 for param_json in json_data.get("arguments", []) + json_data.get("inputs", [])] # TODO: deprecate "arguments" keyword
+        return self._input_props
+
+    @property
+    def _outputs(self):
+        if self._output_props is None:
+            self._output_props = [RemoteProperty(param_json, self._parent)
+                                  for param_json in self._json_data.get("outputs", [])]
+        return self._output_props
 
     def __call__(self, *args):
+        """
+        Calls the remote function. The argument writes, the trigger and the
+        read of the output are sent back-to-back, so a call takes one round
+        trip.
+        Lost argument writes are resent like any other write. The trigger is
+        only resent if it isn't acknowledged within the longest resend
+        timeout of the channel (see _call_requests()). If an argument write
+        had to be resent and was only acknowledged after the trigger, the
+        call is repeated one step at a time (see _end_call()).
+        """
         if (len(self._inputs) != len(args)):
             raise TypeError("expected {} arguments but have {}".format(len(self._inputs), len(args)))
-        for i in range(len(args)):
-            self._inputs[i].set_value(args[i])
-        self._parent.__channel__.remote_endpoint_operation(self._trigger_id, None, True, 0)
+        try:
+            ops = [submit(True) for submit in self._call_requests(args)]
+            self._begin_call(ops)
+            for op in ops:
+                op.result()
+            outcome = self._end_call(ops)
+            if outcome == _CALL_REPEAT:
+                ops = []
+                for submit in self._call_requests(args, sequential=True):
+                    ops.append(submit(True))
+                    ops[-1].result()
+        finally:
+            if self._cache is not None:
+                self._cache.clear()
+        if len(self._outputs) > 0:
+            output = self._outputs[0]._begin_get_value() if outcome == _CALL_REREAD_OUTPUT else ops[-1]
+            return self._outputs[0]._end_get_value(output)
+
+    def _call_requests(self, args, sequential=False):
+        """
+        Returns the functions that submit the operations of a call, in order.
+        Each one takes the block argument of
+        Channel.submit_endpoint_operation() and returns a PendingOperation.
+        If sequential is True, the caller waits for each operation before
+        it submits the next one.
+        """
+        channel = self._parent.__channel__
+        requests = [lambda block, prop=prop, arg=arg: prop._begin_set_value(arg, block)
+                    for prop, arg in zip(self._inputs, args)]
+        # The function may take longer than a round trip and the device
+        # would run it again for a resent trigger, so the trigger and the
+        # output read (which waits for the function) are only resent after
+        # the longest resend timeout of the channel (see _begin_call()).
+        # This makes a lost trigger expensive, so it's not resent as often
+        # as other requests.
+        resend_timeout = channel._max_resend_timeout
+        attempts = self._trigger_attempts
+        requests.append(lambda block: channel.submit_endpoint_operation(self._trigger_id, None, True, 0, block,
+                                                                        resend_timeout=resend_timeout,
+                                                                        max_attempts=attempts))
         if len(self._outputs) > 0:
-            return self._outputs[0].get_value()
+            if sequential:
+                requests.append(lambda block: self._outputs[0]._begin_get_value(block))
+            else:
+                requests.append(lambda block: self._outputs[0]._begin_get_value(block, resend_timeout, attempts))
+        return requests
+
+    def _begin_call(self, ops):
+        """
+        Must be called once the operations of a call were submitted. As
+        soon as the trigger is acknowledged, the output read is resent with
+        the adaptive resend timeout like any other read, since it no longer
+        waits for the function.
+        """
+        if len(self._outputs) == 0:
+            return
+        output = ops[-1]
+        def on_trigger_done(trigger):
+            if not output.done():
+                output._resend_timeout = None
+                output._max_attempts = output._channel._send_attempts
+                output._resend_deadline = time.monotonic() + output._channel._resend_timeout
+        ops[len(self._inputs)].add_done_callback(on_trigger_done)
+
+    def _end_call(self, ops):
+        """
+        Checks the outcome of a call whose operations all completed
+        successfully. The remote end processes requests in order, so if
+        their acknowledgements arrived in a different order, some of them
+        were resent:
+        - If an argument write was acknowledged after the trigger, the
+          write was resent (its first attempt or its acknowledgement was
+          lost) and it's unknown which value the function used. Returns
+          _CALL_REPEAT, so the call is repeated sequentially like before
+          calls were pipelined: the writes are sent again and acknowledged
+          before the function is triggered again.
+        - If the output was read before the trigger was acknowledged, the
+          trigger was resent and the output read returned the previous
+          result. Returns _CALL_REREAD_OUTPUT, so the output is read again.
+        Otherwise returns _CALL_DONE.
+        """
+        trigger = ops[len(self._inputs)]
+        if any(op._completion_index > trigger._completion_index for op in ops[:len(self._inputs)]):
+            return _CALL_REPEAT
+        if len(self._outputs) > 0 and ops[-1]._completion_index < trigger._completion_index:
+            return _CALL_REREAD_OUTPUT
+        return _CALL_DONE
 
     def _dump(self):
         return "{}({})".format(self._name, ", ".join("{}: {}".format(x._name, x._property_type.__name__) for x in self._inputs))
 
-class RemoteObject(object):
+class RemoteAttributes(object):
     """
-    Object with functions and properties that map to remote endpoints
+    Dictionary-like collection of the members of a RemoteObject.
+    Members are only instantiated from the retained JSON when they are
+    first accessed. Malformed members are dropped at that point.
     """
-    def __init__(self, json_data, parent, channel, logger):
-        """
-        Creates an object that implements the specified JSON type description by
-        communicating over the provided channel
-        """
-        # Directly write to __dict__ to avoid calling __setattr__ too early
-        object.__getattribute__(self, "__dict__")["_remote_attributes"] = {}
-        object.__getattribute__(self, "__dict__")["__sealed__"] = False
-        # Assign once more to make linter happy
-        self._remote_attributes = {}
-        self.__sealed__ = False
+    __slots__ = ('_attributes', '_parent', '_channel', '_logger')
 
-        self.__channel__ = channel
-        self.__parent__ = parent
-
-        # Build attribute list from JSON
-        for member_json in json_data.get("members", []):
+    def __init__(self, members_json, parent, channel, logger):
+        # Maps each name to the member's JSON until it is instantiated and
+        # to the instantiated attribute after that
+        self._attributes = {}
+        self._parent = parent
+        self._channel = channel
+        self._logger = logger
+        for member_json in members_json:
             member_name = member_json.get("name", None)
             if member_name is None:
                 logger.debug("ignoring unnamed attribute")
                 continue
+            self._attributes[member_name] = member_json
+
+    def _build(self, name, member_json):
+        try:
+            type_str = member_json.get("type", None)
+            if type_str == "object":
+                attribute = RemoteObject(member_json, self._parent, self._channel, self._logger)
+            elif type_str == "function":
+                attribute = RemoteFunction(member_json, self._parent)
+            elif type_str != None:
+                attribute = RemoteProperty(member_json, self._parent)
+            else:
+                raise ObjectDefinitionError("no type information")
+        except ObjectDefinitionError as ex:
+            self._logger.debug("malformed member {}: {}".format(name, str(ex)))
+            self._attributes.pop(name, None)
+            return None
+        self._attributes[name] = attribute
+        cache_path = self._parent.__dict__.get('_cache_path', None)
+        if cache_path is not None:
+            cache, path = cache_path
+            cache._attach_member(attribute, path + name)
+        return attribute
+
+    def get(self, name, default=None):
+        attribute = self._attributes.get(name, None)
+        if isinstance(attribute, dict):
+            attribute = self._build(name, attribute)
+        return default if attribute is None else attribute
+
+    def __getitem__(self, name):
+        attribute = self.get(name)
+        if attribute is None:
+            raise KeyError(name)
+        return attribute
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def keys(self):
+        return [name for name, _ in self.items()]
+
+    def _names(self):
+        """
+        Returns the names of all members without instantiating them
+        """
+        return list(self._attributes.keys())
 
-            try:
-                type_str = member_json.get("type", None)
-                if type_str == "object":
-                    attribute = RemoteObject(member_json, self, channel, logger)
-                elif type_str == "function":
-                    attribute = RemoteFunction(member_json, self)
-                elif type_str != None:
-                    attribute = RemoteProperty(member_json, self)
+    def values(self):
+        return [attribute for _, attribute in self.items()]
+
+    def items(self):
+        result = []
+        for name in list(self._attributes.keys()):
+            attribute = self.get(name)
+            if attribute is not None:
+                result.append((name, attribute))
+        return result
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.items())
+
+    def _built_values(self):
+        return [a for a in list(self._attributes.values()) if not isinstance(a, dict)]
+
+def _get_member(obj, name):
+    attribute = obj._remote_attributes.get(name, None)
+    if attribute is None:
+        raise AttributeError("Attribute {} not found".format(name))
+    return attribute
+
+class RemotePropertyDescriptor(object):
+    """
+    Data descriptor that maps reads and writes of an attribute of a
+    generated RemoteObject class to the corresponding RemoteProperty.
+    """
+    __slots__ = ('_name',)
+
+    def __init__(self, name):
+        self._name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        attribute = obj._remote_attributes._attributes.get(self._name, None)
+        if not isinstance(attribute, RemoteProperty):
+            attribute = _get_member(obj, self._name)
+        if not attribute._can_read:
+            raise Exception("Cannot read from property {}".format(self._name))
+        return attribute.get_value()
+
+    def __set__(self, obj, value):
+        attribute = obj._remote_attributes._attributes.get(self._name, None)
+        if not isinstance(attribute, RemoteProperty):
+            attribute = _get_member(obj, self._name)
+        if not attribute._can_write:
+            raise Exception("Cannot write to property {}".format(self._name))
+        attribute.set_value(value)
+
+class RemoteMemberDescriptor(object):
+    """
+    Data descriptor that returns a child object or function of a generated
+    RemoteObject class.
+    """
+    __slots__ = ('_name',)
+
+    def __init__(self, name):
+        self._name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        attribute = obj._remote_attributes._attributes.get(self._name, None)
+        if attribute is None or isinstance(attribute, dict):
+            attribute = _get_member(obj, self._name)
+        return attribute
+
+    def __set__(self, obj, value):
+        raise AttributeError("Cannot assign to {}".format(self._name))
+
+# Generated classes by (interface CRC, path of the object in the interface)
+_interface_classes = {}
+_interface_classes_lock = threading.Lock()
+
+def get_interface_class(json_data, json_crc, path):
+    """
+    Returns a subclass of RemoteObject that has a descriptor for each member
+    in json_data. Classes are cached per interface CRC and path, so all
+    objects of the same kind on devices with the same firmware share one
+    class.
+    """
+    # Unnamed members (such as the one for endpoint 0 at the root) can't be
+    # accessed as attributes, so they get no descriptor
+    members = [m for m in json_data.get("members", []) if m.get("name", None)]
+    names = tuple(m["name"] for m in members)
+    key = (json_crc, path)
+    _interface_classes_lock.acquire()
+    try:
+        entry = _interface_classes.get(key, None)
+        if entry is None or entry[0] != names:
+            class_dict = {'_interface_path': path, '__slots__': ()}
+            for member_json in members:
+                name = member_json["name"]
+                if member_json.get("type", None) in ("object", "function"):
+                    class_dict[name] = RemoteMemberDescriptor(name)
                 else:
-                    raise ObjectDefinitionError("no type information")
-            except ObjectDefinitionError as ex:
-                logger.debug("malformed member {}: {}".format(member_name, str(ex)))
-                continue
+                    class_dict[name] = RemotePropertyDescriptor(name)
+            entry = (names, type(str("RemoteObject"), (RemoteObject,), class_dict))
+            _interface_classes[key] = entry
+        return entry[1]
+    finally:
+        _interface_classes_lock.release()
+
+class RemoteObject(object):
+    """
+    Object with functions and properties that map to remote endpoints.
+    Instances are always of a class generated by get_interface_class(), which
+    provides the members as descriptors.
+    """
+    _interface_path = None
 
-            self._remote_attributes[member_name] = attribute
-            self.__dict__[member_name] = attribute
+    def __new__(cls, json_data, parent, channel, logger):
+        if cls is RemoteObject:
+            name = json_data.get("name", None) or ""
+            path = name if parent is None else parent._interface_path + "." + name
+            cls = get_interface_class(json_data, channel._interface_definition_crc, path)
+        return object.__new__(cls)
+
+    def __init__(self, json_data, parent, channel, logger):
+        """
+        Creates an object that implements the specified JSON type description by
+        communicating over the provided channel.
+        Members are instantiated on first access (see RemoteAttributes).
+        """
+        # Directly write to __dict__ to avoid calling __setattr__ too early
+        self.__dict__["__sealed__"] = False
+        self._remote_attributes = RemoteAttributes(json_data.get("members", []), self, channel, logger)
+        self.__channel__ = channel
+        self.__parent__ = parent
 
         # Ensure that from here on out assignments to undefined attributes
         # raise an exception
         self.__sealed__ = True
-        channel._channel_broken.subscribe(self._tear_down)
+        if parent is None:
+            # The root object tears down the whole tree
+            channel._channel_broken.subscribe(self._tear_down)
 
     def _dump(self, indent, depth):
         if depth <= 0:
@@ -226,39 +817,128 @@ class RemoteObject(object):
             lines.append(val_str)
         return "\n".join(lines)
 
+    def _resolve(self, item):
+        """
+        Returns the RemoteProperty referred to by item, which is either a
+        RemoteProperty or a dot-separated path relative to this object
+        (e.g. "axis0.encoder.pos_estimate").
+        """
+        if isinstance(item, RemoteProperty):
+            return item
+        obj = self
+        for name in item.split('.'):
+            attributes = object.__getattribute__(obj, "_remote_attributes") if isinstance(obj, RemoteObject) else {}
+            if name not in attributes:
+                raise AttributeError("Attribute {} not found".format(item))
+            obj = attributes[name]
+        if not isinstance(obj, RemoteProperty):
+            raise AttributeError("{} is not a property".format(item))
+        return obj
+
+    def unacked(self, ack_every=0):
+        """
+        Returns a context manager in which property writes on this object's
+        channel are sent without waiting for acknowledgements.
+        See UnackedWrites.
+        """
+        return UnackedWrites(self.__channel__, ack_every)
+
+    def read_many(self, items, return_exceptions=False):
+        """
+        Reads several properties with one round trip worth of latency.
+        items is a list of RemoteProperty handles or paths relative to this
+        object. All requests are sent back-to-back and the decoded values are
+        returned in order.
+        If any item fails, a BatchOperationError is raised that holds the
+        results and errors of all items. If return_exceptions is True, the
+        exceptions are returned in place of the failed values instead.
+        Properties with a valid entry in the read cache (see enable_cache())
+        are not requested from the device.
+        """
+        def begin(prop, arg):
+            if not prop._can_read:
+                raise Exception("Cannot read from property {}".format(prop._name))
+            cache = prop._cache
+            if cache is None:
+                return (prop._begin_get_value(), None, None, None)
+            hit, value, token = cache.lookup(prop)
+            if hit:
+                return (None, value, None, None)
+            return (prop._begin_get_value(), None, cache, token)
+        def end(prop, pending):
+            operation, value, cache, token = pending
+            if operation is None:
+                return value # cache hit
+            value = prop._end_get_value(operation)
+            if cache is not None:
+                cache.store(prop, value, token)
+            return value
+        return self._run_many([(item, None) for item in items], begin, end, return_exceptions)
+
+    def write_many(self, items, return_exceptions=False):
+        """
+        Writes several properties with one round trip worth of latency.
+        items is a list of (property, value) pairs or a dict, where property
+        is a RemoteProperty handle or a path relative to this object.
+        Failures are reported the same way as for read_many().
+        """
+        if isinstance(items, dict):
+            items = list(items.items())
+        def begin(prop, value):
+            if not prop._can_write:
+                raise Exception("Cannot write to property {}".format(prop._name))
+            return prop._begin_set_value(value)
+        def end(prop, operation):
+            operation.result()
+        self._run_many(items, begin, end, return_exceptions)
+
+    def _run_many(self, items, begin, end, return_exceptions):
+        """
+        Submits begin(property, arg) for each (item, arg) pair without waiting
+        and then collects end(property, operation) for each of them in order.
+        """
+        operations = []
+        for item, arg in items:
+            try:
+                prop = self._resolve(item)
+                operations.append((prop, begin(prop, arg), None))
+            except Exception as ex:
+                operations.append((None, None, ex))
+
+        results = []
+        errors = []
+        for prop, operation, error in operations:
+            if error is None:
+                try:
+                    results.append(end(prop, operation))
+                    errors.append(None)
+                    continue
+                except Exception as ex:
+                    error = ex
+            results.append(error if return_exceptions else None)
+            errors.append(error)
+
+        if not return_exceptions and any(e is not None for e in errors):
+            raise BatchOperationError(results, errors)
+        return results
+
     def __str__(self):
         return self._dump("", depth=2)
 
     def __repr__(self):
         return self.__str__()
 
-    def __getattribute__(self, name):
-        attr = object.__getattribute__(self, "_remote_attributes").get(name, None)
-        if isinstance(attr, RemoteProperty):
-            if attr._can_read:
-                return attr.get_value()
-            else:
-                raise Exception("Cannot read from property {}".format(name))
-        elif attr != None:
-            return attr
-        else:
-            return object.__getattribute__(self, name)
-            #raise AttributeError("Attribute {} not found".format(name))
-
     def __setattr__(self, name, value):
-        attr = object.__getattribute__(self, "_remote_attributes").get(name, None)
-        if isinstance(attr, RemoteProperty):
-            if attr._can_write:
-                attr.set_value(value)
-            else:
-                raise Exception("Cannot write to property {}".format(name))
-        elif not object.__getattribute__(self, "__sealed__") or name in object.__getattribute__(self, "__dict__"):
-            object.__getattribute__(self, "__dict__")[name] = value
-        else:
+        # Remote properties are handled by the descriptors of the class
+        if self.__sealed__ and name not in self.__dict__ and not hasattr(type(self), name):
             raise AttributeError("Attribute {} not found".format(name))
+        object.__setattr__(self, name, value)
 
     def _tear_down(self):
-        # Clear all remote members
-        for k in self._remote_attributes.keys():
-            self.__dict__.pop(k)
-        self._remote_attributes = {}
+        # Clear all remote members, including those of child objects that
+        # were already instantiated
+        attributes = self._remote_attributes
+        self._remote_attributes = RemoteAttributes([], self, self.__channel__, None)
+        for attribute in attributes._built_values():
+            if isinstance(attribute, RemoteObject):
+                attribute._tear_down()
@@ -0,0 +1,222 @@
+"""
+Fixed-rate sampling of remote properties in a background thread.
+
+Example:
+
+    sampler = fibre.sampler.Sampler(odrv0, ['vbus_voltage', 'axis0.encoder.pos_estimate'], rate=200)
+    sampler.start()
+    ...
+    timestamps, values = sampler.snapshot()
+    sampler.stop()
+
+The samples are scheduled against deadlines on the monotonic clock, so the
+sample rate doesn't drift with the time a read takes. All properties of one
+sample are read with pipelined operations, which takes a single round trip.
+Each sample carries the host timestamp (time.monotonic()) of the middle of
+that round trip.
+
+If NumPy is available, samples are stored in a preallocated NumPy array and
+snapshots are views into that array. Otherwise they are stored in Python
+lists and snapshots are copies.
+"""
+
+import time
+import threading
+
+from fibre.utils import Event, Logger, TimeoutError
+
+class SampleBuffer(object):
+    """
+    Ring buffer that holds the most recent `capacity` samples. Each sample
+    is a timestamp and `width` values.
+
+    With NumPy, every row is stored twice, at index i and i + capacity, so
+    the most recent samples are always contiguous and snapshot() can return
+    a view instead of a copy.
+    """
+    def __init__(self, capacity, width):
+        self.capacity = capacity
+        self.width = width
+        self.count = 0 # total number of samples ever appended
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        if numpy is not None:
+            self._data = numpy.zeros((2 * capacity, width + 1), dtype=numpy.float64)
+            self._rows = None
+        else:
+            self._data = None
+            self._rows = [None] * capacity
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, timestamp, values):
+        index = self.count % self.capacity
+        if self._data is not None:
+            self._data[index, 0] = timestamp
+            self._data[index, 1:] = values
+            self._data[index + self.capacity] = self._data[index]
+        else:
+            self._rows[index] = (timestamp, tuple(values))
+        self.count += 1
+
+    def snapshot(self, max_samples=None):
+        """
+        Returns a tuple (timestamps, values) with the most recent samples,
+        oldest first. With NumPy, timestamps is an array of shape (n,) and
+        values an array of shape (n, width). Both are views into the buffer,
+        so they show new samples overwriting the oldest rows after a while.
+        Copy them if they must stay unchanged. Without NumPy, they are lists.
+        """
+        count = self.count
+        n = min(count, self.capacity)
+        if max_samples is not None:
+            n = min(n, max_samples)
+        start = (count - n) % self.capacity
+        if self._data is not None:
+            rows = self._data[start:start + n]
+            return rows[:, 0], rows[:, 1:]
+        rows = [self._rows[(start + i) % self.capacity] for i in range(n)]
+        return [row[0] for row in rows], [row[1] for row in rows]
+
+class Sampler(object):
+    """
+    Samples remote properties at a fixed rate in a background thread.
+
+    obj, paths: The properties to sample. Each item of paths is either a
+        dot-separated path relative to the RemoteObject obj or a
+        RemoteProperty.
+    callback: Alternatively, a function that returns the values of one
+        sample as a sequence or as a single value. Its reads can't be
+        pipelined, so sampling properties through paths is faster.
+    rate: Target sample rate [Hz]. None samples as fast as possible.
+    capacity: Number of samples that are kept.
+    error_callback: Function that is invoked with the exception of every
+        sample that fails. By default, the error is logged as a warning.
+
+    If a sample fails, sampling resumes after retry_delay seconds.
+    """
+    retry_delay = 1.0 # [s]
+
+    def __init__(self, obj=None, paths=(), rate=100.0, capacity=1000, callback=None,
+                 cancellation_token=None, logger=Logger(verbose=False), error_callback=None):
+        if callback is None:
+            self._properties = [obj._resolve(path) for path in paths]
+            width = len(self._properties)
+        else:
+            self._properties = None
+            width = None # known after the first sample
+        self._callback = callback
+        self._rate = rate
+        self._capacity = capacity
+        self._buffer = None if width is None else SampleBuffer(capacity, width)
+        self._logger = logger
+        self._error_callback = error_callback
+        self._stop_event = Event(cancellation_token)
+        self._thread = None
+        self._start_time = None
+        self.missed_deadlines = 0 # number of sample times that were skipped because sampling fell behind
+        self.errors = 0
+
+    def start(self):
+        """
+        Starts sampling in a background thread. Returns self.
+        """
+        self._thread = threading.Thread(target=self._run, name="fibre sampler")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops sampling and waits for the background thread to exit.
+        """
+        self._stop_event.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def sample_count(self):
+        """
+        Total number of samples taken, including the ones that were dropped
+        from the buffer already.
+        """
+        return 0 if self._buffer is None else self._buffer.count
+
+    @property
+    def achieved_rate(self):
+        """
+        Sample rate [Hz] over the samples in the buffer, or None if there are
+        less than two.
+        """
+        timestamps, _ = self.snapshot()
+        if len(timestamps) < 2 or timestamps[-1] <= timestamps[0]:
+            return None
+        return (len(timestamps) - 1) / (timestamps[-1] - timestamps[0])
+
+    def snapshot(self, max_samples=None):
+        """
+        Returns a tuple (timestamps, values) with the most recent samples.
+        See SampleBuffer.snapshot().
+        """
+        if self._buffer is None:
+            return [], []
+        return self._buffer.snapshot(max_samples)
+
+    def _sample(self):
+        start = time.monotonic()
+        if self._callback is not None:
+            values = self._callback()
+            if not isinstance(values, (list, tuple)):
+                values = (values,)
+        else:
+            operations = [prop._begin_get_value() for prop in self._properties]
+            values = [prop._end_get_value(operation) for prop, operation in zip(self._properties, operations)]
+        timestamp = (start + time.monotonic()) / 2
+        if self._buffer is None:
+            self._buffer = SampleBuffer(self._capacity, len(values))
+        self._buffer.append(timestamp, values)
+
+    def _wait_until(self, deadline):
+        try:
+            self._stop_event.wait(max(deadline - time.monotonic(), 0))
+        except TimeoutError:
+            pass
+
+    def _run(self):
+        period = None if not self._rate else 1.0 / self._rate
+        deadline = time.monotonic()
+        while not self._stop_event.is_set():
+            try:
+                self._sample()
+            except Exception as ex:
+                self.errors += 1
+                if self._error_callback is not None:
+                    self._error_callback(ex)
+                else:
+                    self._logger.warn("sampling failed: {}".format(ex))
+                self._wait_until(time.monotonic() + self.retry_delay)
+                deadline = time.monotonic()
+                continue
+            if period is None:
+                continue
+            deadline += period
+            now = time.monotonic()
+            if now >= deadline + period:
+                # Fell behind by more than one period: skip the sample times
+                # that passed instead of sampling in a burst to catch up
+                missed = int((now - deadline) / period)
+                self.missed_deadlines += missed
+                deadline += missed * period
+            self._wait_until(deadline)
@@ -1,27 +1,205 @@
 """
 Provides classes that implement the StreamSource/StreamSink and
 PacketSource/PacketSink interfaces for serial ports.
+
+Path spec: serial:PORT[@OPTIONS], where PORT is a regular expression that
+matches the port name and OPTIONS is a colon-separated list of the baud
+rate and "low_latency". For example:
+
+    serial:/dev/ttyUSB0@921600:low_latency
 """
 
 import os
 import re
 import time
+import select
+import threading
 import traceback
 import serial
 import serial.tools.list_ports
 import fibre
+import fibre.hotplug
 from fibre.utils import TimeoutError
 
-# TODO: make this customizable
 DEFAULT_BAUDRATE = 115200
 
+class RingBuffer(object):
+    """
+    Fixed-size byte FIFO that a producer thread writes to and a consumer
+    thread reads from with a deadline. Once closed, readers get the
+    remaining bytes and then the exception that was passed to close().
+    """
+    def __init__(self, capacity):
+        self._data = bytearray(capacity)
+        self._capacity = capacity
+        self._start = 0 # index of the oldest byte
+        self._length = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._error = None
+
+    def __len__(self):
+        return self._length
+
+    def write(self, data):
+        """
+        Appends data. Blocks while the buffer is full. Data that is written
+        after close() is discarded.
+        """
+        data = memoryview(data)
+        with self._cond:
+            while len(data) and not self._closed:
+                while self._length == self._capacity and not self._closed:
+                    self._cond.wait()
+                end = (self._start + self._length) % self._capacity
+                n = min(len(data), self._capacity - self._length, self._capacity - end)
+                self._data[end:end + n] = data[:n]
+                self._length += n
+                data = data[n:]
+                self._cond.notify_all()
+
+    def read(self, min_bytes, max_bytes, deadline):
+        """
+        Waits until at least min_bytes are buffered and returns up to
+        max_bytes of them. If the deadline is reached first, returns
+        what is there. A deadline of None waits forever.
+        """
+        with self._cond:
+            while self._length < min_bytes and not self._closed:
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+            if self._length == 0 and self._closed and self._error is not None:
+                raise self._error
+            n = min(self._length, max_bytes)
+            end = self._start + n
+            if end <= self._capacity:
+                result = bytes(self._data[self._start:end])
+            else:
+                result = bytes(self._data[self._start:]) + bytes(self._data[:end - self._capacity])
+            self._start = end % self._capacity
+            self._length -= n
+            self._cond.notify_all()
+            return result
+
+    def close(self, error=None):
+        with self._cond:
+            self._closed = True
+            self._error = error
+            self._cond.notify_all()
+
 class SerialStreamTransport(fibre.protocol.StreamSource, fibre.protocol.StreamSink):
-    def __init__(self, port, baud):
-        self._dev = serial.Serial(port, baud, timeout=1)
+    """
+    Received bytes are drained from the port into a ring buffer, from which
+    reads are served. Reads wait with their deadline, which doesn't depend
+    on how pyserial implements timeouts:
+
+    - On POSIX systems, a read that finds the ring buffer empty waits for
+      the port's file descriptor with select() and then drains everything
+      that is waiting with a single system call.
+    - Elsewhere (or with reader_thread=True), a reader thread drains the
+      port as soon as data arrives and reads wait on the ring buffer. This
+      costs a thread switch per wake up.
+
+    low_latency: asks the driver to pass on received bytes right away
+    (e.g. FTDI adapters on Linux otherwise hold them back for up to 16ms).
+    Only supported on POSIX systems.
+    """
+    _buffer_size = 65536
+    # How often the reader thread checks if the port was closed [s] if
+    # pyserial can't interrupt a read
+    _poll_interval = 0.5
+
+    def __init__(self, port, baud, low_latency=False, logger=None, reader_thread=None):
+        self._dev = serial.Serial(port, baud, timeout=self._poll_interval)
+        if low_latency:
+            try:
+                self._dev.set_low_latency_mode(True)
+            except (AttributeError, NotImplementedError, ValueError, IOError) as ex:
+                if logger is not None:
+                    logger.debug("could not enable low latency mode on {}: {}".format(port, ex))
+        self._rx_buffer = RingBuffer(self._buffer_size)
+        self._closed = False
+        self._close_lock = threading.Lock()
+        self._active_drains = 0 # number of threads that may be in select()
+        self._thread = None
+        self._fd = None
+        if reader_thread is None:
+            reader_thread = not hasattr(self._dev, 'fileno')
+        if reader_thread:
+            self._thread = threading.Thread(target=self._reader_thread, name="fibre serial reader")
+            self._thread.daemon = True
+            self._thread.start()
+        else:
+            self._fd = self._dev.fileno()
+            # close() writes to this pipe to interrupt select()
+            self._wake_r, self._wake_w = os.pipe()
+
+    def _reader_thread(self):
+        error = fibre.protocol.ChannelBrokenException()
+        try:
+            while not self._closed:
+                # Returns as soon as the first byte arrives, along with
+                # everything else that is waiting
+                data = self._dev.read(max(self._dev.in_waiting, 1))
+                if data:
+                    self._rx_buffer.write(data)
+        except Exception as ex:
+            if not self._closed:
+                error = fibre.protocol.ChannelBrokenException(str(ex))
+        finally:
+            self._rx_buffer.close(error)
 
     def process_bytes(self, bytes):
         self._dev.write(bytes)
 
+    def _drain(self, min_bytes, deadline):
+        """
+        Waits until the ring buffer plus the port hold at least min_bytes
+        and moves everything that is waiting in the port to the ring buffer.
+        """
+        with self._close_lock:
+            if self._closed:
+                raise fibre.protocol.ChannelBrokenException()
+            self._active_drains += 1
+        try:
+            while len(self._rx_buffer) < min_bytes:
+                if self._closed:
+                    raise fibre.protocol.ChannelBrokenException()
+                timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+                try:
+                    readable, _, _ = select.select([self._fd, self._wake_r], [], [], timeout)
+                    if self._wake_r in readable:
+                        raise fibre.protocol.ChannelBrokenException()
+                    if not readable:
+                        return # deadline reached
+                    data = os.read(self._fd, self._buffer_size - len(self._rx_buffer))
+                except BlockingIOError:
+                    continue # pyserial opens the port in non-blocking mode
+                except (OSError, ValueError) as ex:
+                    raise fibre.protocol.ChannelBrokenException(str(ex))
+                if not data:
+                    raise fibre.protocol.ChannelBrokenException("the port was closed")
+                self._rx_buffer.write(data)
+        finally:
+            with self._close_lock:
+                self._active_drains -= 1
+                self._close_wake_pipe()
+
+    def _close_wake_pipe(self):
+        """
+        Closes the wake up pipe once the port is closed and no thread is
+        waiting on it anymore. Must be called with _close_lock held.
+        """
+        if self._closed and self._active_drains == 0 and self._wake_r is not None:
+            os.close(self._wake_r)
+            os.close(self._wake_w)
+            self._wake_r = self._wake_w = None
+
     def get_bytes(self, n_bytes, deadline):
         """
         Returns n bytes unless the deadline is reached, in which case the bytes
@@ -29,11 +207,19 @@ class SerialStreamTransport(fibre.protocol.StreamSource, fibre.protocol.StreamSi
         function blocks forever. A deadline before the current time corresponds
         to non-blocking mode.
         """
-        if deadline is None:
-            self._dev.timeout = None
-        else:
-            self._dev.timeout = max(deadline - time.monotonic(), 0)
-        return self._dev.read(n_bytes)
+        if self._fd is not None:
+            self._drain(n_bytes, deadline)
+        return self._rx_buffer.read(n_bytes, n_bytes, deadline)
+
+    def get_available_bytes(self, max_bytes, deadline):
+        """
+        Returns everything that was received so far (up to max_bytes). If
+        nothing was received, this blocks until the first byte arrives or the
+        deadline is reached.
+        """
+        if self._fd is not None:
+            self._drain(1, deadline)
+        return self._rx_buffer.read(1, max_bytes, deadline)
 
     def get_bytes_or_fail(self, n_bytes, deadline):
         result = self.get_bytes(n_bytes, deadline)
@@ -42,6 +228,24 @@ class SerialStreamTransport(fibre.protocol.StreamSource, fibre.protocol.StreamSi
         return result
 
     def close(self):
+        """
+        Closes the port. Reads that are in progress fail with a
+        ChannelBrokenException. Calling this more than once has no effect.
+        """
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self._fd is not None:
+                os.write(self._wake_w, b'\0') # interrupts select() in _drain()
+                self._close_wake_pipe()
+        self._rx_buffer.close(fibre.protocol.ChannelBrokenException()) # unblocks the reader thread if the buffer is full
+        if self._thread is not None:
+            try:
+                self._dev.cancel_read()
+            except (AttributeError, NotImplementedError):
+                pass # the reader thread notices within _poll_interval
+            self._thread.join()
         self._dev.close()
 
 
@@ -55,47 +259,72 @@ def find_pyserial_ports():
     return [x.device for x in serial.tools.list_ports.comports()]
 
 
-def discover_channels(path, serial_number, callback, cancellation_token, channel_termination_token, logger):
+def discover_channels(path, serial_number, callback, cancellation_token, channel_termination_token, logger,
+                      enumerate_ports=None, monitor=None):
     """
-    Scans for serial ports that match the path spec.
+    Scans for serial ports that match the path spec (see the top of this file).
     This function blocks until cancellation_token is set.
     Channels spawned by this function run until channel_termination_token is set.
+    The ports are rescanned when a tty device appears (see fibre.hotplug).
+    enumerate_ports: function that returns the names of all serial ports
+    monitor: hotplug monitor, defaults to fibre.hotplug.create_monitor()
     """
-    if path == None:
+    baud = DEFAULT_BAUDRATE
+    low_latency = False
+    if path:
+        path, _, options = path.partition('@')
+        for option in options.split(':') if options else []:
+            if option == 'low_latency':
+                low_latency = True
+            else:
+                try:
+                    baud = int(option)
+                except ValueError:
+                    raise Exception("{} is not a valid serial port option. Expected "
+                                    "a baud rate or \"low_latency\".".format(option))
+    if not path:
         # This regex should match all desired port names on macOS,
         # Linux and Windows but might match some incorrect port names.
         regex = r'^(/dev/tty\.usbmodem.*|/dev/ttyACM.*|COM[0-9]+)$'
     else:
         regex = "^" + path + "$"
+    regex = re.compile(regex)
+    if enumerate_ports is None:
+        enumerate_ports = lambda: find_pyserial_ports() + find_dev_serial_ports()
+    if monitor is None:
+        monitor = fibre.hotplug.create_monitor(('tty',), cancellation_token, logger)
 
-    known_devices = []
+    known_devices = set()
     def device_matcher(port_name):
         if port_name in known_devices:
             return False
-        return bool(re.match(regex, port_name))
+        return bool(regex.match(port_name))
 
     def did_disconnect(port_name, device):
         device.close()
-        # TODO: yes there is a race condition here in case you wonder.
-        known_devices.pop(known_devices.index(port_name))
+        known_devices.discard(port_name)
 
-    while not cancellation_token.is_set():
-        all_ports = find_pyserial_ports() + find_dev_serial_ports()
-        new_ports = filter(device_matcher, all_ports)
-        for port_name in new_ports:
+    def scan():
+        ports = set(enumerate_ports())
+        # Ports that disappeared may show up again under the same name
+        known_devices.intersection_update(ports)
+        for port_name in filter(device_matcher, ports):
             try:
-                serial_device = SerialStreamTransport(port_name, DEFAULT_BAUDRATE)
+                serial_device = SerialStreamTransport(port_name, baud, low_latency, logger)
                 input_stream = fibre.protocol.PacketFromStreamConverter(serial_device)
                 output_stream = fibre.protocol.StreamBasedPacketSink(serial_device)
                 channel = fibre.protocol.Channel(
-                        "serial port {}@{}".format(port_name, DEFAULT_BAUDRATE),
+                        "serial port {}@{}".format(port_name, baud),
                         input_stream, output_stream, channel_termination_token, logger)
                 channel.serial_device = serial_device
             except serial.serialutil.SerialException:
                 logger.debug("Serial device init failed. Ignoring this port. More info: " + traceback.format_exc())
-                known_devices.append(port_name)
+                known_devices.add(port_name)
             else:
-                known_devices.append(port_name)
-                channel._channel_broken.subscribe(lambda: did_disconnect(port_name, serial_device))
+                known_devices.add(port_name)
+                channel._channel_broken.subscribe(
+                        lambda port_name=port_name, serial_device=serial_device: did_disconnect(port_name, serial_device))
                 callback(channel)
-        time.sleep(1)
+        return False
+
+    fibre.hotplug.discovery_loop(scan, monitor, cancellation_token)
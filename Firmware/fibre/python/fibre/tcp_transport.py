@@ -46,6 +46,23 @@ class TCPTransport(fibre.protocol.StreamSource, fibre.protocol.StreamSink):
       except socket.timeout:
         raise TimeoutError
 
+  def get_available_bytes(self, max_bytes, deadline):
+    """
+    Returns whatever the socket has received so far (up to max_bytes). If
+    nothing was received yet, this blocks until some data arrives or the
+    deadline is reached, in which case an empty result is returned.
+    """
+    timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+    self.sock.settimeout(timeout)
+    try:
+      data = self.sock.recv(max_bytes)
+    except (socket.timeout, BlockingIOError):
+      return bytes()
+    if len(data) == 0:
+      # the remote end closed the connection
+      raise fibre.protocol.ChannelBrokenException()
+    return data
+
   def get_bytes_or_fail(self, n_bytes, deadline):
     result = self.get_bytes(n_bytes, deadline)
     if len(result) < n_bytes:
@@ -82,4 +99,7 @@ def discover_channels(path, serial_number, callback, cancellation_token, channel
     else:
       callback(channel)
       wait_any(None, cancellation_token, channel._channel_broken)
-    time.sleep(1)
+    try:
+      cancellation_token.wait(timeout=1)
+    except TimeoutError:
+      pass
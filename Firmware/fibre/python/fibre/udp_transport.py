@@ -4,7 +4,7 @@ import socket
 import time
 import traceback
 import fibre.protocol
-from fibre.utils import wait_any
+from fibre.utils import wait_any, TimeoutError
 
 def noprint(x):
   pass
@@ -54,4 +54,7 @@ def discover_channels(path, serial_number, callback, cancellation_token, channel
     else:
       callback(channel)
       wait_any(None, cancellation_token, channel._channel_broken)
-    time.sleep(1)
+    try:
+      cancellation_token.wait(timeout=1)
+    except TimeoutError:
+      pass
@@ -5,7 +5,10 @@ import usb.core
 import usb.util
 import sys
 import time
+import ctypes
+import threading
 import fibre.protocol
+import fibre.hotplug
 import traceback
 import platform
 from fibre.utils import TimeoutError
@@ -18,13 +21,177 @@ WELL_KNOWN_VID_PID_PAIRS = [
   (0x1209, 0x0D33)
 ]
 
+# Status codes of asynchronous transfers (same values as libusb_transfer_status)
+TRANSFER_COMPLETED = 0
+TRANSFER_ERROR = 1
+TRANSFER_TIMED_OUT = 2
+TRANSFER_CANCELLED = 3
+TRANSFER_STALL = 4
+TRANSFER_NO_DEVICE = 5
+TRANSFER_OVERFLOW = 6
+
+class _Timeval(ctypes.Structure):
+  _fields_ = [('tv_sec', ctypes.c_long), ('tv_usec', ctypes.c_long)]
+
+class _LibusbTransfer(object):
+  def __init__(self, pointer, buffer, callback):
+    self.pointer = pointer # POINTER(libusb_transfer)
+    self.buffer = buffer
+    self.callback = callback # ctypes doesn't keep the callback alive by itself
+
+class LibusbAsyncIO(object):
+  """
+  Bulk transfers through the asynchronous API of libusb 1.0, which pyusb
+  doesn't expose. This uses the library and the device handle of pyusb's
+  libusb1 backend. Raises NotImplementedError if the device uses another
+  backend.
+
+  Transfers are opaque objects. Their callback(transfer, status, data) is
+  called from within handle_events() with one of the TRANSFER_* status
+  codes and a copy of the received data. libusb may also run it on another
+  thread that is waiting for a synchronous transfer of the same device.
+  Objects with the same methods can stand in for this class (see
+  USBBulkTransport).
+  """
+  def __init__(self, dev):
+    try:
+      import usb.backend.libusb1 as libusb1
+    except ImportError as ex:
+      raise NotImplementedError(str(ex))
+    if not isinstance(dev.backend, libusb1._LibUSB):
+      raise NotImplementedError("the {} backend has no asynchronous API".format(type(dev.backend).__name__))
+    self._libusb1 = libusb1
+    self._lib = dev.backend.lib
+    self._ctx = dev.backend.ctx
+    dev._ctx.managed_open()
+    self._handle = dev._ctx.handle.handle
+    # pyusb doesn't declare these functions
+    self._lib.libusb_cancel_transfer.argtypes = [ctypes.POINTER(libusb1._libusb_transfer)]
+    self._lib.libusb_handle_events_timeout.argtypes = [ctypes.c_void_p, ctypes.POINTER(_Timeval)]
+
+  def alloc_transfer(self, endpoint, length, callback):
+    """
+    Allocates a bulk transfer of up to length bytes on the specified endpoint.
+    """
+    def on_done(pointer):
+      transfer = pointer.contents
+      callback(result, transfer.status, ctypes.string_at(transfer.buffer, transfer.actual_length))
+    pointer = self._lib.libusb_alloc_transfer(0)
+    if not pointer:
+      raise MemoryError()
+    result = _LibusbTransfer(pointer, ctypes.create_string_buffer(length),
+                             self._libusb1._libusb_transfer_cb_fn_p(on_done))
+    transfer = pointer.contents
+    transfer.dev_handle = self._handle
+    transfer.endpoint = endpoint
+    transfer.type = self._libusb1._LIBUSB_TRANSFER_TYPE_BULK
+    transfer.timeout = 0 # no timeout
+    transfer.buffer = ctypes.addressof(result.buffer)
+    transfer.length = length
+    transfer.callback = result.callback
+    return result
+
+  def submit(self, transfer):
+    self._libusb1._check(self._lib.libusb_submit_transfer(transfer.pointer))
+
+  def cancel(self, transfer):
+    """
+    Cancels a submitted transfer. Its callback is still called, with the
+    status TRANSFER_CANCELLED (unless it completed in the meantime).
+    """
+    ret = self._lib.libusb_cancel_transfer(transfer.pointer)
+    if ret != self._libusb1.LIBUSB_ERROR_NOT_FOUND: # not pending anymore
+      self._libusb1._check(ret)
+
+  def free(self, transfer):
+    self._lib.libusb_free_transfer(transfer.pointer)
+    transfer.pointer = None
+
+  def handle_events(self, timeout):
+    """
+    Runs the callbacks of completed transfers. Blocks for at most
+    timeout [s] if there are none.
+    """
+    tv = _Timeval(int(timeout), int((timeout % 1) * 1e6))
+    ret = self._lib.libusb_handle_events_timeout(self._ctx, ctypes.byref(tv))
+    if ret != self._libusb1.LIBUSB_ERROR_INTERRUPTED:
+      self._libusb1._check(ret)
+
+class _BulkWriter(fibre.protocol.PacketSink):
+  """
+  Writes each packet as one bulk transfer to the OUT endpoint of a USBBulkTransport.
+  """
+  def __init__(self, transport):
+    self._transport = transport
+
+  def process_packet(self, packet):
+    return self._transport._write_transfer(packet)
+
 class USBBulkTransport(fibre.protocol.PacketSource, fibre.protocol.PacketSink):
-  def __init__(self, dev, logger):
+  # Largest packet that can be sent as a single bulk transfer. The remote end
+  # must be told about packets larger than DEFAULT_MTU through Channel.negotiate_mtu().
+  max_mtu = 512
+  # Round trips take about a millisecond. A resend timeout of a few
+  # milliseconds makes a lost packet barely noticeable.
+  min_resend_timeout = 0.005 # [s]
+  # Number of IN transfers that are kept queued through libusb's asynchronous
+  # API, so that the host keeps polling the device between two transfers.
+  # With 0, the channel's receiver thread reads one transfer at a time.
+  in_transfers = 0
+  # The receive path gives up after this many failed transfers in a row
+  max_receive_errors = 10
+  # If not None, packets are sent with the stream framing (like on UART)
+  # instead of one packet per transfer, and several of them are packed into
+  # a single bulk transfer of up to wMaxPacketSize bytes. A packet is held
+  # back for at most this long [s], or until someone waits for an ACK.
+  # Requires firmware that was built with CONFIG_USB_PROTOCOL=native-stream,
+  # which answers stream framed requests on the native interface's IN
+  # endpoint. Firmware built with the default (native) protocol doesn't
+  # understand the stream framing and won't respond.
+  coalesce_delay = None
+
+  def __init__(self, dev, logger, in_transfers=None, async_io=None, coalesce_delay=None):
+    """
+    in_transfers, coalesce_delay: override the class attributes of the same name
+    async_io: LibusbAsyncIO or an object with the same methods (e.g. a mock
+              for testing). By default, a LibusbAsyncIO is created for dev
+              when needed.
+    """
     self._logger = logger
     self.dev = dev
     self.intf = None
     self._name = "USB device {}:{}".format(dev.idVendor, dev.idProduct)
     self._was_damaged = False
+    self._mtu = fibre.protocol.DEFAULT_MTU
+    self._metrics = None
+    if in_transfers is not None:
+      self.in_transfers = in_transfers
+    if coalesce_delay is not None:
+      self.coalesce_delay = coalesce_delay
+    self._async_io = async_io
+    self._framer = None # set up by init() if coalesce_delay is not None
+    self._coalescer = None
+    self._rx_packets = fibre.protocol.PacketQueue()
+    self._segmenter = None
+
+  def set_mtu(self, mtu):
+    self._mtu = mtu
+    if self._framer is not None:
+      self._framer.set_mtu(mtu)
+    if self._segmenter is not None:
+      self._segmenter.set_mtu(mtu)
+
+  def attach_metrics(self, metrics):
+    self._metrics = metrics
+    if self._segmenter is not None:
+      self._segmenter._metrics = metrics
+
+  def flush(self):
+    """
+    Sends the packets that are held back to coalesce them.
+    """
+    if self._coalescer is not None:
+      self._coalescer.flush()
 
   ##
   # information about the connected device
@@ -89,11 +256,23 @@ class USBBulkTransport(fibre.protocol.PacketSource, fibre.protocol.PacketSink):
     assert self.epr is not None
     self._logger.debug("EndpointAddress for reading {}".format(self.epr.bEndpointAddress))
 
+    if self.coalesce_delay is not None and self._framer is None:
+      self._coalescer = fibre.protocol.StreamCoalescer(_BulkWriter(self), self.epw.wMaxPacketSize, self.coalesce_delay)
+      self._framer = fibre.protocol.StreamBasedPacketSink(self._coalescer)
+      self._framer.set_mtu(self._mtu)
+      self._segmenter = fibre.protocol.StreamToPacketSegmenter(self._rx_packets, self._mtu)
+      self._segmenter._metrics = self._metrics
+
   def deinit(self):
     if not self.intf is None:
       usb.util.release_interface(self.dev, self.intf)
 
-  def process_packet(self, usbBuffer):
+  def process_packet(self, packet):
+    if self._framer is not None:
+      return self._framer.process_packet(packet)
+    return self._write_transfer(packet)
+
+  def _write_transfer(self, usbBuffer):
     try:
       ret = self.epw.write(usbBuffer, 0)
       if self._was_damaged:
@@ -121,8 +300,33 @@ class USBBulkTransport(fibre.protocol.PacketSource, fibre.protocol.PacketSink):
         raise fibre.protocol.ChannelDamagedException()
 
   def get_packet(self, deadline):
+    if self._segmenter is not None:
+      # The stream framing doesn't care about transfer boundaries, so a
+      # transfer may contain several packets or a part of one
+      while not len(self._rx_packets):
+        self._segmenter.process_bytes(self._read_transfer(self.epr.wMaxPacketSize, deadline))
+      return self._rx_packets.pop()
+    # Once a larger MTU was negotiated, responses can span multiple USB packets
+    bufferLen = self.epr.wMaxPacketSize
+    if self._mtu > fibre.protocol.DEFAULT_MTU:
+      bufferLen = max(bufferLen, self._mtu)
+    ret = self._read_transfer(bufferLen, deadline)
+    if len(ret) == 0:
+      raise TimeoutError() # zero length packet that terminated a response of a multiple of the packet size
+    # A transfer that filled its buffer may have been cut short: the read
+    # may have started with a smaller buffer before the MTU was raised.
+    # The rest of the response follows in the next transfer.
+    while (len(ret) == bufferLen and self._mtu > fibre.protocol.DEFAULT_MTU and
+           len(ret) < self._mtu):
+      bufferLen = self._mtu - len(ret)
+      chunk = self._read_transfer(bufferLen, deadline)
+      ret += chunk
+      if len(chunk) == 0:
+        break # terminated by a zero length packet
+    return ret
+
+  def _read_transfer(self, bufferLen, deadline):
     try:
-      bufferLen = self.epr.wMaxPacketSize
       timeout = max(int((deadline - time.monotonic()) * 1000), 0)
       ret = self.epr.read(bufferLen, timeout)
       if self._was_damaged:
@@ -149,12 +353,147 @@ class USBBulkTransport(fibre.protocol.PacketSource, fibre.protocol.PacketSink):
         self._was_damaged = True
         raise fibre.protocol.ChannelDamagedException()
 
+  def start_receiving(self, sink, broken):
+    """
+    Queues in_transfers asynchronous IN transfers and hands every received
+    packet to sink.process_packet() from the completion callbacks. Returns
+    False if this mode is disabled or not supported by the pyusb backend, in
+    which case packets must be read with get_packet().
+    The transfers are cancelled once the Event broken is set. The transport
+    sets it itself if the device fails.
+    """
+    if not self.in_transfers:
+      return False
+    if self._async_io is None:
+      try:
+        self._async_io = LibusbAsyncIO(self.dev)
+      except NotImplementedError as ex:
+        self._logger.debug("asynchronous USB transfers not available, using synchronous reads: {}".format(ex))
+        return False
+    usb.util.claim_interface(self.dev, self.intf)
+    self._sink = sink
+    self._broken = broken
+    self._error_ctr = 0
+    self._partial = bytearray()
+    if self._segmenter is not None:
+      # Received frames go straight to the sink
+      self._segmenter = fibre.protocol.StreamToPacketSegmenter(sink, self._mtu)
+      self._segmenter._metrics = self._metrics
+    # Each transfer takes a single USB packet, so responses that span
+    # multiple packets are reassembled in _on_transfer_done
+    self._packet_size = self.epr.wMaxPacketSize
+    self._all_transfers = [self._async_io.alloc_transfer(self.epr.bEndpointAddress,
+                                                         self._packet_size, self._on_transfer_done)
+                           for _ in range(self.in_transfers)]
+    self._pending = set()
+    for transfer in self._all_transfers:
+      self._resubmit(transfer)
+    t = threading.Thread(target=self._event_thread, name="fibre USB events")
+    t.daemon = True
+    t.start()
+    return True
+
+  def _resubmit(self, transfer):
+    try:
+      self._async_io.submit(transfer)
+    except usb.core.USBError as ex:
+      self._logger.debug("{}: failed to submit IN transfer: {}".format(self._name, ex))
+      self._broken.set()
+      return
+    self._pending.add(transfer)
+
+  def _on_transfer_done(self, transfer, status, data):
+    self._pending.discard(transfer)
+    if status == TRANSFER_CANCELLED:
+      return
+    if status == TRANSFER_COMPLETED:
+      if self._error_ctr > 0:
+        self._error_ctr -= 1
+    elif status in (TRANSFER_NO_DEVICE, TRANSFER_STALL):
+      self._logger.debug("{}: IN transfer failed with status {}".format(self._name, status))
+      self._broken.set()
+      return
+    else:
+      if self._metrics is not None:
+        self._metrics.receive_errors += 1
+      self._error_ctr += 1
+      if self._error_ctr >= self.max_receive_errors:
+        self._logger.debug("{}: too many failed IN transfers".format(self._name))
+        self._broken.set()
+        return
+      data = None
+    # data is a copy, so the transfer can be resubmitted before the packet
+    # is processed
+    if not self._broken.is_set():
+      self._resubmit(transfer)
+    try:
+      if self._segmenter is not None:
+        if data:
+          self._segmenter.process_bytes(data)
+      else:
+        self._deliver_packet(data)
+    except Exception:
+      self._logger.debug("{}: failed to process packet: {}".format(self._name, traceback.format_exc()))
+      self._broken.set()
+
+  def _deliver_packet(self, data):
+    if not data and not self._partial:
+      return
+    # A full USB packet is continued in the next one if the MTU allows for
+    # larger responses
+    if (data is not None and len(data) == self._packet_size and
+        self._mtu > fibre.protocol.DEFAULT_MTU and len(self._partial) + len(data) < self._mtu):
+      self._partial += data
+      return
+    if self._partial:
+      if data is None:
+        self._logger.debug("{}: dropping incomplete packet".format(self._name))
+        self._partial = bytearray()
+        return
+      data = self._partial + data
+      self._partial = bytearray()
+    self._sink.process_packet(data)
+
+  def _event_thread(self):
+    try:
+      while not self._broken.is_set():
+        self._async_io.handle_events(0.1)
+    except Exception:
+      self._logger.debug("{}: USB event thread failed: {}".format(self._name, traceback.format_exc()))
+    finally:
+      self._broken.set()
+      self._cancel_transfers()
 
-def discover_channels(path, serial_number, callback, cancellation_token, channel_termination_token, logger):
+  def _cancel_transfers(self):
+    for transfer in list(self._pending):
+      try:
+        self._async_io.cancel(transfer)
+      except usb.core.USBError:
+        pass # the callback still reports it
+    deadline = time.monotonic() + 1.0
+    while self._pending and time.monotonic() < deadline:
+      try:
+        self._async_io.handle_events(0.1)
+      except usb.core.USBError:
+        break
+    # Transfers that didn't complete can't be freed safely
+    for transfer in self._all_transfers:
+      if transfer not in self._pending:
+        self._async_io.free(transfer)
+
+
+def discover_channels(path, serial_number, callback, cancellation_token, channel_termination_token, logger,
+                      enumerate_devices=None, monitor=None, in_transfers=None, coalesce_delay=None):
   """
   Scans for USB devices that match the path spec.
   This function blocks until cancellation_token is set.
   Channels spawned by this function run until channel_termination_token is set.
+  The bus is rescanned when a USB device is plugged in (see fibre.hotplug).
+  enumerate_devices: function that returns the attached devices, defaults
+                     to pyusb's usb.core.find(find_all=True)
+  monitor: hotplug monitor, defaults to fibre.hotplug.create_monitor()
+  in_transfers: number of queued IN transfers, see USBBulkTransport.in_transfers
+  coalesce_delay: see USBBulkTransport.coalesce_delay
   """
   if path == None or path == "":
     bus = None
@@ -168,30 +507,47 @@ def discover_channels(path, serial_number, callback, cancellation_token, channel
                       "Expected a string of the format BUS:DEVICE where BUS "
                       "and DEVICE are integers.".format(path))
   
-  known_devices = []
+  if enumerate_devices is None:
+    enumerate_devices = lambda: usb.core.find(find_all=True)
+  if monitor is None:
+    monitor = fibre.hotplug.create_monitor(('usb',), cancellation_token, logger)
+
+  known_devices = set()
+  serial_numbers = {} # reading a serial number takes a control transfer, so they're cached
   def device_matcher(device):
     #print("  test {:04X}:{:04X}".format(device.idVendor, device.idProduct))
     try:
-      if (device.bus, device.address) in known_devices:
+      key = (device.bus, device.address)
+      if key in known_devices:
         return False
       if bus != None and device.bus != bus:
         return False
       if address != None and device.address != address:
         return False
-      if serial_number != None and device.serial_number != serial_number:
-        return False
       if (device.idVendor, device.idProduct) not in WELL_KNOWN_VID_PID_PAIRS:
         return False
+      if serial_number != None:
+        if not key in serial_numbers:
+          serial_numbers[key] = device.serial_number
+        if serial_numbers[key] != serial_number:
+          return False
     except:
       return False
     return True
 
-  while not cancellation_token.is_set():
+  def scan():
     logger.debug("USB discover loop")
-    devices = usb.core.find(find_all=True, custom_match=device_matcher)
-    for usb_device in devices:
+    retry = False
+    devices = list(enumerate_devices())
+    # Forget devices that were unplugged. Their bus address may be reused.
+    present = set((device.bus, device.address) for device in devices)
+    known_devices.intersection_update(present)
+    for key in list(serial_numbers.keys()):
+      if key not in present:
+        del serial_numbers[key]
+    for usb_device in filter(device_matcher, devices):
       try:
-        bulk_device = USBBulkTransport(usb_device, logger)
+        bulk_device = USBBulkTransport(usb_device, logger, in_transfers, coalesce_delay=coalesce_delay)
         logger.debug(bulk_device.info())
         bulk_device.init()
         channel = fibre.protocol.Channel(
@@ -201,15 +557,19 @@ def discover_channels(path, serial_number, callback, cancellation_token, channel
       except usb.core.USBError as ex:
         if ex.errno == 13:
           logger.debug("USB device access denied. Did you set up your udev rules correctly?")
+          retry = True
           continue
         elif ex.errno == 16:
           logger.debug("USB device busy. I'll reset it and try again.")
           usb_device.reset()
+          retry = True
           continue
         else:
           logger.debug("USB device init failed. Ignoring this device. More info: " + traceback.format_exc())
-          known_devices.append((usb_device.bus, usb_device.address))
+          known_devices.add((usb_device.bus, usb_device.address))
       else:
-        known_devices.append((usb_device.bus, usb_device.address))
+        known_devices.add((usb_device.bus, usb_device.address))
         callback(channel)
-    time.sleep(1)
+    return retry
+
+  fibre.hotplug.discovery_loop(scan, monitor, cancellation_token)
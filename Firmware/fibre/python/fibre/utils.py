@@ -24,42 +24,67 @@ else:
     TimeoutError = TimeoutError
 
 def get_serial_number_str(device):
-    if hasattr(device, 'serial_number'):
-        return format(device.serial_number, 'x').upper()
+    serial_number = getattr(device, 'serial_number', None)
+    if serial_number is not None:
+        return format(serial_number, 'x').upper()
     else:
         return "[unknown serial number]"
 
 ## Threading utils ##
+class EventGroup():
+    """
+    A set of events that share one condition variable. A thread can wait
+    for any or all events of a group (see wait_any() and wait_all()) by
+    waiting on that condition variable, without subscribing to the events.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+
+    def event(self, trigger=None):
+        """
+        Creates a new event in this group. See Event.
+        """
+        return Event(trigger, group=self)
+
 class Event():
     """
     Alternative to threading.Event(), enhanced by the subscribe() function
     that the original fails to provide.
     @param Trigger: if supplied, the newly created event will be triggered
                     as soon as the trigger event becomes set
+    @param group: the EventGroup that this event belongs to. By default,
+                  every event is in a group of its own.
     """
-    def __init__(self, trigger=None):
-        self._evt = threading.Event()
+    def __init__(self, trigger=None, group=None):
+        self._group = group or EventGroup()
+        self._cond = self._group._cond
+        self._is_set = False
         self._subscribers = []
-        self._mutex = threading.Lock()
+        self._waiters = [] # condition variables of threads that wait across groups
         if not trigger is None:
             trigger.subscribe(lambda: self.set())
 
     def is_set(self):
-        return self._evt.is_set()
+        return self._is_set
 
     def set(self):
         """
         Sets the event and invokes all subscribers if the event was
         not already set
         """
-        self._mutex.acquire()
-        try:
-            if not self._evt.is_set():
-                self._evt.set()
-                for s in self._subscribers:
-                    s()
-        finally:
-            self._mutex.release()
+        with self._cond:
+            if self._is_set:
+                return
+            self._is_set = True
+            self._cond.notify_all()
+            subscribers = self._subscribers
+            self._subscribers = []
+            waiters = list(self._waiters)
+        for waiter in waiters:
+            with waiter:
+                waiter.notify_all()
+        for s in subscribers:
+            s()
 
     def subscribe(self, handler):
         """
@@ -70,57 +95,92 @@ class Event():
         """
         if handler is None:
             raise TypeError
-        self._mutex.acquire()
-        try:
-            self._subscribers.append(handler)
-            if self._evt.is_set():
-                handler()
-        finally:
-            self._mutex.release()
+        with self._cond:
+            if not self._is_set:
+                self._subscribers.append(handler)
+                return handler
+        handler()
         return handler
     
     def unsubscribe(self, handler):
-        self._mutex.acquire()
-        try:
-            self._subscribers.pop(self._subscribers.index(handler))
-        finally:
-            self._mutex.release()
+        with self._cond:
+            if handler in self._subscribers:
+                self._subscribers.remove(handler)
 
-    def wait(self, timeout=None):
-        if not self._evt.wait(timeout=timeout):
-            raise TimeoutError()
+    def wait(self, timeout=None, deadline=None):
+        """
+        Blocks until the event is set. Raises a TimeoutError if the timeout
+        [s] or the deadline (in time.monotonic() time) is reached first.
+        """
+        _wait_for((self,), lambda: self._is_set, timeout, deadline)
 
     def trigger_after(self, timeout):
         """
         Triggers the event after the specified timeout.
         This function returns immediately.
         """
-        def delayed_trigger():
-            if not self.wait(timeout=timeout):
-                self.set()
-        threading.Thread(target=delayed_trigger)
+        t = threading.Timer(timeout, self.set)
         t.daemon = True
         t.start()
-        
+        return t
 
-def wait_any(timeout=None, *events):
+def _wait_for(events, predicate, timeout, deadline):
+    if timeout is not None:
+        timeout_deadline = time.monotonic() + timeout
+        deadline = timeout_deadline if deadline is None else min(deadline, timeout_deadline)
+    conds = set(event._cond for event in events)
+    if len(conds) == 1:
+        # Common case: all events are in one group
+        cond = conds.pop()
+        registered = False
+    else:
+        # Have all events notify a condition variable of our own
+        cond = threading.Condition()
+        for event in events:
+            with event._cond:
+                event._waiters.append(cond)
+        registered = True
+    try:
+        with cond:
+            while not predicate():
+                if deadline is None:
+                    cond.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError()
+                    cond.wait(remaining)
+    finally:
+        if registered:
+            for event in events:
+                with event._cond:
+                    event._waiters.remove(cond)
+
+def wait_any(timeout=None, *events, **kwargs):
     """
     Blocks until any of the specified events are triggered.
     Returns the index of the event that was triggerd or raises
     a TimeoutError
     Param timeout: A timeout in seconds
+    Param deadline: (keyword only) alternatively an absolute deadline in
+                    time.monotonic() time
     """
-    or_event = threading.Event()
-    subscriptions = []
-    for event in events:
-        subscriptions.append((event, event.subscribe(lambda: or_event.set())))
-    or_event.wait(timeout=timeout)
-    for event, sub in subscriptions:
-        event.unsubscribe(sub)
+    _wait_for(events, lambda: any(event._is_set for event in events),
+              timeout, kwargs.get('deadline', None))
     for i in range(len(events)):
         if events[i].is_set():
             return i
-    raise TimeoutError()
+
+def wait_all(timeout=None, *events, **kwargs):
+    """
+    Blocks until all of the specified events are triggered or raises
+    a TimeoutError
+    Param timeout: A timeout in seconds
+    Param deadline: (keyword only) alternatively an absolute deadline in
+                    time.monotonic() time
+    """
+    _wait_for(events, lambda: all(event._is_set for event in events),
+              timeout, kwargs.get('deadline', None))
 
 
 ## Log utils ##
@@ -0,0 +1,56 @@
+"""
+Tests for the asyncio interface in fibre.aio.
+
+Run from Firmware/fibre/python with:
+    python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import asyncio
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'benchmarks'))
+
+from fake_device import FakeDevice, open_object # sets up the import path
+import fibre.aio
+
+class TestAio(unittest.TestCase):
+    def setUp(self):
+        self.device = FakeDevice()
+        self.obj = open_object(self.device, loss=0.05)
+        channel = self.obj.__channel__
+        channel._max_resend_timeout = 0.1 # a lost trigger is resent after that
+        self.addCleanup(channel.fake_link.close)
+        self.addCleanup(channel.close)
+
+    def run_coroutine(self, coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def test_get_set_call(self):
+        async def main():
+            await fibre.aio.set_value(self.obj, 'axis0.encoder.config.cpr', 8192)
+            values = await asyncio.gather(*[fibre.aio.get_value(self.obj, 'axis0.encoder.config.cpr') for _ in range(20)])
+            return values, await fibre.aio.call(self.obj.get_adc_voltage, 3)
+        values, voltage = self.run_coroutine(main())
+        self.assertEqual(values, [8192] * 20)
+        self.assertEqual(voltage, 3.0)
+
+    def test_operation_completes_after_the_loop_was_closed(self):
+        channel = self.obj.__channel__
+        endpoint_id = self.device.endpoint_id('vbus_voltage')
+        operation = channel.submit_endpoint_operation(endpoint_id, None, True, 4)
+        async def subscribe():
+            fibre.aio._done_future(operation)
+        self.run_coroutine(subscribe())
+        # The receiver thread completes the operation. Its callback must not
+        # fail because the loop is closed, that would break the channel.
+        operation.result()
+        self.assertFalse(channel._channel_broken.is_set())
+
+if __name__ == '__main__':
+    unittest.main()
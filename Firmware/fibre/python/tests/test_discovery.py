@@ -0,0 +1,319 @@
+"""
+Tests for the hotplug driven discovery loops of the USB and serial
+transports. The buses are replaced by fake enumerators and the hotplug
+monitor by a script, so neither hardware nor udev is needed.
+
+Run from Firmware/fibre/python with:
+    python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import time
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'benchmarks'))
+
+from fake_device import FakeDevice, open_channel # sets up the import path
+from fake_usb import FakeUSBDevice
+import usb.core
+import fibre.discovery
+import fibre.hotplug
+import fibre.serial_transport
+import fibre.usbbulk_transport
+from fibre.utils import Event, Logger
+
+class ScriptedMonitor(object):
+    """
+    Hotplug monitor that runs the next step of a script on every wait()
+    and reports it as a hotplug event. Once the script is done, it ends the
+    discovery loop by setting the cancellation token.
+    """
+    hotplug = True
+
+    def __init__(self, steps, cancellation_token):
+        self._steps = list(steps)
+        self._cancellation_token = cancellation_token
+        self.timeouts = []
+        self.closed = False
+
+    def wait(self, timeout):
+        self.timeouts.append(timeout)
+        if not self._steps:
+            self._cancellation_token.set()
+            return False
+        self._steps.pop(0)()
+        return True
+
+    def close(self):
+        self.closed = True
+
+class CountingUSBDevice(FakeUSBDevice):
+    """
+    FakeUSBDevice at the specified bus address that counts how often its
+    serial number is read (a control transfer on a real bus).
+    """
+    def __init__(self, bus, address, serial_number=None, init_error=None):
+        device = FakeDevice()
+        if serial_number is not None:
+            device.set('serial_number', serial_number)
+        FakeUSBDevice.__init__(self, device)
+        self.bus = bus
+        self.address = address
+        self.serial_reads = 0
+        self._init_error = init_error
+
+    @property
+    def serial_number(self):
+        self.serial_reads += 1
+        return self._serial_number
+
+    @serial_number.setter
+    def serial_number(self, value):
+        self._serial_number = value
+
+    def reset(self):
+        if self._init_error is not None:
+            raise self._init_error
+
+class DiscoveryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.logger = Logger(verbose=False)
+        self.cancellation_token = Event()
+        self.channel_termination_token = Event()
+        self.channels = []
+        self.devices = []
+
+    def tearDown(self):
+        self.channel_termination_token.set()
+        for device in self.devices:
+            device.link.close()
+
+    def add_usb_device(self, *args, **kwargs):
+        device = CountingUSBDevice(*args, **kwargs)
+        self.devices.append(device)
+        return device
+
+    def run_usb_discovery(self, bus, steps, serial_number=None):
+        """
+        Runs USB discovery on the list bus, which the steps of the script
+        modify, and returns the monitor.
+        """
+        monitor = ScriptedMonitor(steps, self.cancellation_token)
+        fibre.usbbulk_transport.discover_channels(
+                None, serial_number, self.channels.append, self.cancellation_token,
+                self.channel_termination_token, self.logger,
+                enumerate_devices=lambda: list(bus), monitor=monitor)
+        return monitor
+
+class TestUSBDiscovery(DiscoveryTestCase):
+    def test_add_remove_and_readd(self):
+        bus = []
+        first = self.add_usb_device(1, 5)
+        second = self.add_usb_device(1, 5) # plugged in again at the same address
+        monitor = self.run_usb_discovery(bus, [
+            lambda: bus.append(first),
+            lambda: None, # unrelated event
+            lambda: bus.remove(first),
+            lambda: bus.append(second),
+        ])
+        self.assertEqual([c.usb_device for c in self.channels], [first, second])
+        self.assertTrue(monitor.closed)
+
+    def test_ignores_other_devices(self):
+        other = self.add_usb_device(1, 6)
+        other.idVendor = 0x1234
+        bus = [other]
+        self.run_usb_discovery(bus, [lambda: None])
+        self.assertEqual(self.channels, [])
+
+    def test_serial_numbers_are_cached(self):
+        wanted = self.add_usb_device(1, 5, serial_number=0x1234)
+        other = self.add_usb_device(1, 6, serial_number=0x5678)
+        bus = [wanted, other]
+        self.run_usb_discovery(bus, [
+            lambda: None,
+            lambda: None,
+            lambda: bus.remove(other),
+            lambda: bus.append(other),
+        ], serial_number="{:012X}".format(0x1234))
+        self.assertEqual([c.usb_device for c in self.channels], [wanted])
+        # Once matched, a device is not looked at again
+        self.assertEqual(wanted.serial_reads, 1)
+        # The other one is read once per time it was plugged in
+        self.assertEqual(other.serial_reads, 2)
+
+    def test_inaccessible_device_is_retried(self):
+        denied = self.add_usb_device(1, 5, init_error=usb.core.USBError("Access denied", None, 13))
+        bus = [denied]
+        def allow():
+            denied._init_error = None
+        monitor = self.run_usb_discovery(bus, [allow])
+        self.assertEqual([c.usb_device for c in self.channels], [denied])
+        self.assertEqual(monitor.timeouts[0], 1.0) # retry interval of discovery_loop()
+        self.assertEqual(monitor.timeouts[1], 10.0) # rescan interval
+
+class TestSerialDiscovery(DiscoveryTestCase):
+    def setUp(self):
+        DiscoveryTestCase.setUp(self)
+        self.ptys = []
+
+    def tearDown(self):
+        DiscoveryTestCase.tearDown(self) # closes the serial ports (see did_disconnect)
+        for fd in self.ptys:
+            os.close(fd)
+
+    def open_pty(self):
+        master, slave = os.openpty()
+        self.ptys += [master, slave]
+        return os.ttyname(slave)
+
+    @unittest.skipUnless(hasattr(os, 'openpty'), "needs pseudo terminals")
+    def test_add_remove_and_readd(self):
+        port = self.open_pty()
+        other_port = self.open_pty()
+        ports = []
+        monitor = ScriptedMonitor([
+            lambda: ports.extend([port, other_port]),
+            lambda: None,
+            lambda: ports.remove(port),
+            lambda: ports.append(port),
+        ], self.cancellation_token)
+        fibre.serial_transport.discover_channels(
+                port + "@921600", None, self.channels.append, self.cancellation_token,
+                self.channel_termination_token, self.logger,
+                enumerate_ports=lambda: list(ports), monitor=monitor)
+        self.assertEqual([c._name for c in self.channels], ["serial port {}@921600".format(port)] * 2)
+        self.assertEqual(self.channels[0].serial_device._dev.baudrate, 921600)
+
+# Interface definition that takes few requests to download
+SMALL_INTERFACE = [
+    ('serial_number', 'uint64', 'r'),
+    ('hw_version_major', 'uint8', 'r'),
+    ('hw_version_minor', 'uint8', 'r'),
+    ('hw_version_variant', 'uint8', 'r'),
+]
+
+class TestFindAll(unittest.TestCase):
+    def setUp(self):
+        self._interface_cache = fibre.discovery.interface_cache
+        fibre.discovery.interface_cache = None
+        self.cancellation_token = Event()
+        self.channels = []
+
+    def tearDown(self):
+        self.cancellation_token.set()
+        fibre.discovery.interface_cache = self._interface_cache
+        for channel_type in ('fake', 'other'):
+            fibre.discovery.channel_types.pop(channel_type, None)
+        for channel in self.channels:
+            channel.close()
+            channel.fake_link.close()
+
+    def find_all(self, links, callback, other_links=[]):
+        """
+        Runs find_all() on channels to the specified (device, latency) links,
+        which are discovered in that order. The other_links are discovered
+        by a second transport type.
+        """
+        discovered_all = threading.Event()
+        def discover_channels(links, discovered):
+            for device, latency in links:
+                channel = open_channel(device, latency=latency)
+                self.channels.append(channel)
+                discovered(channel)
+        fibre.discovery.channel_types['fake'] = lambda path, serial_number, discovered, *args: \
+            (discover_channels(links, discovered), discovered_all.set())
+        fibre.discovery.channel_types['other'] = lambda path, serial_number, discovered, *args: \
+            (discovered_all.wait(), discover_channels(other_links, discovered))
+        fibre.discovery.find_all('fake,other', None, callback, self.cancellation_token, Event(), Logger(verbose=False))
+
+    def test_outdated_channel_is_closed(self):
+        device = FakeDevice(SMALL_INTERFACE, blob_size=0)
+        found = threading.Event()
+        objects = []
+        def did_discover_object(obj):
+            objects.append(obj)
+            found.set()
+        # The first channel is still initializing when the second one is done
+        self.find_all([(device, 0.05), (device, 0.0)], did_discover_object)
+        self.assertTrue(found.wait(5.0))
+        old, new = self.channels
+        old._channel_broken.wait(5.0)
+        self.assertEqual([obj.__channel__ for obj in objects], [new])
+        self.assertFalse(new._channel_broken.is_set())
+
+    def test_other_transport_doesnt_replace_the_channel(self):
+        device = FakeDevice(SMALL_INTERFACE, blob_size=0)
+        all_found = threading.Event()
+        objects = []
+        def did_discover_object(obj):
+            objects.append(obj)
+            if len(objects) == 2:
+                all_found.set()
+        # Discovered later but done first, like the channel above
+        self.find_all([(device, 0.05)], did_discover_object, other_links=[(device, 0.0)])
+        self.assertTrue(all_found.wait(5.0))
+        self.assertEqual(set(obj.__channel__ for obj in objects), set(self.channels))
+        self.assertFalse(any(channel._channel_broken.is_set() for channel in self.channels))
+
+    def test_devices_without_serial_number_are_not_deduplicated(self):
+        interface = [member for member in SMALL_INTERFACE if member[0] != 'serial_number']
+        devices = [FakeDevice(interface, blob_size=0) for i in range(2)]
+        all_found = threading.Event()
+        objects = []
+        def did_discover_object(obj):
+            objects.append(obj)
+            if len(objects) == 2:
+                all_found.set()
+        self.find_all([(devices[0], 0.05), (devices[1], 0.0)], did_discover_object)
+        self.assertTrue(all_found.wait(5.0))
+        self.assertEqual(set(obj.__channel__ for obj in objects), set(self.channels))
+        self.assertFalse(any(channel._channel_broken.is_set() for channel in self.channels))
+
+    def test_callback_runs_outside_the_lock(self):
+        devices = [FakeDevice(SMALL_INTERFACE, blob_size=0) for i in range(3)]
+        for i, device in enumerate(devices):
+            device.set('serial_number', 0x100 + i)
+        all_found = threading.Event()
+        objects = []
+        active = []
+        def did_discover_object(obj):
+            self.assertEqual(active, []) # never invoked concurrently
+            active.append(obj)
+            time.sleep(0.05) # other devices finish their initialization meanwhile
+            objects.append(obj)
+            active.remove(obj)
+            if len(objects) == 2:
+                raise RuntimeError() # doesn't stop the delivery of the others
+            if len(objects) == len(devices):
+                all_found.set()
+        self.find_all([(device, 0.0) for device in devices], did_discover_object)
+        self.assertTrue(all_found.wait(5.0))
+        self.assertEqual(set(obj.__channel__ for obj in objects), set(self.channels))
+
+class TestDiscoveryLoop(unittest.TestCase):
+    def test_monitor_is_closed_when_scan_fails(self):
+        token = Event()
+        monitor = ScriptedMonitor([], token)
+        def scan():
+            raise RuntimeError()
+        with self.assertRaises(RuntimeError):
+            fibre.hotplug.discovery_loop(scan, monitor, token)
+        self.assertTrue(monitor.closed)
+
+    def test_parse_uevent(self):
+        kernel = b'add@/devices/usb1/1-1\0ACTION=add\0SUBSYSTEM=usb\0DEVNAME=bus/usb/001/005\0'
+        self.assertEqual(fibre.hotplug.parse_uevent(kernel),
+                         {'ACTION': 'add', 'SUBSYSTEM': 'usb', 'DEVNAME': 'bus/usb/001/005'})
+        properties = b'ACTION=remove\0SUBSYSTEM=tty\0'
+        header = fibre.hotplug._UDEV_HEADER.pack(fibre.hotplug._UDEV_PREFIX, 0xfeedcafe,
+                                                 fibre.hotplug._UDEV_HEADER.size,
+                                                 fibre.hotplug._UDEV_HEADER.size, len(properties))
+        self.assertEqual(fibre.hotplug.parse_uevent(header + properties),
+                         {'ACTION': 'remove', 'SUBSYSTEM': 'tty'})
+        self.assertIsNone(fibre.hotplug.parse_uevent(fibre.hotplug._UDEV_PREFIX))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+"""
+Tests for the persistent cache of interface definitions.
+
+Run from Firmware/fibre/python with:
+    python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'benchmarks'))
+
+from fake_device import FakeDevice, open_channel # sets up the import path
+import fibre.discovery
+from fibre.interface_cache import InterfaceCache
+from fibre.utils import Logger
+
+class TestInterfaceCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.device = FakeDevice(blob_size=0)
+
+    def fetch(self, cache):
+        channel = open_channel(self.device)
+        self.addCleanup(channel.fake_link.close)
+        self.addCleanup(channel.close)
+        requests_before = self.device.request_count
+        result = cache.fetch(channel, Logger(verbose=False))
+        self.assertEqual(result, (self.device.json, self.device.json_crc))
+        return self.device.request_count - requests_before
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(fibre.discovery.interface_cache)
+
+    def test_directory_is_created_on_first_fetch(self):
+        directory = os.path.join(self.directory, 'interfaces')
+        cache = InterfaceCache(directory)
+        self.assertFalse(os.path.exists(directory))
+        cold_requests = self.fetch(cache)
+        self.assertEqual(len(os.listdir(directory)), 1)
+        self.assertLess(self.fetch(InterfaceCache(directory)), cold_requests)
+
+    def test_write_errors_are_ignored(self):
+        # A file where the directory should be
+        path = os.path.join(self.directory, 'interfaces')
+        open(path, 'w').close()
+        self.fetch(InterfaceCache(path))
+
+    def test_parsed_definitions_are_limited(self):
+        cache = InterfaceCache(self.directory)
+        first = cache.parse(b'[1]', 1)
+        for i in range(cache.max_parsed):
+            cache.parse('[{}]'.format(i + 2).encode('ascii'), i + 2)
+        self.assertEqual(len(cache._parsed), cache.max_parsed)
+        self.assertIsNot(cache.parse(b'[1]', 1), first) # parsed again
+        self.assertEqual(len(cache._parsed), cache.max_parsed)
+
+if __name__ == '__main__':
+    unittest.main()
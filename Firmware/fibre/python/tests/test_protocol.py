@@ -0,0 +1,143 @@
+"""
+Tests for the packet framing and the Channel of fibre.protocol.
+
+Run from Firmware/fibre/python with:
+    python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'benchmarks'))
+
+import fake_device # sets up the import path
+import fibre.protocol
+from fibre.protocol import SYNC_BYTE, CRC8_INIT, calc_crc8
+from fibre.utils import Event, Logger
+
+class PacketRecorder(fibre.protocol.PacketSink):
+    def __init__(self):
+        self.packets = []
+
+    def process_packet(self, packet):
+        self.packets.append(bytes(packet))
+
+class StreamRecorder(fibre.protocol.StreamSink):
+    def __init__(self):
+        self.data = bytearray()
+
+    def process_bytes(self, data):
+        self.data += data
+
+def frame(packet, mtu=fibre.protocol.MAX_EXTENDED_PACKET_SIZE - 1):
+    stream = StreamRecorder()
+    framer = fibre.protocol.StreamBasedPacketSink(stream)
+    framer.set_mtu(mtu)
+    framer.process_packet(packet)
+    return bytes(stream.data)
+
+def spurious_header(length):
+    """
+    Returns a header with a valid CRC8 that announces a packet of the
+    specified length, as it may show up by chance in the payload of a frame.
+    """
+    if length < fibre.protocol.MAX_PACKET_SIZE:
+        header = bytearray([SYNC_BYTE, length])
+    else:
+        header = bytearray([SYNC_BYTE, 0x80 | (length >> 8), length & 0xff])
+    header.append(calc_crc8(CRC8_INIT, header))
+    return bytes(header)
+
+class TestStreamToPacketSegmenter(unittest.TestCase):
+    def setUp(self):
+        self.packets = PacketRecorder()
+        self.segmenter = fibre.protocol.StreamToPacketSegmenter(self.packets)
+
+    def test_packets(self):
+        self.segmenter.process_bytes(b'\x00' + frame(b'hello') + frame(b'world')[:4])
+        self.assertEqual(self.packets.packets, [b'hello'])
+        self.segmenter.process_bytes(frame(b'world')[4:])
+        self.assertEqual(self.packets.packets, [b'hello', b'world'])
+
+    def test_spurious_header_beyond_mtu(self):
+        # Doesn't hold up the packets behind it
+        self.segmenter.process_bytes(spurious_header(30000) + frame(b'hello'))
+        self.assertEqual(self.packets.packets, [b'hello'])
+
+    def test_resync_after_spurious_header(self):
+        frames = [frame(bytes(bytearray([i])) * 10) for i in range(3)]
+        data = spurious_header(20) + b''.join(frames)
+        self.segmenter.process_bytes(data[:20])
+        self.assertEqual(self.packets.packets, []) # waits for the announced length
+        self.segmenter.process_bytes(data[20:])
+        self.assertEqual(self.packets.packets, [bytes(bytearray([i])) * 10 for i in range(3)])
+
+    def test_set_mtu(self):
+        self.segmenter.process_bytes(frame(b'a' * 300))
+        self.assertEqual(self.packets.packets, [])
+        self.segmenter.set_mtu(512)
+        self.segmenter.process_bytes(frame(b'b' * 300))
+        self.assertEqual(self.packets.packets, [b'b' * 300])
+
+    def test_converter_follows_the_channel_mtu(self):
+        converter = fibre.protocol.PacketFromStreamConverter(None)
+        self.assertEqual(converter._segmenter._mtu, fibre.protocol.DEFAULT_MTU)
+        converter.set_mtu(512)
+        self.assertEqual(converter._segmenter._mtu, 512)
+
+class FailingOutput(fibre.protocol.PacketSink):
+    def __init__(self, error):
+        self.error = error
+
+    def process_packet(self, packet):
+        if self.error is not None:
+            raise self.error
+
+class NoInput(fibre.protocol.PacketSource):
+    def start_receiving(self, sink, broken):
+        return True # no receiver thread
+
+    def get_packet(self, deadline):
+        raise TimeoutError()
+
+class TestChannel(unittest.TestCase):
+    def open_channel(self, output):
+        channel = fibre.protocol.Channel("test", NoInput(), output, Event(), Logger(verbose=False))
+        self.addCleanup(channel.close)
+        return channel
+
+    def test_output_error_fails_the_operation(self):
+        channel = self.open_channel(FailingOutput(OSError("closed socket")))
+        operation = channel.submit_endpoint_operation(1, None, True, 4)
+        with self.assertRaises(OSError):
+            operation.result(timeout=1.0)
+        self.assertEqual(channel._in_flight, 0)
+        self.assertEqual(channel._expected_acks, {})
+
+    def test_output_error_doesnt_reach_other_callers(self):
+        output = FailingOutput(None)
+        channel = self.open_channel(output)
+        operation = channel.submit_endpoint_operation(1, None, True, 4)
+        output.error = fibre.protocol.ChannelBrokenException()
+        operation._resend_deadline = 0
+        channel._resend_overdue() # resends on behalf of the owner of the operation
+        with self.assertRaises(fibre.protocol.ChannelBrokenException):
+            operation.result(timeout=1.0)
+        self.assertEqual(channel._in_flight, 0)
+
+    def test_break_before_insert(self):
+        channel = self.open_channel(FailingOutput(fibre.protocol.TimeoutError()))
+        try_acquire_window = channel._try_acquire_window
+        def break_while_acquiring():
+            # The channel breaks after _submit() checked for it
+            channel._channel_broken.set()
+            return try_acquire_window()
+        channel._try_acquire_window = break_while_acquiring
+        with self.assertRaises(fibre.protocol.ChannelBrokenException):
+            channel.submit_endpoint_operation(1, None, True, 4, block=False)
+        self.assertEqual(channel._in_flight, 0)
+        self.assertEqual(channel._expected_acks, {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+"""
+Tests for calls of remote functions over a link that loses specific packets.
+
+Run from Firmware/fibre/python with:
+    python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import time
+import struct
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'benchmarks'))
+
+from fake_device import FakeDevice, open_object # sets up the import path
+import fibre.protocol
+
+class DroppingOutput(fibre.protocol.PacketSink):
+    """
+    Drops the next count requests to the specified endpoint.
+    """
+    def __init__(self, output):
+        self._output = output
+        self._drops = {}
+
+    def drop(self, endpoint_id, count=1):
+        self._drops[endpoint_id] = count
+
+    def process_packet(self, packet):
+        endpoint_id = struct.unpack_from('<H', packet, 2)[0] & 0x7fff
+        if self._drops.get(endpoint_id, 0) > 0:
+            self._drops[endpoint_id] -= 1
+            return
+        self._output.process_packet(packet)
+
+class TestRemoteFunction(unittest.TestCase):
+    def setUp(self):
+        self.device = FakeDevice()
+        self.odrv = open_object(self.device)
+        channel = self.odrv.__channel__
+        self.addCleanup(channel.fake_link.close)
+        self.addCleanup(channel.close)
+        channel._max_resend_timeout = 0.1
+        self.output = DroppingOutput(channel._output)
+        channel._output = self.output
+        self.calls = []
+        call = self.device._call
+        def counting_call(function):
+            self.calls.append([self.device._values[arg["id"]] for arg in function["inputs"]])
+            call(function)
+        self.device._call = counting_call
+        self.func = self.odrv.test_function
+
+    def test_call(self):
+        self.assertEqual(self.func(5), 5)
+        self.assertEqual(self.calls, [[5]])
+
+    def test_lost_argument_write(self):
+        # The function runs with the previous argument first, so the call
+        # is repeated
+        self.func(1)
+        self.output.drop(self.func._inputs[0]._id)
+        self.assertEqual(self.func(5), 5)
+        self.assertEqual(self.calls, [[1], [1], [5]])
+
+    def test_lost_argument_ack(self):
+        channel = self.odrv.__channel__
+        write_id = self.func._inputs[0]._id
+        dropped = []
+        process_packet = channel.process_packet
+        def drop_write_ack(packet):
+            operation = channel._expected_acks.get(struct.unpack_from('<H', packet, 0)[0] & 0x7fff, None)
+            if not dropped and operation is not None and \
+                    struct.unpack_from('<H', operation._packet, 2)[0] & 0x7fff == write_id:
+                dropped.append(packet)
+                return
+            process_packet(packet)
+        channel.process_packet = drop_write_ack
+        self.assertEqual(self.func(5), 5)
+        self.assertEqual(len(dropped), 1)
+        self.assertEqual(self.calls[-1], [5])
+
+    def test_lost_trigger(self):
+        self.output.drop(self.func._trigger_id)
+        self.assertEqual(self.func(5), 5)
+        self.assertEqual(self.calls, [[5]])
+
+    def test_trigger_attempts_are_limited(self):
+        self.output.drop(self.func._trigger_id, self.func._trigger_attempts)
+        start = time.monotonic()
+        with self.assertRaises(fibre.protocol.ChannelBrokenException):
+            self.func(5)
+        self.assertLess(time.monotonic() - start, 1.0)
+        self.assertEqual(self.calls, [])
+
+if __name__ == '__main__':
+    unittest.main()
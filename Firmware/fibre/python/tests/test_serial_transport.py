@@ -0,0 +1,67 @@
+"""
+Tests for SerialStreamTransport on pseudo terminals.
+
+Run from Firmware/fibre/python with:
+    python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import time
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'benchmarks'))
+
+import fake_device # sets up the import path
+import fibre.protocol
+from fibre.serial_transport import SerialStreamTransport
+
+@unittest.skipUnless(hasattr(os, 'openpty'), "needs pseudo terminals")
+class TestSerialStreamTransport(unittest.TestCase):
+    def setUp(self):
+        self.master, slave = os.openpty()
+        self.port = os.ttyname(slave)
+        self.addCleanup(os.close, self.master)
+        self.addCleanup(os.close, slave)
+
+    def test_read(self):
+        for reader_thread in (False, True):
+            transport = SerialStreamTransport(self.port, 115200, reader_thread=reader_thread)
+            os.write(self.master, b'hello')
+            self.assertEqual(transport.get_bytes(5, time.monotonic() + 1.0), b'hello')
+            self.assertEqual(transport.get_available_bytes(5, time.monotonic() + 0.01), b'')
+            transport.close()
+
+    def test_close_twice(self):
+        for reader_thread in (False, True):
+            transport = SerialStreamTransport(self.port, 115200, reader_thread=reader_thread)
+            transport.close()
+            transport.close()
+            with self.assertRaises(fibre.protocol.ChannelBrokenException):
+                transport.get_bytes(1, None)
+
+    def test_close_interrupts_read(self):
+        transport = SerialStreamTransport(self.port, 115200, reader_thread=False)
+        wake_pipe = (transport._wake_r, transport._wake_w)
+        errors = []
+        def read():
+            try:
+                transport.get_bytes(1, None)
+            except fibre.protocol.ChannelBrokenException as ex:
+                errors.append(ex)
+        t = threading.Thread(target=read)
+        t.start()
+        time.sleep(0.05)
+        transport.close()
+        t.join(1.0)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(len(errors), 1)
+        # The reader was the last one to use the wake up pipe and closed it
+        for fd in wake_pipe:
+            with self.assertRaises(OSError):
+                os.fstat(fd)
+        transport.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+"""
+Tests for the reassembly of packets that span multiple USB packets, with
+synchronous reads and with asynchronous IN transfers.
+
+Run from Firmware/fibre/python with:
+    python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'benchmarks'))
+
+from fake_device import FakeDevice # sets up the import path
+from fake_usb import open_transport
+import fibre.protocol
+from fibre.utils import Event, Logger
+
+class PacketRecorder(fibre.protocol.PacketSink):
+    def __init__(self):
+        self.packets = []
+
+    def process_packet(self, packet):
+        self.packets.append(bytes(packet))
+
+class TestDeliverPacket(unittest.TestCase):
+    """
+    Feeds USB packets to _deliver_packet() like _on_transfer_done() does.
+    """
+    def setUp(self):
+        device = FakeDevice()
+        self.transport = open_transport(device, 0, Logger(verbose=False))
+        self.addCleanup(self.transport.dev.link.close)
+        self.sink = PacketRecorder()
+        # set up like start_receiving() does
+        self.transport._sink = self.sink
+        self.transport._partial = bytearray()
+        self.transport._packet_size = 64
+        self.transport.set_mtu(512)
+
+    def deliver(self, *packets):
+        for data in packets:
+            self.transport._deliver_packet(data)
+
+    def test_short_packet(self):
+        self.deliver(b'a' * 10)
+        self.assertEqual(self.sink.packets, [b'a' * 10])
+
+    def test_multiple_usb_packets(self):
+        self.deliver(b'a' * 64, b'b' * 64, b'c' * 10)
+        self.assertEqual(self.sink.packets, [b'a' * 64 + b'b' * 64 + b'c' * 10])
+
+    def test_full_mtu(self):
+        # A packet of the size of the MTU ends without a zero length packet
+        self.deliver(*[bytes([i]) * 64 for i in range(8)])
+        self.assertEqual(self.sink.packets, [b''.join(bytes([i]) * 64 for i in range(8))])
+        self.deliver(b'x')
+        self.assertEqual(self.sink.packets[1:], [b'x'])
+
+    def test_zero_length_packet(self):
+        self.deliver(b'a' * 64, b'')
+        self.assertEqual(self.sink.packets, [b'a' * 64])
+        self.deliver(b'') # on its own, a zero length packet is ignored
+        self.assertEqual(len(self.sink.packets), 1)
+
+    def test_failed_transfer_drops_partial_packet(self):
+        self.deliver(b'a' * 64, None)
+        self.assertEqual(self.sink.packets, [])
+        self.deliver(b'b' * 10)
+        self.assertEqual(self.sink.packets, [b'b' * 10])
+
+    def test_default_mtu(self):
+        # Before the MTU is raised, every USB packet is a packet of its own
+        self.transport.set_mtu(fibre.protocol.DEFAULT_MTU)
+        self.deliver(b'a' * 64, b'b' * 10)
+        self.assertEqual(self.sink.packets, [b'a' * 64, b'b' * 10])
+
+class TestGetPacket(unittest.TestCase):
+    """
+    Synchronous reads through get_packet(), with the USB packets queued on
+    the fake device.
+    """
+    def setUp(self):
+        device = FakeDevice()
+        self.transport = open_transport(device, 0, Logger(verbose=False))
+        self.addCleanup(self.transport.dev.link.close)
+
+    def get_packet(self, *packets):
+        self.transport.dev._packets.extend(packets)
+        return bytes(self.transport.get_packet(time.monotonic() + 0.5))
+
+    def test_multiple_usb_packets(self):
+        self.transport.set_mtu(512)
+        self.assertEqual(self.get_packet(b'a' * 64, b'b' * 64, b'c' * 10), b'a' * 64 + b'b' * 64 + b'c' * 10)
+        self.assertEqual(self.get_packet(b'a' * 64, b''), b'a' * 64)
+
+    def test_default_mtu(self):
+        # A full USB packet is a packet of its own and doesn't wait for more
+        self.assertEqual(self.get_packet(b'a' * 64), b'a' * 64)
+        self.assertEqual(self.get_packet(b'b' * 10), b'b' * 10)
+
+class TestAsyncTransfers(unittest.TestCase):
+    def test_read_buffer(self):
+        device = FakeDevice(max_mtu=512)
+        transport = open_transport(device, 4, Logger(verbose=False))
+        zero_length_packets = [0]
+        next_packet = transport.dev.next_packet
+        def counting_next_packet(not_before, deadline):
+            packet = next_packet(not_before, deadline)
+            if packet == b'':
+                zero_length_packets[0] += 1
+            return packet
+        transport.dev.next_packet = counting_next_packet
+        channel = fibre.protocol.Channel("fake USB device", transport, transport, Event(), Logger(verbose=False))
+        self.addCleanup(transport.dev.link.close)
+        self.addCleanup(channel.close)
+        channel._interface_definition_crc = device.json_crc
+        self.assertEqual(channel.negotiate_mtu(), 512)
+        # The chunks of the blob fill the MTU, so each one ends with a zero
+        # length packet
+        self.assertEqual(channel.remote_endpoint_read_buffer(device.blob_id), device.blob)
+        self.assertGreater(zero_length_packets[0], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -18,6 +18,7 @@ import usb.core
 import fibre
 import odrive
 from odrive.utils import Event, OperationAbortedException
+from fibre.utils import TimeoutError
 from odrive.dfuse import *
 
 try:
@@ -201,11 +202,9 @@ def show_deferred_message(message, cancellation_token):
     Shows a message after 10s, unless cancellation_token gets set.
     """
     def show_message_thread(message, cancellation_token):
-        for _ in range(1,10):
-            if cancellation_token.is_set():
-                return
-            time.sleep(1)
-        if not cancellation_token.is_set():
+        try:
+            cancellation_token.wait(timeout=10)
+        except TimeoutError:
             print(message)
     t = threading.Thread(target=show_message_thread, args=(message, cancellation_token))
     t.daemon = True
@@ -241,7 +240,10 @@ def find_device_in_dfu_mode(serial_number, cancellation_token):
         stm_device = usb.core.find(idVendor=0x0483, idProduct=0xdf11, **params)
         if stm_device != None:
             return stm_device
-        time.sleep(1)
+        try:
+            cancellation_token.wait(timeout=1)
+        except TimeoutError:
+            pass
     return None
 
 def update_device(device, firmware, logger, cancellation_token):
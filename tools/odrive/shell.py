@@ -5,7 +5,7 @@ import threading
 import fibre
 import odrive
 import odrive.enums
-from odrive.utils import start_liveplotter, dump_errors
+from odrive.utils import start_liveplotter, dump_errors, dump_channel_metrics
 #from odrive.enums import * # pylint: disable=W0614
 
 def print_banner():
@@ -77,7 +77,8 @@ def launch_shell(args, logger, app_shutdown_token):
 
     interactive_variables = {
         'start_liveplotter': start_liveplotter,
-        'dump_errors': dump_errors
+        'dump_errors': dump_errors,
+        'dump_channel_metrics': dump_channel_metrics
     }
 
     # Expose all enums from odrive.enums
@@ -41,7 +41,7 @@ class ODriveTestContext():
         self.handle = odrive.find_any(
             path="usb", serial_number=self.yaml['serial-number'], timeout=15)#, printer=print)
         for axis_idx, axis_ctx in enumerate(self.axes):
-            axis_ctx.handle = self.handle.__dict__['axis{}'.format(axis_idx)]
+            axis_ctx.handle = self.handle._remote_attributes['axis{}'.format(axis_idx)]
 
 class AxisTestContext():
     def __init__(self, name: str, yaml: dict, odrv_ctx: ODriveTestContext):
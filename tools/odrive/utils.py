@@ -7,6 +7,7 @@ import platform
 import subprocess
 import os
 from fibre.utils import Event
+from fibre.sampler import Sampler
 from odrive.enums import errors
 
 try:
@@ -60,13 +61,23 @@ def dump_errors(odrv, clear=False):
             else:
                 print(prefix + _VT100Colors['green'] + "no error" + _VT100Colors['default'])
 
+def dump_channel_metrics(odrv):
+    """
+    Prints the statistics of the connection to the specified ODrive:
+    round trip latencies, resends, corrupt frames and so on.
+    """
+    print(odrv.__channel__.metrics)
+
 data_rate = 10
 plot_rate = 10
 num_samples = 1000
-def start_liveplotter(get_var_callback):
+def start_liveplotter(get_var_callback=None, obj=None, paths=()):
     """
     Starts a liveplotter.
-    The variable that is plotted is retrieved from get_var_callback.
+    The variables that are plotted are either retrieved from get_var_callback
+    or are the properties at the specified paths relative to obj, e.g.
+    start_liveplotter(obj=odrv0, paths=['axis0.encoder.pos_estimate']).
+    Properties given by path are all read in a single round trip.
     This function returns immediately and the liveplotter quits when
     the user closes it.
     """
@@ -75,27 +86,14 @@ def start_liveplotter(get_var_callback):
 
     cancellation_token = Event()
 
-    global vals
-    vals = []
-    def fetch_data():
-        global vals
-        while not cancellation_token.is_set():
-            try:
-                data = get_var_callback()
-            except Exception as ex:
-                print(str(ex))
-                time.sleep(1)
-                continue
-            vals.append(data)
-            if len(vals) > num_samples:
-                vals = vals[-num_samples:]
-            time.sleep(1/data_rate)
+    sampler = Sampler(obj, paths, rate=data_rate, capacity=num_samples,
+                      callback=get_var_callback, cancellation_token=cancellation_token,
+                      error_callback=lambda ex: print(str(ex)))
+    sampler.start()
 
     # TODO: use animation for better UI performance, see:
     # https://matplotlib.org/examples/animation/simple_anim.html
     def plot_data():
-        global vals
-
         plt.ion()
 
         # Make sure the script terminates when the user closes the plotter
@@ -105,23 +103,18 @@ def start_liveplotter(get_var_callback):
         fig.canvas.mpl_connect('close_event', did_close)
 
         while not cancellation_token.is_set():
+            _, vals = sampler.snapshot()
             plt.clf()
             plt.plot(vals)
-            plt.legend(list(range(len(vals))))
+            plt.legend(list(range(len(vals[0]) if len(vals) else 0)))
             fig.canvas.draw()
             fig.canvas.start_event_loop(1/plot_rate)
 
-    fetch_t = threading.Thread(target=fetch_data)
-    fetch_t.daemon = True
-    fetch_t.start()
-    
     plot_t = threading.Thread(target=plot_data)
     plot_t.daemon = True
     plot_t.start()
-    
 
     return cancellation_token;
-    #plot_data()
 
 def print_drv_regs(name, motor):
     """
@@ -173,24 +166,17 @@ def rate_test(device):
 
 def usb_burn_in_test(get_var_callback, cancellation_token):
     """
-    Starts background threads that read a values form the USB device in a spin-loop
+    Starts a background thread that reads values from the USB device in a spin-loop
     """
 
     def fetch_data():
-        global vals
-        i = 0
-        while not cancellation_token.is_set():
-            try:
-                get_var_callback()
-                i += 1
-            except Exception as ex:
-                print(str(ex))
-                time.sleep(1)
-                i = 0
-                continue
-            if i % 1000 == 0:
-                print("read {} values".format(i))
-    threading.Thread(target=fetch_data, daemon=True).start()
+        value = get_var_callback()
+        if (sampler.sample_count + 1) % 1000 == 0:
+            print("read {} values".format(sampler.sample_count + 1))
+        return value
+    sampler = Sampler(rate=None, capacity=1000, callback=fetch_data,
+                      cancellation_token=cancellation_token, error_callback=lambda ex: print(str(ex)))
+    sampler.start()
 
 def yes_no_prompt(question, default=None):
     if default is None: